@@ -50,6 +50,13 @@ class AddChatMessageAction {
   AddChatMessageAction(this.chatId, this.message);
 }
 
+class RemoveChatMessageAction {
+  final String chatId;
+  final ChatMessage message;
+
+  RemoveChatMessageAction(this.chatId, this.message);
+}
+
 List<ChatTile> chatsReducer(List<ChatTile> state, dynamic action) {
   if (action is SetChatsAction) {
     return action.chats;
@@ -70,6 +77,14 @@ Map<String, List<ChatMessage>> chatMessagesReducer(
       ...state,
       action.chatId: List.from(prevMessages)..add(action.message),
     };
+  } else if (action is RemoveChatMessageAction) {
+    final prevMessages = state[action.chatId] ?? [];
+    return {
+      ...state,
+      action.chatId: prevMessages
+          .where((message) => !identical(message, action.message))
+          .toList(),
+    };
   }
   return state;
 }
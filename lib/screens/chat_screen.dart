@@ -478,23 +478,19 @@ class _ChatPageState extends State<ChatPage> {
 
                         // StoreProvider.of<AppState>(context)
                         //     .dispatch(SetIsMessageSendingAction(true));
-                        SocketService()
-                            .send("sndm${widget.chatId} ${text.trim()}");
-
-                        StoreProvider.of<AppState>(context).dispatch(
-                          AddChatMessageAction(
-                            widget.chatId,
-                            ChatMessage(
-                              sender: Profile(
-                                  displayName: displayName,
-                                  photoUrl: FirebaseAuth
-                                          .instance.currentUser?.photoURL ??
+                        final message = ChatMessage(
+                          sender: Profile(
+                              displayName: displayName,
+                              photoUrl:
+                                  FirebaseAuth.instance.currentUser?.photoURL ??
                                       ''),
-                              message: text.trim(),
-                              timestamp: DateTime.now().toLocal(),
-                            ),
-                          ),
+                          message: text.trim(),
+                          timestamp: DateTime.now().toLocal(),
                         );
+                        StoreProvider.of<AppState>(context).dispatch(
+                            AddChatMessageAction(widget.chatId, message));
+                        SocketService().sendChatMessage(
+                            widget.chatId, text.trim(), message);
 
                         _controller.clear();
                         setState(() {});
@@ -14,6 +14,12 @@ class AesCrypt {
   AesCrypt(this.keyParam, this.nonce);
 }
 
+/// Thrown when the server sheds the connection with a "busy" frame instead of its key
+class ServerBusyException implements Exception {
+  @override
+  String toString() => "ServerBusyException: server is shedding load";
+}
+
 /// Utilities for RSA/OAEP key exchange and AES/EAX message framing
 class EncryptionUtils {
   /// Decode PEM-formatted public key to DER bytes
@@ -77,6 +83,7 @@ class EncryptionUtils {
     // receive server RSA public key PEM
     final stream = dataStream ?? socket.cast<Uint8List>().asBroadcastStream();
     final pubPem = utf8.decode(await _readRawFrom(stream));
+    if (pubPem == "busy") throw ServerBusyException();
     // parse public key
     final der = _decodePEM(pubPem);
     final rsaPub = _parsePublicKey(der);
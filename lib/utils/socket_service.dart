@@ -1,6 +1,7 @@
 import 'dart:async';
 import 'dart:convert';
 import 'dart:io';
+import 'dart:math';
 import 'dart:typed_data';
 import 'package:firebase_messaging/firebase_messaging.dart';
 import 'package:flutter/material.dart';
@@ -27,9 +28,21 @@ class SocketService with WidgetsBindingObserver {
   bool _connecting = false;
   Uint8List? _buffer;
 
+  // Failed connection attempts in a row, for exponential backoff
+  int _failedAttempts = 0;
+  final Random _random = Random();
+
   String token = '';
   AesCrypt? _aes;
 
+  // Server sync token from the last chat list, presented on reconnect to get only changes
+  String _syncToken = '';
+
+  // Chat messages shown before the server accepted them, by request id, so a throttled one can be resent
+  final Map<String, _PendingMessage> _pendingMessages = {};
+  int _nextRequestId = 0;
+  static const int _maxSendAttempts = 5;
+
   Store<AppState>? _store;
 
   void registerStore(Store<AppState> store) {
@@ -107,8 +120,9 @@ class SocketService with WidgetsBindingObserver {
         _aes =
             await EncryptionUtils.keyExchange(_socket!, dataStream: byteStream);
         debugPrint("Key exchange completed, AES established.");
+        _failedAttempts = 0;
         // send token encrypted
-        send("user$token");
+        send(_syncToken.isEmpty ? "user$token" : "user$token $_syncToken");
         byteStream.listen(
           (data) {
             _buffer ??= Uint8List(0);
@@ -145,12 +159,21 @@ class SocketService with WidgetsBindingObserver {
         debugPrint("Connection failed: $e");
         _socket?.destroy();
         _socket = null;
-        await Future.delayed(const Duration(seconds: 2));
+        await Future.delayed(_backoff(busy: e is ServerBusyException));
       }
     }
     _connecting = false;
   }
 
+  /// Exponential backoff with full jitter, so clients shed together don't retry together.
+  /// A busy server starts from a longer delay than a network error.
+  Duration _backoff({bool busy = false}) {
+    final base = busy ? 4000 : 1000;
+    final cap = min(60000, base * pow(2, min(_failedAttempts, 10)).toInt());
+    _failedAttempts++;
+    return Duration(milliseconds: _random.nextInt(cap) + 250);
+  }
+
   void send(String message) {
     if (_socket == null) {
       debugPrint("Cannot send: Socket is null, attempting to reconnect");
@@ -175,14 +198,66 @@ class SocketService with WidgetsBindingObserver {
     }
   }
 
+  /// Sends a chat message that is already shown in the chat.
+  /// It is resent with backoff while the server throttles it, and removed if it can't be sent.
+  void sendChatMessage(String chatId, String text, ChatMessage shown,
+      {int attempt = 0}) {
+    final requestId = "m${_nextRequestId++}";
+    _pendingMessages[requestId] =
+        _PendingMessage(chatId, text, shown, attempt);
+    send("#$requestId:sndm$chatId $text");
+  }
+
+  void _handleSendReply(_PendingMessage pending, String result) {
+    if (result == "ok") return;
+    if (result == "throttled" && pending.attempt + 1 < _maxSendAttempts) {
+      // Exponential backoff with full jitter, like reconnects
+      final cap = min(8000, 500 * pow(2, pending.attempt).toInt());
+      final delay = Duration(milliseconds: _random.nextInt(cap) + 250);
+      Future.delayed(
+          delay,
+          () => sendChatMessage(pending.chatId, pending.text, pending.shown,
+              attempt: pending.attempt + 1));
+      return;
+    }
+    debugPrint("Message not sent: $result");
+    _store?.dispatch(RemoveChatMessageAction(pending.chatId, pending.shown));
+  }
+
   void handleIncomingData(String data) {
     if (data.isEmpty) return;
 
+    // Replies to tagged requests start with "#<request id>:"
+    if (data.startsWith("#")) {
+      final separator = data.indexOf(":");
+      if (separator > 0) {
+        final pending = _pendingMessages.remove(data.substring(1, separator));
+        data = data.substring(separator + 1);
+        if (pending != null) {
+          if (data.startsWith("sndm")) {
+            _handleSendReply(pending, data.substring(4));
+            return;
+          }
+          // Refused before it reached the controller (e.g. token_fail)
+          _store?.dispatch(
+              RemoveChatMessageAction(pending.chatId, pending.shown));
+        }
+      }
+    }
+
     if (data.startsWith("token_ok")) {
       debugPrint("Token accepted by server, ready to send/receive messages.");
       _store?.dispatch(SetConnectionStatusAction(true));
       String displayName = data.substring("token_ok".length);
       _store?.dispatch(SetDisplayNameAction(displayName));
+      // Register this device so the server can skip pushes while we're online
+      FirebaseMessaging.instance.getToken().then((fcmToken) {
+        if (fcmToken != null && fcmToken.isNotEmpty) {
+          send("fcmt$fcmToken");
+        }
+      }).catchError((error) {
+        debugPrint("Failed to get FCM token: $error");
+      });
       return;
     } else if (data == "token_fail") {
       debugPrint("Token error, attempting to refresh token...");
@@ -235,6 +310,58 @@ class SocketService with WidgetsBindingObserver {
             debugPrint("Error decoding JSON: $e");
           }
           return;
+        case 'chtd':
+          try {
+            final decoded = jsonDecode(content);
+            if (decoded is List) {
+              final changed = decoded
+                  .map(
+                      (item) => ChatTile.fromJson(item as Map<String, dynamic>))
+                  .toList();
+              final changedIds = changed.map((c) => c.chatId).toSet();
+              final chats = [
+                ...changed,
+                ...?_store?.state.chats
+                    .where((c) => !changedIds.contains(c.chatId)),
+              ];
+              _store?.dispatch(SetChatsAction(chats));
+            }
+          } catch (e) {
+            debugPrint("Error decoding chat delta JSON: $e");
+          }
+          return;
+        case 'stok':
+          _syncToken = content;
+          return;
+        case 'ping':
+          // Server keepalive, answering keeps an idle connection from being reaped
+          if (content == "ping") send("pingack");
+          return;
+        case 'msgd':
+          try {
+            final parts = content.split(',');
+            if (parts.length < 2) {
+              debugPrint("Invalid message delta format: $content");
+              return;
+            }
+            final chatId = parts[0];
+            final decoded = jsonDecode(parts.sublist(1).join(","));
+            if (decoded is List) {
+              for (final item in decoded) {
+                final message =
+                    ChatMessage.fromJson(item as Map<String, dynamic>);
+                if (message.type == 'assertion') {
+                  final assertion = message.message as Assertion;
+                  _store?.dispatch(SetAssertionAction(assertion.id, assertion));
+                  message.message = assertion.id;
+                }
+                _store?.dispatch(AddChatMessageAction(chatId, message));
+              }
+            }
+          } catch (e) {
+            debugPrint("Error decoding message delta JSON: $e");
+          }
+          return;
         case "tpcs":
           try {
             final decoded = jsonDecode(content);
@@ -371,6 +498,8 @@ class SocketService with WidgetsBindingObserver {
   void _handleDisconnect() {
     _socket?.destroy();
     _socket = null;
+    // Their replies were lost with the socket, and they may have been stored, so they stay shown
+    _pendingMessages.clear();
     _store?.dispatch(SetConnectionStatusAction(false));
     _connect();
   }
@@ -383,3 +512,12 @@ class SocketService with WidgetsBindingObserver {
     _aes = null;
   }
 }
+
+class _PendingMessage {
+  final String chatId;
+  final String text;
+  final ChatMessage shown;
+  final int attempt;
+
+  _PendingMessage(this.chatId, this.text, this.shown, this.attempt);
+}
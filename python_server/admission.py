@@ -0,0 +1,125 @@
+"""
+Admission control for the accept loop.
+
+Connections are refused before a thread is spawned when the server already holds
+MAX_CONNECTIONS or the peer's IP opens them faster than IP_CONNECT_RATE. RSA key generation
+and the session key decrypt are limited to MAX_HANDSHAKES at a time; connections beyond
+that wait up to HANDSHAKE_WAIT_S for a slot. Slots only cover that CPU work, a client gets
+HANDSHAKE_READ_TIMEOUT_S in total to answer the public key. Refused connections get a plaintext "busy" frame in place of the public key,
+so clients can back off instead of treating it as a network error.
+"""
+from rate_limit import TokenBuckets
+import contextlib
+import logs
+import metrics
+import os
+import socket
+import threading
+
+MAX_CONNECTIONS = int(os.environ.get("MAX_CONNECTIONS", 10000))
+MAX_HANDSHAKES = int(os.environ.get("MAX_HANDSHAKES", os.cpu_count() or 4))
+HANDSHAKE_WAIT = float(os.environ.get("HANDSHAKE_WAIT_S", 10))
+HANDSHAKE_READ_TIMEOUT = float(os.environ.get("HANDSHAKE_READ_TIMEOUT_S", 5))
+
+# Mobile carriers put many users behind one address, keep the per-IP limits generous
+IP_CONNECT_RATE = float(os.environ.get("IP_CONNECT_RATE", 20))
+IP_CONNECT_BURST = float(os.environ.get("IP_CONNECT_BURST", 100))
+
+LISTEN_BACKLOG = int(os.environ.get("LISTEN_BACKLOG", 1024))
+
+BUSY_FRAME = len(b"busy").to_bytes(4, 'big') + b"busy"
+
+log = logs.get("admission")
+
+_ip_buckets = TokenBuckets(IP_CONNECT_RATE, IP_CONNECT_BURST)
+_handshakes = threading.BoundedSemaphore(MAX_HANDSHAKES)
+
+_lock = threading.Lock()
+_connections = 0
+_handshakes_waiting = 0
+
+
+def admit(ip: str) -> str | None:
+    """
+    Count a new connection in, or return why it is refused.
+    Every admitted connection must be released().
+    """
+    global _connections
+    with _lock:
+        if _connections >= MAX_CONNECTIONS:
+            return "max_connections"
+        if not _ip_buckets.allow(ip):
+            return "ip_rate"
+        _connections += 1
+    return None
+
+
+def release():
+    global _connections
+    with _lock:
+        _connections -= 1
+
+
+def acquire_handshake() -> bool:
+    """
+    Wait for a key exchange slot, False if none freed up within HANDSHAKE_WAIT.
+    """
+    global _handshakes_waiting
+    if _handshakes.acquire(blocking=False):
+        return True
+    metrics.inc("handshakes_queued_total")
+    with _lock:
+        _handshakes_waiting += 1
+    try:
+        return _handshakes.acquire(timeout=HANDSHAKE_WAIT)
+    finally:
+        with _lock:
+            _handshakes_waiting -= 1
+
+
+def release_handshake():
+    _handshakes.release()
+
+
+class HandshakeBusy(Exception):
+    """
+    No key exchange slot freed up within HANDSHAKE_WAIT.
+    """
+
+
+@contextlib.contextmanager
+def handshake_slot():
+    """
+    Hold a key exchange slot for CPU-bound handshake work, never across network reads.
+    """
+    if not acquire_handshake():
+        raise HandshakeBusy()
+    try:
+        yield
+    finally:
+        release_handshake()
+
+
+def shed(conn: socket.socket, addr: tuple[str, int], reason: str):
+    """
+    Tell the client the server is busy and close the socket.
+    """
+    metrics.inc("connections_rejected_total", (("reason", reason),))
+    log.info("Connection refused", extra={
+             "peer": f"{addr[0]}:{addr[1]}", "reason": reason})
+    try:
+        conn.settimeout(0.5)
+        conn.sendall(BUSY_FRAME)
+    except OSError:
+        pass
+    finally:
+        conn.close()
+
+
+def _gauges() -> dict:
+    with _lock:
+        return {(("state", "admitted"),): _connections,
+                (("state", "handshake_waiting"),): _handshakes_waiting}
+
+
+metrics.gauge("admission_connections", _gauges)
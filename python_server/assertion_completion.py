@@ -1,24 +1,13 @@
-from db_utils import DbUtils
+from db_utils import DbTransaction
 from queries import GetChatMembersQuery
+from scoring import calculate_score
 import json
+import logs
 import math
 import datetime
 from typing import Any
 
-
-def calculate_score(confidence: float, forecast: bool, final_answer: bool) -> int:
-    """
-    Calculate score based on prediction accuracy.
-
-    Formula: ((0.5 - true_confidence) * multiplier * final_answer) + multiplier / 2
-    """
-    multiplier = 1000
-    true_confidence = (1 - confidence) if forecast else confidence
-
-    score = ((0.5 - true_confidence) * multiplier *
-             (1 if final_answer else -1)) + multiplier // 2
-
-    return int(score)
+log = logs.get("scheduler")
 
 
 def check_and_complete_assertion(assertion_data: dict[str, Any]) -> tuple[bool, bool]:
@@ -83,86 +72,101 @@ def check_and_complete_assertion(assertion_data: dict[str, Any]) -> tuple[bool,
         return complete_assertion(assertion_data["Id"], chat_id, final_answer)
 
     except Exception as e:
-        print(f"Error checking assertion completion: {e}")
+        log.error("Error checking assertion completion: %s", e)
         return (False, False)
 
 
 def complete_assertion(assertion_id: str, chat_id: str, final_answer: bool) -> tuple[bool, bool]:
     """
     Complete an assertion and update user stats.
+    The assertion is claimed with a conditional update in the same transaction as the
+    score update, so concurrent callers apply the scores exactly once.
     """
     try:
-        # Get predictions data
-        pred_row = DbUtils(
-            "SELECT Predictions FROM Assertions WHERE Id = %s",
-            (assertion_id,)
-        ).execute_single()
-
-        if not pred_row:
-            return (False, False)
-
-        pred_data: dict[str, Any] = dict(pred_row)  # type: ignore
-        predictions_json = pred_data.get("Predictions", "{}")
+        with DbTransaction() as tx:
+            claimed = tx.execute_update(
+                "UPDATE Assertions SET Completed = 1, FinalAnswer = %s WHERE Id = %s AND Completed = 0",
+                (1 if final_answer else 0, assertion_id)
+            )
+
+            if not claimed:
+                # Someone else completed it first, report their answer
+                row = tx.execute_single(
+                    "SELECT Completed, FinalAnswer FROM Assertions WHERE Id = %s",
+                    (assertion_id,)
+                )
+                if not row:
+                    return (False, False)
+                row_dict: dict[str, Any] = dict(row)  # type: ignore
+                return (bool(row_dict.get("Completed", 0)), bool(row_dict.get("FinalAnswer", 0)))
+
+            # Get predictions data
+            pred_row = tx.execute_single(
+                "SELECT Predictions FROM Assertions WHERE Id = %s",
+                (assertion_id,)
+            )
+
+            if not pred_row:
+                raise LookupError(f"Assertion {assertion_id} not found")
+
+            pred_data: dict[str, Any] = dict(pred_row)  # type: ignore
+            predictions_json = pred_data.get("Predictions", "{}")
+
+            if isinstance(predictions_json, str):
+                try:
+                    predictions = json.loads(predictions_json)
+                except:
+                    predictions = {}
+            else:
+                predictions = predictions_json or {}
+
+            # Lock the chat stats row so completions in the same chat don't lose updates
+            stats_row = tx.execute_single(
+                "SELECT ScoreSumPerUser, PredictionsPerUser FROM Chats WHERE Id = %s FOR UPDATE",
+                (chat_id,)
+            )
+
+            if not stats_row:
+                raise LookupError(f"Chat {chat_id} not found")
+
+            stats_data: dict[str, Any] = dict(stats_row)  # type: ignore
+
+            # Parse current stats
+            scores_json = stats_data.get("ScoreSumPerUser", "{}")
+            preds_json = stats_data.get("PredictionsPerUser", "{}")
 
-        if isinstance(predictions_json, str):
             try:
-                predictions = json.loads(predictions_json)
+                score_sums = json.loads(
+                    str(scores_json)) if scores_json else {}
+                pred_counts = json.loads(str(preds_json)) if preds_json else {}
             except:
-                predictions = {}
-        else:
-            predictions = predictions_json or {}
-
-        # Get current chat stats
-        stats_row = DbUtils(
-            "SELECT ScoreSumPerUser, PredictionsPerUser FROM Chats WHERE Id = %s",
-            (chat_id,)
-        ).execute_single()
-
-        if not stats_row:
-            return (False, False)
-
-        stats_data: dict[str, Any] = dict(stats_row)  # type: ignore
-
-        # Parse current stats
-        scores_json = stats_data.get("ScoreSumPerUser", "{}")
-        preds_json = stats_data.get("PredictionsPerUser", "{}")
-
-        try:
-            score_sums = json.loads(str(scores_json)) if scores_json else {}
-            pred_counts = json.loads(str(preds_json)) if preds_json else {}
-        except:
-            score_sums = {}
-            pred_counts = {}
-
-        # Update stats for each user who predicted
-        for user_id, prediction in predictions.items():
-            if isinstance(prediction, dict):
-                confidence = prediction.get("confidence", 0.5)
-                forecast = prediction.get("forecast", False)
+                score_sums = {}
+                pred_counts = {}
 
-                # Calculate score
-                score = calculate_score(confidence, forecast, final_answer)
+            # Update stats for each user who predicted
+            for user_id, prediction in predictions.items():
+                if isinstance(prediction, dict):
+                    confidence = prediction.get("confidence", 0.5)
+                    forecast = prediction.get("forecast", False)
 
-                # Update user stats
-                current_score = score_sums.get(user_id, 0)
-                current_preds = pred_counts.get(user_id, 0)
+                    # Calculate score
+                    score = calculate_score(confidence, forecast, final_answer)
 
-                score_sums[user_id] = current_score + score
-                pred_counts[user_id] = current_preds + 1
+                    # Update user stats
+                    current_score = score_sums.get(user_id, 0)
+                    current_preds = pred_counts.get(user_id, 0)
 
-        # Update database
-        success1 = DbUtils(
-            "UPDATE Chats SET ScoreSumPerUser = %s, PredictionsPerUser = %s WHERE Id = %s",
-            (json.dumps(score_sums), json.dumps(pred_counts), chat_id)
-        ).execute_update()
+                    score_sums[user_id] = current_score + score
+                    pred_counts[user_id] = current_preds + 1
 
-        success2 = DbUtils(
-            "UPDATE Assertions SET Completed = 1, FinalAnswer = %s WHERE Id = %s",
-            (1 if final_answer else 0, assertion_id)
-        ).execute_update()
+            # Update database
+            tx.execute_update(
+                "UPDATE Chats SET ScoreSumPerUser = %s, PredictionsPerUser = %s WHERE Id = %s",
+                (json.dumps(score_sums), json.dumps(pred_counts), chat_id)
+            )
 
-        return (success1 and success2, final_answer)
+        return (True, final_answer)
 
     except Exception as e:
-        print(f"Error completing assertion: {e}")
+        log.error("Error completing assertion: %s", e)
         return (False, False)
@@ -0,0 +1,139 @@
+from assertion_completion import check_and_complete_assertion
+from db_utils import DbUtils
+from queries import GetAssertionQuery, GetChatMembersQuery
+import event_framework
+import datetime
+import heapq
+import json
+import logs
+import threading
+import time
+from typing import Any
+
+log = logs.get("scheduler")
+
+# Min-heap of (validation timestamp, assertion_id) for assertions awaiting their deadline
+_deadlines: list[tuple[float, str]] = []
+
+# Assertions past their deadline that need their majority re-checked (e.g. a vote arrived)
+_rechecks: set[str] = set()
+
+# Guards both structures above and wakes the scheduler thread on changes
+_condition = threading.Condition()
+
+
+def _to_timestamp(validation_date: datetime.datetime) -> float:
+    if validation_date.tzinfo is None:
+        validation_date = validation_date.replace(tzinfo=datetime.timezone.utc)
+    return validation_date.timestamp()
+
+
+def schedule_assertion(assertion_id: str, validation_date: datetime.datetime):
+    """
+    Schedule an assertion to be checked for completion at its validation date.
+    """
+    with _condition:
+        heapq.heappush(_deadlines, (_to_timestamp(
+            validation_date), str(assertion_id)))
+        _condition.notify()
+
+
+def notify_vote(assertion_id: str):
+    """
+    Request a majority re-check for an assertion after a vote was cast.
+    """
+    with _condition:
+        _rechecks.add(str(assertion_id))
+        _condition.notify()
+
+
+def load_pending_assertions() -> int:
+    """
+    Load every incomplete assertion into the deadline heap.
+    Served by the (Completed, ValidationDate) index on Assertions.
+    """
+    rows = DbUtils(
+        "SELECT Id, ValidationDate FROM Assertions WHERE Completed = 0 ORDER BY ValidationDate"
+    ).execute()
+    if not rows:
+        return 0
+
+    with _condition:
+        for row in rows:
+            row_dict: dict[str, Any] = dict(row)  # type: ignore
+            validation_date = row_dict.get("ValidationDate")
+            if not validation_date:
+                continue
+            _deadlines.append(
+                (_to_timestamp(validation_date), str(row_dict["Id"])))
+        heapq.heapify(_deadlines)
+        _condition.notify()
+    return len(rows)
+
+
+def _complete_if_ready(assertion_id: str):
+    """
+    Try to complete an assertion and push the final state to the chat members.
+    """
+    row = DbUtils(
+        "SELECT Id, ChatId, Votes, ValidationDate, Completed FROM Assertions WHERE Id = %s",
+        (assertion_id,)
+    ).execute_single()
+    if not row:
+        return
+
+    assertion_dict: dict[str, Any] = dict(row)  # type: ignore
+    if bool(assertion_dict.get("Completed", 0)):
+        return
+
+    completed, _ = check_and_complete_assertion(assertion_dict)
+    if not completed:
+        # No majority yet, wait for the next vote
+        return
+
+    chat_id = str(assertion_dict.get("ChatId", ""))
+    assertion_data = GetAssertionQuery().execute(assertion_id, None)
+    if not assertion_data:
+        return
+
+    event_framework.emit_event({
+        "prefix": "assr",
+        "data": f"{json.dumps(assertion_data['content'])}".encode(),
+        "recipients": GetChatMembersQuery().execute(chat_id),
+        "chat_id": chat_id,
+        "coalesce_key": f"assr{assertion_id}",
+    })
+    log.info("Assertion %s completed by scheduler", assertion_id)
+
+
+def process_deadlines(load_pending: bool = True):
+    """
+    Background worker that completes assertions once their validation date passes.
+    With several server processes only one loads the pending assertions at startup.
+    """
+    if load_pending:
+        try:
+            count = load_pending_assertions()
+            log.info("Loaded %d pending assertions", count)
+        except Exception as e:
+            log.error("Error loading pending assertions: %s", e)
+
+    while True:
+        with _condition:
+            now = time.time()
+            due: list[str] = []
+            while _deadlines and _deadlines[0][0] <= now:
+                due.append(heapq.heappop(_deadlines)[1])
+            due.extend(_rechecks)
+            _rechecks.clear()
+
+            if not due:
+                timeout = _deadlines[0][0] - now if _deadlines else None
+                _condition.wait(timeout)
+                continue
+
+        for assertion_id in dict.fromkeys(due):
+            try:
+                _complete_if_ready(assertion_id)
+            except Exception as e:
+                log.error("Error completing assertion %s: %s", assertion_id, e)
@@ -0,0 +1,103 @@
+"""
+Benchmark chat lock lookup and contention with thousands of active chats.
+
+Compares the striped lock table against the previous unbounded dict registry
+guarded by a global lock. Run from python_server/:
+    python -m benchmarks.chat_locks [--chats 5000] [--threads 32] [--ops 20000]
+"""
+from locks import ReadWriteLock, StripedLockTable
+import argparse
+import random
+import threading
+import time
+
+
+class DictLockRegistry:
+    """
+    The original registry: one lock per chat id ever seen, created under a global lock.
+    """
+
+    def __init__(self):
+        self._locks: dict[str, ReadWriteLock] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._locks)
+
+    def get(self, key: str) -> ReadWriteLock:
+        with self._lock:
+            if key not in self._locks:
+                self._locks[key] = ReadWriteLock()
+            return self._locks[key]
+
+
+def run(table, chats: int, threads: int, ops: int, write_ratio: float, hold: float) -> tuple[float, float]:
+    """
+    Returns (operations per second, mean wait in microseconds).
+    """
+    waits: list[float] = []
+    waits_lock = threading.Lock()
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(seed: int):
+        rng = random.Random(seed)
+        local_waits = []
+        barrier.wait()
+        for _ in range(ops):
+            chat_id = str(rng.randrange(chats))
+            start = time.perf_counter()
+            lock = table.get(chat_id)
+            if rng.random() < write_ratio:
+                lock.acquire_write()
+                local_waits.append(time.perf_counter() - start)
+                if hold:
+                    time.sleep(hold)
+                lock.release_write()
+            else:
+                lock.acquire_read()
+                local_waits.append(time.perf_counter() - start)
+                if hold:
+                    time.sleep(hold)
+                lock.release_read()
+        with waits_lock:
+            waits.extend(local_waits)
+
+    workers = [threading.Thread(target=worker, args=(i,))
+               for i in range(threads)]
+    for t in workers:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return threads * ops / elapsed, sum(waits) / len(waits) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare chat lock table implementations.")
+    parser.add_argument("--chats", type=int, default=5000)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--ops", type=int, default=20000,
+                        help="lock acquisitions per thread")
+    parser.add_argument("--write-ratio", type=float, default=0.2)
+    parser.add_argument("--hold-us", type=float, default=0,
+                        help="time each lock is held, in microseconds")
+    args = parser.parse_args()
+
+    tables = [("dict registry", DictLockRegistry())]
+    tables += [(f"striped x{n}", StripedLockTable(n))
+               for n in (64, 1024, 4096)]
+
+    print(f"{args.chats} chats, {args.threads} threads, {args.ops} ops/thread, "
+          f"{args.write_ratio:.0%} writes, {args.hold_us}us hold")
+    for label, table in tables:
+        throughput, mean_wait = run(table, args.chats, args.threads, args.ops,
+                                    args.write_ratio, args.hold_us / 1e6)
+        print(f"{label:<15} {throughput:>12,.0f} ops/s  mean wait {mean_wait:8.1f}us  "
+              f"locks held {len(table)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Benchmark chat message appends with and without the group commit log.
+
+Needs the database configured for the server and an existing chat to append to
+(the messages are left in it). With --offline it runs against a freshly seeded
+SQLite file instead. Run from python_server/:
+    python -m benchmarks.group_commit --chat <chat id> [--threads 16] [--messages 200]
+    python -m benchmarks.group_commit --offline [--history 1000]
+"""
+import os
+import sys
+import tempfile
+
+OFFLINE_DB = os.path.join(tempfile.gettempdir(), "predictrix-group-commit.sqlite3")
+
+# The backend is chosen when the server modules load
+if "--offline" in sys.argv:
+    os.environ["OFFLINE"] = "1"
+    os.environ["OFFLINE_DB"] = OFFLINE_DB
+
+import message_log
+import offline
+import argparse
+import datetime
+import threading
+import time
+
+
+def run(chat_id: str, threads: int, messages: int, sender: str) -> tuple[float, float]:
+    """
+    Returns (acked messages per second, seconds until every message was in the DB).
+    """
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(index: int):
+        barrier.wait()
+        for i in range(messages):
+            message_log.append(chat_id, {
+                "sender": sender,
+                "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "content": f"benchmark {index}/{i}",
+            })
+
+    workers = [threading.Thread(target=worker, args=(i,))
+               for i in range(threads)]
+    for t in workers:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in workers:
+        t.join()
+    acked = time.perf_counter() - start
+    message_log.flush_all()
+    durable = time.perf_counter() - start
+    return threads * messages / acked, durable
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare direct and group committed message appends.")
+    parser.add_argument("--chat", default="")
+    parser.add_argument("--offline", action="store_true",
+                        help="append to a chat seeded in a fresh SQLite database")
+    parser.add_argument("--history", type=int, default=1000,
+                        help="messages already in the seeded chat with --offline")
+    parser.add_argument("--sender", default="benchmark")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--messages", type=int, default=200,
+                        help="messages appended per thread")
+    args = parser.parse_args()
+    if args.offline:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(OFFLINE_DB + suffix):
+                os.unlink(OFFLINE_DB + suffix)
+        layout = offline.seed(OFFLINE_DB, 1, 2, args.history)
+        args.chat = next(iter(layout))
+    elif not args.chat:
+        parser.error("--chat is required without --offline")
+
+    flusher = threading.Thread(
+        target=message_log.process_flushes, daemon=True)
+    flusher.start()
+
+    print(f"{args.threads} threads, {args.messages} messages/thread, "
+          f"flush every {message_log.FLUSH_INTERVAL * 1000:g}ms or "
+          f"{message_log.FLUSH_MAX_MESSAGES} messages")
+    for label, enabled in (("direct", False), ("group commit", True)):
+        message_log.GROUP_COMMIT = enabled
+        throughput, durable = run(
+            args.chat, args.threads, args.messages, args.sender)
+        stats = message_log.stats()
+        batch = stats["flushed"] / stats["flushes"] if stats["flushes"] else 1
+        print(f"{label:<13} {throughput:>10,.0f} msgs/s acked  "
+              f"all durable after {durable:6.2f}s  avg batch {batch:5.1f}")
+
+
+if __name__ == "__main__":
+    main()
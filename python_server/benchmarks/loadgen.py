@@ -0,0 +1,374 @@
+"""
+End-to-end load generator that speaks the client protocol.
+
+Each simulated client does the same handshake as the app (RSA public key, OAEP
+session key, nonce, then AES-GCM frames), logs in with "user" and then sends a
+weighted mix of commands. Every command is tagged with a "#<id>:" request id so
+its reply can be matched, and chat messages carry a send timestamp so the
+"newm" events other members receive give the fan-out delay.
+
+By default it seeds a fresh offline database and starts the server against it
+with OFFLINE=1, so neither MariaDB nor Firebase is needed. Run from python_server/:
+    python -m benchmarks.loadgen [--clients 50] [--chat-size 5] [--duration 30]
+        [--mix sndm=40,msgs=25,chts=10,user=5,assr=5,pred=10,vote=5]
+
+With --connect HOST:PORT it targets a server that is already running with
+OFFLINE=1 and OFFLINE_DB set to the --db path, which is seeded first.
+"""
+from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.PublicKey import RSA
+from Crypto.Random import get_random_bytes
+import offline
+import argparse
+import datetime
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+COMMANDS = ("user", "chts", "msgs", "sndm", "assr", "pred", "vote")
+
+DEFAULT_MIX = "sndm=40,msgs=25,chts=10,user=5,assr=5,pred=10,vote=5"
+
+# Reply prefix that ends each command's response, "user" and "chts" finish with the sync token
+TERMINAL_PREFIX = {"user": "stok", "chts": "stok"}
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+class Results:
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = {cmd: [] for cmd in COMMANDS}
+        self.timeouts: dict[str, int] = {cmd: 0 for cmd in COMMANDS}
+        self.fanout: list[float] = []
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def record(self, cmd: str, latency: float | None):
+        with self._lock:
+            if latency is None:
+                self.timeouts[cmd] += 1
+            else:
+                self.latencies[cmd].append(latency)
+
+    def record_fanout(self, delay: float):
+        with self._lock:
+            self.fanout.append(delay)
+
+    def record_error(self):
+        with self._lock:
+            self.errors += 1
+
+
+class Client:
+    """
+    One protocol connection with a reader thread that matches tagged replies to requests.
+    """
+
+    def __init__(self, index: int, host: str, port: int, results: Results, timeout: float):
+        self.index = index
+        self.results = results
+        self.timeout = timeout
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.session_key = b""
+        self._ids = itertools.count()
+        self._waiting: dict[str, tuple[str, threading.Event, list]] = {}
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self.closed = False
+
+    def _recv_exact(self, size: int) -> bytes:
+        data = b""
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("Server closed the connection")
+            data += chunk
+        return data
+
+    def _recv_frame(self) -> bytes:
+        return self._recv_exact(int.from_bytes(self._recv_exact(4), 'big'))
+
+    def handshake(self):
+        frame = self._recv_frame()
+        if frame == b"busy":
+            raise ConnectionRefusedError("Server is shedding load")
+        public_key = RSA.import_key(frame)
+        self.session_key = get_random_bytes(32)
+        encrypted = PKCS1_OAEP.new(public_key).encrypt(self.session_key)
+        self.sock.sendall(len(encrypted).to_bytes(4, 'big') + encrypted)
+        # The server's nonce is unused, every frame carries its own
+        self._recv_frame()
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def send(self, text: str):
+        cipher = AES.new(self.session_key, AES.MODE_GCM)
+        ciphertext, tag = cipher.encrypt_and_digest(text.encode())
+        data = cipher.nonce + ciphertext + tag
+        with self._send_lock:
+            self.sock.sendall(len(data).to_bytes(4, 'big') + data)
+
+    def request(self, cmd: str, payload: str) -> tuple[float | None, bytes]:
+        """
+        Send a tagged command and wait for its final reply. Returns (latency or None on timeout, reply body).
+        """
+        request_id = str(next(self._ids))
+        done = threading.Event()
+        reply: list = []
+        with self._lock:
+            self._waiting[request_id] = (
+                TERMINAL_PREFIX.get(cmd, cmd), done, reply)
+        start = time.perf_counter()
+        self.send(f"#{request_id}:{cmd}{payload}")
+        if not done.wait(self.timeout):
+            with self._lock:
+                self._waiting.pop(request_id, None)
+            return None, b""
+        return time.perf_counter() - start, reply[0]
+
+    def _read(self):
+        try:
+            while True:
+                payload = self._recv_frame()
+                nonce, ciphertext, tag = payload[:16], payload[16:-16], payload[-16:]
+                frame = AES.new(self.session_key, AES.MODE_GCM,
+                                nonce=nonce).decrypt_and_verify(ciphertext, tag)
+                received = time.perf_counter()
+                if frame.startswith(b"#"):
+                    self._reply(frame)
+                elif frame.startswith(b"newm"):
+                    self._event(frame[4:], received)
+        except Exception:
+            if not self.closed:
+                self.results.record_error()
+            with self._lock:
+                for _, done, _ in self._waiting.values():
+                    done.set()
+
+    def _reply(self, frame: bytes):
+        header, _, rest = frame[1:].partition(b":")
+        request_id = header.decode()
+        with self._lock:
+            waiting = self._waiting.get(request_id)
+            if not waiting:
+                return
+            terminal, done, reply = waiting
+            # token_fail and unknown commands reply with an empty prefix, throttling under the command's
+            if not rest.startswith(terminal.encode()) and rest not in (b"token_fail", b"what") \
+                    and rest[4:] != b"throttled":
+                return
+            del self._waiting[request_id]
+        reply.append(rest)
+        done.set()
+
+    def _event(self, data: bytes, received: float):
+        _, _, body = data.partition(b",")
+        try:
+            content = json.loads(body).get("content", "")
+        except Exception:
+            return
+        # Messages sent by the load generator are "lg:<client>:<perf_counter at send>"
+        parts = str(content).split(":")
+        if len(parts) == 3 and parts[0] == "lg":
+            self.results.record_fanout(received - float(parts[2]))
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+def parse_mix(spec: str) -> tuple[list[str], list[float]]:
+    commands, weights = [], []
+    for item in spec.split(","):
+        cmd, _, weight = item.partition("=")
+        if cmd not in COMMANDS:
+            raise ValueError(f"Unknown command in mix: {cmd}")
+        commands.append(cmd)
+        weights.append(float(weight or 1))
+    return commands, weights
+
+
+def iso_z(value: datetime.datetime) -> str:
+    return value.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def run_client(client: Client, uid: str, chat_id: str, seeded: list, created: list,
+               mix: tuple[list[str], list[float]], deadline: float, think: float, seed: int):
+    rng = random.Random(seed)
+    commands, weights = mix
+    token = offline.token_for(uid)
+    latency, reply = client.request("user", token)
+    client.results.record("user", latency)
+    if latency is None or reply == b"token_fail":
+        client.results.record_error()
+        return
+
+    while time.time() < deadline and not client.closed:
+        cmd = rng.choices(commands, weights)[0]
+        if cmd == "user":
+            payload = token
+        elif cmd == "chts":
+            payload = ""
+        elif cmd == "msgs":
+            payload = chat_id
+        elif cmd == "sndm":
+            payload = f"{chat_id} lg:{client.index}:{time.perf_counter()!r}"
+        elif cmd == "assr":
+            now = datetime.datetime.now(datetime.timezone.utc)
+            payload = (f"{chat_id},{iso_z(now + datetime.timedelta(days=2))},"
+                       f"{iso_z(now + datetime.timedelta(days=1))},Load test {client.index}")
+        elif cmd == "pred":
+            # Open assertions created during the run, or a seeded one (past its casting deadline)
+            pool = created or seeded
+            if not pool:
+                continue
+            payload = f"{rng.choice(pool)},{rng.randint(50, 100) / 100},{rng.choice(['true', 'false'])}"
+        else:
+            if not seeded:
+                continue
+            payload = f"{rng.choice(seeded)},{rng.choice(['true', 'false'])}"
+
+        latency, reply = client.request(cmd, payload)
+        client.results.record(cmd, latency)
+        if cmd == "assr" and reply.startswith(b"assrcreated:"):
+            created.append(reply[len(b"assrcreated:"):].decode())
+        if think:
+            time.sleep(rng.expovariate(1 / think))
+
+
+def start_server(db_path: str, port: int) -> subprocess.Popen:
+    env = {**os.environ, "OFFLINE": "1",
+           "OFFLINE_DB": db_path, "PORT": str(port)}
+    # Measure the server, not its per-user rate limits
+    env.setdefault("RATE_LIMITS", "off")
+    server = subprocess.Popen([sys.executable, "main.py"], env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                raise RuntimeError("Server exited during startup")
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("Server did not start listening")
+
+
+def report(results: Results, elapsed: float, clients: int):
+    total = sum(len(v) for v in results.latencies.values())
+    print(f"\n{clients} clients, {elapsed:.1f}s, {total / elapsed:,.0f} req/s, "
+          f"{results.errors} connection errors")
+    print(f"{'cmd':<6}{'count':>8}{'timeouts':>10}{'req/s':>9}{'p50 ms':>9}{'p99 ms':>9}")
+    for cmd in COMMANDS:
+        latencies = results.latencies[cmd]
+        if not latencies and not results.timeouts[cmd]:
+            continue
+        print(f"{cmd:<6}{len(latencies):>8}{results.timeouts[cmd]:>10}"
+              f"{len(latencies) / elapsed:>9.1f}"
+              f"{percentile(latencies, 50) * 1000:>9.2f}{percentile(latencies, 99) * 1000:>9.2f}")
+    if results.fanout:
+        print(f"fan-out {len(results.fanout)} events delivered, "
+              f"p50 {percentile(results.fanout, 50) * 1000:.2f}ms, "
+              f"p99 {percentile(results.fanout, 99) * 1000:.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Drive the server with simulated clients over the real protocol.")
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--chat-size", type=int, default=5,
+                        help="members per chat, clients are split into chats of this size")
+    parser.add_argument("--messages", type=int, default=200,
+                        help="messages seeded per chat")
+    parser.add_argument("--assertions", type=int, default=20,
+                        help="assertions open for voting seeded per chat")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help="weighted command mix, e.g. sndm=40,msgs=25")
+    parser.add_argument("--think-ms", type=float, default=0,
+                        help="mean pause between a client's commands")
+    parser.add_argument("--timeout", type=float, default=10)
+    parser.add_argument("--db", default=os.path.join(
+        tempfile.gettempdir(), "predictrix-loadgen.sqlite3"))
+    parser.add_argument("--port", type=int, default=32790,
+                        help="port for the spawned server")
+    parser.add_argument("--connect", default="",
+                        help="HOST:PORT of a running offline server instead of spawning one")
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(args.db + suffix):
+            os.unlink(args.db + suffix)
+    chats = -(-args.clients // args.chat_size)
+    layout = offline.seed(args.db, chats, args.chat_size,
+                          args.messages, args.assertions, uid_prefix="lg")
+    print(f"Seeded {chats} chats of {args.chat_size} members in {args.db}")
+
+    server = None
+    if args.connect:
+        host, _, port = args.connect.rpartition(":")
+        target = (host, int(port))
+    else:
+        server = start_server(args.db, args.port)
+        target = ("127.0.0.1", args.port)
+
+    results = Results()
+    members = [(chat_id, uid) for chat_id, chat in layout.items()
+               for uid in chat["members"]][:args.clients]
+    created: dict[str, list] = {chat_id: [] for chat_id in layout}
+    clients: list[Client] = []
+    connected: list[tuple[str, str]] = []
+    try:
+        for i, member in enumerate(members):
+            client = Client(i, *target, results, args.timeout)
+            try:
+                client.handshake()
+            except ConnectionRefusedError:
+                # Shed by admission control, counted as a connection error
+                results.record_error()
+                client.close()
+                continue
+            clients.append(client)
+            connected.append(member)
+        print(f"Connected {len(clients)} clients")
+
+        start = time.time()
+        threads = [threading.Thread(target=run_client, args=(
+            client, uid, chat_id, layout[chat_id]["assertions"], created[chat_id],
+            mix, start + args.duration, args.think_ms / 1000, i))
+            for i, (client, (chat_id, uid)) in enumerate(zip(clients, connected))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+    finally:
+        for client in clients:
+            client.close()
+        if server:
+            server.terminate()
+            server.wait()
+
+    report(results, elapsed, len(clients))
+
+
+if __name__ == "__main__":
+    main()
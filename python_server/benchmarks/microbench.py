@@ -0,0 +1,312 @@
+"""
+Microbenchmarks for every Query, Command and Controller.handle, run offline.
+
+The server modules are loaded with OFFLINE=1 against an in-memory SQLite
+database, seeded with synthetic chats of 10/1k/100k messages and 2/50/5000
+members. Each case reports the median time per call. Results can be saved and
+compared with an earlier run to catch regressions in hot paths.
+Run from python_server/:
+    python -m benchmarks.microbench [--quick] [--filter msgs] [--save out.json] [--compare base.json]
+"""
+import os
+
+os.environ["OFFLINE"] = "1"
+os.environ["OFFLINE_DB"] = ":memory:"
+os.environ.setdefault("CJTK_SECRET", "microbench")
+# Server logging goes through a writer thread that would compete with the timed calls
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+
+from commands import CreateUserCommand, AppendChatMessageCommand, AppendChatMessagesCommand
+from commands import JoinChatCommand, CreateChatCommand, CreateAssertionCommand
+from commands import AddPredictionCommand, AddVoteCommand
+from queries import GetChatsQuery, GetUserProfileQuery, GetChatMembersQuery, GetChatsMembersQuery
+from queries import GetUserProfilesQuery, GetChatMessagesQuery, GetChatStatsQuery, GetAssertionQuery
+from queries import GetAssertionVersionsQuery
+from cqrs import Command, Query
+from db_utils import DbUtils
+from controllers import Controller, generate_chat_join_token_hash
+import event_framework
+import offline
+from queue import Empty
+import argparse
+import base64
+import datetime
+import itertools
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from typing import Callable
+
+# (messages, members) per dataset, every chat also gets a few votable assertions
+DATASETS = [(10, 50), (1000, 50), (100000, 50), (1000, 2), (1000, 5000)]
+QUICK_DATASETS = [(10, 50), (1000, 50), (1000, 2)]
+ASSERTIONS = 5
+
+# Fresh users and open assertions per dataset for the join and prediction cases
+POOL_SIZE = 512
+
+# Admin diagnostics, not request paths ("prof" starts a profiling thread)
+ADMIN_COMMANDS = {"stat", "prof"}
+
+
+class Dataset:
+    def __init__(self, messages: int, members: int, chat_id: str, chat: dict[str, list]):
+        self.name = f"{messages}msg/{members}mem"
+        self.chat_id = chat_id
+        self.members: list[str] = chat["members"]
+        self.assertions: list[int] = chat["assertions"]
+        self.uid = self.members[0]
+        # Joins and predictions only succeed once per user and assertion,
+        # so those cases draw fresh users and still-open assertions from a pool
+        now = datetime.datetime.now(datetime.timezone.utc)
+        joiners = [f"{self.uid}-joiner{i}" for i in range(POOL_SIZE)]
+        DbUtils("INSERT INTO Users (UserId, DisplayName, Email, PhotoUrl, Chats) VALUES (%s, %s, %s, %s, '[]')").execute_many(
+            [(uid, uid, "", "") for uid in joiners])
+        self._joiners = iter(joiners)
+        self._open_assertions = iter([CreateAssertionCommand().execute(
+            self.uid, chat_id, f"Open assertion {i}",
+            (now + datetime.timedelta(days=2)).strftime("%Y-%m-%dT%H:%M:%S"),
+            (now + datetime.timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%S"))
+            for i in range(POOL_SIZE)])
+        self._last_open_assertion = ""
+
+    def next_joiner(self) -> str:
+        # Once the pool is used up the cases measure the already-member path
+        return next(self._joiners, self.uid)
+
+    def next_open_assertion(self) -> str:
+        self._last_open_assertion = next(
+            self._open_assertions, self._last_open_assertion)
+        return self._last_open_assertion
+
+
+class BenchConnection:
+    """
+    Connection stand-in for controllers, counts the replies instead of sending them.
+    """
+
+    def __init__(self, uid: str):
+        self.uid = uid
+        self.addr = ("microbench", 0)
+        self.event_seq = False
+        self.frames = 0
+        self.bytes = 0
+
+    def send(self, prefix: str, content: bytes):
+        self.frames += 1
+        self.bytes += len(prefix) + len(content)
+
+    def set_uid(self, uid: str):
+        self.uid = uid
+
+    def enable_event_seq(self):
+        self.event_seq = True
+
+
+def _counter() -> Callable[[], int]:
+    return itertools.count().__next__
+
+
+def iso_z(value: datetime.datetime) -> str:
+    return value.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def message(uid: str) -> dict:
+    return {
+        "sender": uid,
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "content": "microbench message",
+    }
+
+
+def query_cases(ds: Dataset) -> dict[type, Callable[[], object]]:
+    return {
+        GetChatsQuery: lambda: GetChatsQuery().execute(ds.uid),
+        GetUserProfileQuery: lambda: GetUserProfileQuery().execute(ds.uid),
+        GetChatMembersQuery: lambda: GetChatMembersQuery().execute(ds.chat_id),
+        GetChatsMembersQuery: lambda: GetChatsMembersQuery().execute([ds.chat_id]),
+        GetUserProfilesQuery: lambda: GetUserProfilesQuery().execute(ds.members),
+        GetChatMessagesQuery: lambda: GetChatMessagesQuery().execute(ds.chat_id),
+        GetChatStatsQuery: lambda: GetChatStatsQuery().execute(ds.chat_id),
+        GetAssertionQuery: lambda: GetAssertionQuery().execute(str(ds.assertions[0]), ds.uid),
+        GetAssertionVersionsQuery: lambda: GetAssertionVersionsQuery().execute([ds.chat_id]),
+    }
+
+
+def command_cases(ds: Dataset) -> dict[type, Callable[[], object]]:
+    n = _counter()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    validation = (now + datetime.timedelta(days=2)).strftime("%Y-%m-%dT%H:%M:%S")
+    casting = (now + datetime.timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%S")
+    return {
+        CreateUserCommand: lambda: CreateUserCommand().execute(offline.token_for(ds.uid)),
+        AppendChatMessageCommand: lambda: AppendChatMessageCommand().execute(ds.chat_id, message(ds.uid)),
+        AppendChatMessagesCommand: lambda: AppendChatMessagesCommand().execute(
+            ds.chat_id, [message(ds.uid) for _ in range(10)]),
+        JoinChatCommand: lambda: JoinChatCommand().execute(ds.chat_id, ds.next_joiner()),
+        CreateChatCommand: lambda: CreateChatCommand().execute(f"{ds.name} chat {n()}", ds.uid),
+        CreateAssertionCommand: lambda: CreateAssertionCommand().execute(
+            ds.uid, ds.chat_id, f"Assertion {n()}", validation, casting),
+        AddPredictionCommand: lambda: AddPredictionCommand().execute(
+            ds.next_open_assertion(), ds.uid, 0.7, True),
+        AddVoteCommand: lambda: AddVoteCommand().execute(str(ds.assertions[2]), ds.uid, True),
+    }
+
+
+def controller_cases(ds: Dataset, handlers: dict[str, Controller]) -> dict[str, Callable[[], object]]:
+    n = _counter()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    join_hash = generate_chat_join_token_hash(ds.chat_id)
+    join_token = f"{join_hash}.{base64.b64encode(ds.chat_id.encode()).decode()}"
+    # Connection uid per controller, the chat member unless listed
+    uids: dict[str, Callable[[], str]] = {"join": ds.next_joiner}
+    payloads: dict[str, Callable[[], str]] = {
+        "ping": lambda: "",
+        "chts": lambda: "",
+        "msgs": lambda: ds.chat_id,
+        "memb": lambda: ds.chat_id,
+        "sndm": lambda: f"{ds.chat_id} microbench message",
+        "user": lambda: offline.token_for(ds.uid),
+        "fcmt": lambda: "microbench-device-token",
+        "cjtk": lambda: ds.chat_id,
+        "join": lambda: join_token,
+        "crtc": lambda: f"{ds.name} chat {n()}",
+        "assr": lambda: (f"{ds.chat_id},{iso_z(now + datetime.timedelta(days=2))},"
+                         f"{iso_z(now + datetime.timedelta(days=1))},Assertion {n()}"),
+        "pred": lambda: f"{ds.next_open_assertion()},0.7,true",
+        "vote": lambda: f"{ds.assertions[4]},true",
+        "resm": lambda: f"{ds.chat_id},0,{event_framework.epoch}",
+        "batc": lambda: json.dumps(["chts", f"msgs{ds.chat_id}", f"memb{ds.chat_id}"]),
+    }
+    cases = {}
+    for name, handler in handlers.items():
+        if name in payloads:
+            payload = payloads[name]
+            uid = uids.get(name, lambda: ds.uid)
+            cases[name] = (lambda h=handler, p=payload, u=uid:
+                           h.handle(BenchConnection(u()), p()))  # type: ignore
+    return cases
+
+
+def drain_events():
+    # No dispatcher runs here, drop what the commands emitted
+    while True:
+        try:
+            event_framework.event_queue.get_nowait()
+            event_framework.event_queue.task_done()
+        except Empty:
+            return
+
+
+def measure(fn: Callable[[], object], budget: float, max_calls: int) -> tuple[float, int]:
+    """
+    Median seconds per call over rounds of calls, after one warm-up call.
+    """
+    fn()
+    rounds: list[float] = []
+    calls = 0
+    deadline = time.perf_counter() + budget
+    while calls < max_calls and (len(rounds) < 3 or time.perf_counter() < deadline):
+        start = time.perf_counter()
+        fn()
+        rounds.append(time.perf_counter() - start)
+        calls += 1
+    drain_events()
+    return statistics.median(rounds), calls
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Offline microbenchmarks for queries, commands and controllers.")
+    parser.add_argument("--quick", action="store_true",
+                        help="skip the 100k message and 5000 member datasets")
+    parser.add_argument("--filter", default="",
+                        help="only run cases whose name contains this")
+    parser.add_argument("--budget", type=float, default=0.5,
+                        help="seconds spent per case")
+    parser.add_argument("--max-calls", type=int, default=200)
+    parser.add_argument("--save", default="", help="write results as JSON")
+    parser.add_argument("--compare", default="",
+                        help="earlier --save output to compare against")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="slowdown ratio reported as a regression")
+    args = parser.parse_args()
+
+    datasets: list[Dataset] = []
+    sizes = QUICK_DATASETS if args.quick else DATASETS
+    for i, (messages, members) in enumerate(sizes):
+        layout = offline.seed(offline.MEMORY, 1, members, messages,
+                              ASSERTIONS, uid_prefix=f"d{i}u")
+        chat_id, chat = next(iter(layout.items()))
+        datasets.append(Dataset(messages, members, chat_id, chat))
+    print(f"Seeded {len(datasets)} datasets: {', '.join(ds.name for ds in datasets)}")
+
+    handlers = {inst.name(): inst for cls in Controller.__subclasses__()
+                for inst in [cls()] if inst.name() not in ADMIN_COMMANDS}
+    cases: list[tuple[str, Callable[[], object]]] = []
+    for ds in datasets:
+        cases += [(f"query:{cls.__name__}[{ds.name}]", fn)
+                  for cls, fn in query_cases(ds).items()]
+        cases += [(f"command:{cls.__name__}[{ds.name}]", fn)
+                  for cls, fn in command_cases(ds).items()]
+        cases += [(f"controller:{name}[{ds.name}]", fn)
+                  for name, fn in controller_cases(ds, handlers).items()]
+
+    # New classes need a case here, list the ones without
+    covered = set(query_cases(datasets[0])) | set(command_cases(datasets[0]))
+    missing = [cls.__name__ for cls in Query.__subclasses__() + Command.__subclasses__()
+               if cls not in covered]
+    missing += [name for name in handlers
+                if name not in controller_cases(datasets[0], handlers)]
+    if missing:
+        print(f"No benchmark case for: {', '.join(missing)}")
+
+    baseline: dict[str, float] = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+
+    results: dict[str, float] = {}
+    regressions = 0
+    for name, fn in cases:
+        if args.filter and args.filter not in name:
+            continue
+        seconds, calls = measure(fn, args.budget, args.max_calls)
+        results[name] = seconds
+        line = f"{name:<60} {seconds * 1e6:>12,.1f}us  ({calls} calls)"
+        if name in baseline and baseline[name] > 0:
+            ratio = seconds / baseline[name]
+            flag = "  REGRESSION" if ratio > args.threshold else ""
+            regressions += bool(flag)
+            line += f"  x{ratio:.2f}{flag}"
+        print(line)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({
+                "revision": git_revision(),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "results": results,
+            }, f, indent=2)
+        print(f"Saved {len(results)} results to {args.save}")
+
+    if regressions:
+        print(f"{regressions} cases slower than x{args.threshold} of the baseline")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
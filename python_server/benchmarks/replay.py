@@ -0,0 +1,301 @@
+"""
+Replay a traffic trace recorded with TRAFFIC_TRACE against a test server.
+
+Every recorded connection is reopened at its original offset and sends its
+commands on the original schedule, scaled by --speed (1 for real time, 10 for
+ten times faster, 0 for as fast as possible, each connection still waiting for
+its previous reply). Before the run, a fresh offline database is seeded with the
+users, chats and assertions the trace refers to, and an offline server is started
+on it unless --connect is given. Assertion dates are shifted so deadlines that
+were in the future when recorded still are.
+
+The report compares the replayed round-trip latency of each command with the
+recorded server-side time (frame arrival to handler return).
+Run from python_server/:
+    python -m benchmarks.replay trace.bin [trace.bin.1234 ...] [--speed 10]
+"""
+from benchmarks.loadgen import Client, Results, percentile, start_server
+import offline
+import traffic_trace
+import argparse
+import base64
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+# Commands whose payload starts with a chat id ("sndm" separates it with a space)
+CHAT_COMMANDS = {"msgs", "memb", "cjtk", "sndm", "assr", "resm", "join"}
+
+REPLAY_SECRET = "replay"
+
+
+class Connection:
+    def __init__(self, opened: float):
+        self.opened = opened
+        self.closed: float | None = None
+        # (time, command, uid, payload, recorded duration)
+        self.commands: list[tuple[float, str, str, str, float]] = []
+
+
+def load(paths: list[str]) -> tuple[list[Connection], float]:
+    """
+    Group the records of every trace file by connection. Returns the connections and the trace start time.
+    """
+    connections: dict[tuple[int, int], Connection] = {}
+    for index, path in enumerate(paths):
+        for at, connection_id, kind, cmd, duration, uid, payload in traffic_trace.read(path):
+            key = (index, connection_id)
+            if kind == traffic_trace.OPEN:
+                connections[key] = Connection(at)
+                continue
+            connection = connections.setdefault(key, Connection(at))
+            if kind == traffic_trace.COMMAND:
+                connection.commands.append((at, cmd, uid, payload, duration))
+            else:
+                connection.closed = at
+    for connection in connections.values():
+        connection.commands.sort()
+    start = min((c.opened for c in connections.values()), default=0.0)
+    return sorted(connections.values(), key=lambda c: c.opened), start
+
+
+def expand(cmd: str, payload: str) -> list[tuple[str, str]]:
+    if cmd == "batc":
+        try:
+            return [(c[:4].lower(), c[4:]) for c in json.loads(payload)]
+        except ValueError:
+            return []
+    return [(cmd, payload)]
+
+
+def chat_of(cmd: str, payload: str) -> str:
+    if cmd == "sndm":
+        return payload.strip().split(" ", 1)[0]
+    return payload.strip().split(",", 1)[0]
+
+
+def seed_from_trace(path: str, connections: list[Connection]):
+    """
+    Create the users, chats and assertions the trace refers to.
+    A user is a member of every chat they used, unless their first use was joining it.
+    """
+    members: dict[str, list[str]] = {}
+    joined: set[tuple[str, str]] = set()
+    users: set[str] = set()
+    open_assertions: dict[str, str] = {}
+    voted_assertions: dict[str, str] = {}
+
+    for connection in connections:
+        for _, top_cmd, uid, top_payload, _ in connection.commands:
+            if uid:
+                users.add(uid)
+            for cmd, payload in expand(top_cmd, top_payload):
+                if cmd in CHAT_COMMANDS and uid:
+                    chat_id = chat_of(cmd, payload)
+                    if not chat_id.isdigit():
+                        continue
+                    chat = members.setdefault(chat_id, [])
+                    if cmd == "join" and uid not in chat:
+                        joined.add((chat_id, uid))
+                    elif uid not in chat and (chat_id, uid) not in joined:
+                        chat.append(uid)
+                elif cmd in ("pred", "vote") and uid:
+                    assertion_id = payload.split(",", 1)[0]
+                    if assertion_id.isdigit():
+                        target = open_assertions if cmd == "pred" else voted_assertions
+                        target.setdefault(assertion_id, uid)
+
+    connection = offline.connect(path)
+    db = connection.db
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    user_chats: dict[str, list[int]] = {uid: [] for uid in users}
+    db.execute("BEGIN")
+    for chat_id, uids in members.items():
+        db.execute(
+            "INSERT INTO Chats (Id, Name, Members, ScoreSumPerUser, PredictionsPerUser) VALUES (?, ?, ?, ?, ?)",
+            (int(chat_id), f"Chat {chat_id}", json.dumps(uids),
+             json.dumps({uid: 0 for uid in uids}), json.dumps({uid: 0 for uid in uids})))
+        for uid in uids:
+            user_chats[uid].append(int(chat_id))
+    db.executemany(
+        "INSERT INTO Users (UserId, DisplayName, Chats) VALUES (?, ?, ?)",
+        [(uid, f"User {uid[:6]}", json.dumps(chats)) for uid, chats in user_chats.items()])
+
+    for assertions, casting, validation in (
+            (open_assertions, now + datetime.timedelta(days=1), now + datetime.timedelta(days=2)),
+            (voted_assertions, now - datetime.timedelta(hours=2), now - datetime.timedelta(hours=1))):
+        for assertion_id, uid in assertions.items():
+            chats = user_chats.get(uid) or [0]
+            db.execute(
+                "INSERT OR IGNORE INTO Assertions (Id, UserId, ChatId, Text, ValidationDate, CastingForecastDeadline) VALUES (?, ?, ?, ?, ?, ?)",
+                (int(assertion_id), uid, chats[0], f"Assertion {assertion_id}", validation, casting))
+    db.execute("COMMIT")
+    connection.close()
+    print(f"Seeded {len(users)} users, {len(members)} chats, "
+          f"{len(open_assertions) + len(voted_assertions)} assertions")
+
+
+def join_token(chat_id: str) -> str:
+    # Same hash the server computes with CJTK_SECRET=REPLAY_SECRET
+    digest = hashlib.sha256((chat_id + REPLAY_SECRET).encode()).digest()
+    return f"{base64.b64encode(digest)[:16].decode()}.{base64.b64encode(chat_id.encode()).decode()}"
+
+
+def shift_date(value: str, shift: datetime.timedelta) -> str:
+    try:
+        parsed = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return value
+    return (parsed + shift).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def restore(cmd: str, payload: str, uid: str, shift: datetime.timedelta) -> str:
+    """
+    Turn a recorded payload back into one the test server accepts.
+    """
+    if cmd == "user":
+        return offline.token_for(uid)
+    if cmd == "fcmt":
+        return "replay-device-token"
+    if cmd == "join":
+        return join_token(payload)
+    if cmd == "assr":
+        parts = payload.split(",", 3)
+        if len(parts) == 4:
+            parts[1], parts[2] = shift_date(parts[1], shift), shift_date(parts[2], shift)
+        return ",".join(parts)
+    if cmd == "batc":
+        return json.dumps([c + restore(c, p, uid, shift) for c, p in expand(cmd, payload)])
+    return payload
+
+
+class Stats:
+    def __init__(self):
+        self.replayed: dict[str, list[float]] = {}
+        self.recorded: dict[str, list[float]] = {}
+        self.timeouts: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def record(self, cmd: str, latency: float | None, recorded: float):
+        with self._lock:
+            self.recorded.setdefault(cmd, []).append(recorded)
+            if latency is None:
+                self.timeouts[cmd] = self.timeouts.get(cmd, 0) + 1
+            else:
+                self.replayed.setdefault(cmd, []).append(latency)
+
+
+def replay_connection(connection: Connection, index: int, target: tuple[str, int], start: float,
+                      run_start: float, speed: float, shift: datetime.timedelta,
+                      stats: Stats, results: Results, timeout: float):
+    def wait_until(at: float):
+        if speed:
+            delay = run_start + (at - start) / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    wait_until(connection.opened)
+    try:
+        client = Client(index, *target, results, timeout)
+        client.handshake()
+    except Exception:
+        results.record_error()
+        return
+
+    uid = ""
+    for at, cmd, recorded_uid, payload, duration in connection.commands:
+        wait_until(at)
+        uid = recorded_uid or uid
+        latency, _ = client.request(cmd, restore(cmd, payload, uid, shift))
+        stats.record(cmd, latency, duration)
+        if client.closed:
+            break
+
+    if connection.closed is not None:
+        wait_until(connection.closed)
+    client.close()
+
+
+def report(stats: Stats, elapsed: float, traced: float, results: Results):
+    total = sum(len(v) for v in stats.replayed.values())
+    print(f"\nReplayed {total} commands in {elapsed:.1f}s (trace spans {traced:.1f}s), "
+          f"{total / elapsed:,.0f} cmd/s, {results.errors} connection errors")
+    print(f"{'cmd':<6}{'count':>8}{'timeouts':>10}{'p50 ms':>9}{'p99 ms':>9}"
+          f"{'rec p50':>9}{'rec p99':>9}{'p50 x':>8}")
+    for cmd in sorted(stats.recorded):
+        replayed = stats.replayed.get(cmd, [])
+        recorded = stats.recorded[cmd]
+        p50, rec_p50 = percentile(replayed, 50), percentile(recorded, 50)
+        ratio = f"{p50 / rec_p50:>8.2f}" if rec_p50 else f"{'-':>8}"
+        print(f"{cmd:<6}{len(replayed):>8}{stats.timeouts.get(cmd, 0):>10}"
+              f"{p50 * 1000:>9.2f}{percentile(replayed, 99) * 1000:>9.2f}"
+              f"{rec_p50 * 1000:>9.2f}{percentile(recorded, 99) * 1000:>9.2f}{ratio}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay a recorded traffic trace against an offline server.")
+    parser.add_argument("traces", nargs="+",
+                        help="trace files, one per server process")
+    parser.add_argument("--speed", type=float, default=1,
+                        help="time scale, 0 replays as fast as possible")
+    parser.add_argument("--timeout", type=float, default=10)
+    parser.add_argument("--db", default=os.path.join(
+        tempfile.gettempdir(), "predictrix-replay.sqlite3"))
+    parser.add_argument("--port", type=int, default=32791,
+                        help="port for the spawned server")
+    parser.add_argument("--connect", default="",
+                        help="HOST:PORT of a running offline server (OFFLINE_DB=--db, "
+                             f"CJTK_SECRET={REPLAY_SECRET}) instead of spawning one")
+    args = parser.parse_args()
+
+    connections, start = load(args.traces)
+    if not connections:
+        print("The trace holds no connections.")
+        return
+    end = max([c.closed or c.opened for c in connections] +
+              [cmd[0] for c in connections for cmd in c.commands])
+    print(f"Loaded {len(connections)} connections, "
+          f"{sum(len(c.commands) for c in connections)} commands")
+
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(args.db + suffix):
+            os.unlink(args.db + suffix)
+    seed_from_trace(args.db, connections)
+
+    server = None
+    if args.connect:
+        host, _, port = args.connect.rpartition(":")
+        target = (host, int(port))
+    else:
+        os.environ["CJTK_SECRET"] = REPLAY_SECRET
+        server = start_server(args.db, args.port)
+        target = ("127.0.0.1", args.port)
+
+    stats = Stats()
+    results = Results()
+    # Dates in the trace move forward by the time since it was recorded
+    shift = datetime.timedelta(seconds=time.time() - start)
+    run_start = time.time()
+    try:
+        threads = [threading.Thread(target=replay_connection, args=(
+            connection, i, target, start, run_start, args.speed, shift, stats, results, args.timeout))
+            for i, connection in enumerate(connections)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    report(stats, time.time() - run_start, end - start, results)
+
+
+if __name__ == "__main__":
+    main()
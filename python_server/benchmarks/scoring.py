@@ -0,0 +1,47 @@
+"""
+Benchmark the vectorized calculate_scores against the scalar calculate_score path.
+
+Run from python_server/:
+    python -m benchmarks.scoring [--predictions 1000000]
+"""
+from scoring import calculate_score, calculate_scores
+import argparse
+import time
+
+import numpy as np
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare scalar and vectorized scoring.")
+    parser.add_argument("--predictions", type=int, default=1_000_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    confidences = np.round(rng.random(args.predictions), 2)
+    forecasts = rng.random(args.predictions) < 0.5
+    final_answers = rng.random(args.predictions) < 0.5
+
+    start = time.perf_counter()
+    scalar = [calculate_score(c, f, a) for c, f, a in zip(
+        confidences.tolist(), forecasts.tolist(), final_answers.tolist())]
+    scalar_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    vectorized = calculate_scores(confidences, forecasts, final_answers)
+    vectorized_time = time.perf_counter() - start
+
+    if not np.array_equal(np.asarray(scalar, dtype=np.int64), vectorized):
+        raise SystemExit("Vectorized scores differ from the scalar path.")
+
+    print(f"Predictions: {args.predictions}")
+    print(
+        f"Scalar:      {scalar_time:.3f}s ({args.predictions / scalar_time:,.0f}/s)")
+    print(
+        f"Vectorized:  {vectorized_time:.3f}s ({args.predictions / vectorized_time:,.0f}/s)")
+    print(f"Speedup:     {scalar_time / vectorized_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
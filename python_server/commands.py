@@ -1,10 +1,17 @@
 from cqrs import Command
-from db_utils import DbUtils
+from db_utils import DbUtils, DbTransaction
+from db_connector import OFFLINE
 from firebase_admin import auth
 from queries import GetUserProfileQuery
 import json
+import logs
 from typing import Any
 
+if OFFLINE:
+    from offline import auth
+
+log = logs.get("commands")
+
 
 class CreateUserCommand(Command):
     def execute(self, token: str) -> tuple[str, str]:
@@ -17,10 +24,9 @@ class CreateUserCommand(Command):
             display_name = decoded_token.get("name", "Unknown User")
             email = decoded_token.get("email", "")
             photo_url = decoded_token.get("picture", "")
-            print(f"Decoded token for user {uid}: {decoded_token}")
 
         except Exception as e:
-            print(f"Error decoding token: {e}")
+            log.warning("Error decoding token: %s", e)
             return ("", "Unknown User")
 
         try:
@@ -29,7 +35,7 @@ class CreateUserCommand(Command):
                 "SELECT COUNT(*) FROM Users WHERE UserId = %s", (uid,)).execute_single()
             count = list(count.values())[0] if count else 0  # type: ignore
             if count > 0:  # type: ignore
-                print(f"User {uid} already exists.")
+                log.debug("User %s already exists", uid)
 
                 # Update user details if necessary
                 existing_user = DbUtils(
@@ -44,7 +50,7 @@ class CreateUserCommand(Command):
                     db_photo_url = existing_user.get(  # type: ignore
                         "PhotoUrl", "")
                     if db_display_name != display_name or db_email != email or db_photo_url != photo_url:
-                        print(f"Updating user {uid} details...")
+                        log.debug("Updating user %s details", uid)
                         DbUtils(
                             "UPDATE Users SET DisplayName = %s, Email = %s, PhotoUrl = %s WHERE UserId = %s",
                             (display_name, email, photo_url, uid)
@@ -52,21 +58,21 @@ class CreateUserCommand(Command):
 
                 return (uid, display_name)
 
-            print(f"User {uid} does not exist, adding to database...")
+            log.debug("User %s does not exist, adding to database", uid)
             success = DbUtils(
                 "INSERT INTO Users (UserId, DisplayName, Email, PhotoUrl, Chats) VALUES (%s, %s, %s, %s, '[]')",
                 (uid, display_name, email, photo_url)
             ).execute_update()
 
             if not success:
-                print(f"Failed to add user {uid}.")
+                log.error("Failed to add user %s", uid)
                 return ("", "Unknown User")
-            print(f"User {uid} added successfully.")
+            log.info("User %s added", uid)
 
             return (uid, display_name)
 
         except Exception as e:
-            print(f"Error adding user {uid}: {e}")
+            log.error("Error adding user %s: %s", uid, e)
             return ("", "Unknown User")
 
 
@@ -76,42 +82,57 @@ class AppendChatMessageCommand(Command):
         Append a new message dict to the Messages JSON array in the Chats table.
         Also updates LastMessage to be "{sender}: {content}".
         """
+        return AppendChatMessagesCommand().execute(chat_id, [message])
+
+
+class AppendChatMessagesCommand(Command):
+    def execute(self, chat_id: str, messages: list) -> bool:
+        """
+        Append several messages to the Messages JSON array in one update.
+        LastMessage is taken from the last dict message, assertion IDs leave it unchanged.
+        The row is locked while it's rewritten, so appends from other server processes aren't lost.
+        """
         try:
-            # Fetch existing messages
-            row = DbUtils(
-                "SELECT Messages FROM Chats WHERE Id = %s", (chat_id,)
-            ).execute_single()
-            raw = row.get("Messages") if row else None  # type: ignore
-            msgs = []
-            if raw:
-                try:
-                    msgs = json.loads(str(raw))
-                except Exception:
-                    msgs = []
-            # Append new message
-            msgs.append(message)
-
-            if (type(message) is int):
-                success = DbUtils(
-                    "UPDATE Chats SET Messages = %s WHERE Id = %s",
-                    (json.dumps(msgs), chat_id)
-                ).execute_update()
-                return success
-
-            # Prepare LastMessage
-            sender = GetUserProfileQuery().execute(message.get("sender", "")
-                                                   ).get("displayName", "Unknown User")
-            content = message.get("content", "")
-            last_message = f"{sender}: {content}"
-            # Persist back to database
-            updated = json.dumps(msgs)
-            success = DbUtils(
-                "UPDATE Chats SET Messages = %s, LastMessage = %s WHERE Id = %s",
-                (updated, last_message, chat_id)
-            ).execute_update()
-            return success
+            last_message = None
+            text_messages = [m for m in messages if type(m) is not int]
+            if text_messages:
+                # Prepare LastMessage
+                message = text_messages[-1]
+                sender = GetUserProfileQuery().execute(message.get("sender", "")
+                                                       ).get("displayName", "Unknown User")
+                content = message.get("content", "")
+                last_message = f"{sender}: {content}"
+
+            with DbTransaction() as tx:
+                # Fetch existing messages
+                row = tx.execute_single(
+                    "SELECT Messages FROM Chats WHERE Id = %s FOR UPDATE", (chat_id,)
+                )
+                raw = row.get("Messages") if row else None  # type: ignore
+                msgs = []
+                if raw:
+                    try:
+                        msgs = json.loads(str(raw))
+                    except Exception:
+                        msgs = []
+                # Append new messages
+                msgs.extend(messages)
+
+                # Persist back to database
+                updated = json.dumps(msgs)
+                if last_message is None:
+                    tx.execute_update(
+                        "UPDATE Chats SET Messages = %s WHERE Id = %s",
+                        (updated, chat_id)
+                    )
+                else:
+                    tx.execute_update(
+                        "UPDATE Chats SET Messages = %s, LastMessage = %s WHERE Id = %s",
+                        (updated, last_message, chat_id)
+                    )
+            return True
         except Exception as e:
-            print(f"Error appending message to chat {chat_id}: {e}")
+            log.error("Error appending messages to chat %s: %s", chat_id, e)
             return False
 
 
@@ -121,74 +142,54 @@ class JoinChatCommand(Command):
         Add a user to a chat by updating both Chats.Members and Users.Chats.
         """
         try:
-            # Add user to chat members
-            chat_row = DbUtils(
-                "SELECT Members FROM Chats WHERE Id = %s", (chat_id,)
-            ).execute_single()
-            if not chat_row:
-                print(f"Chat {chat_id} not found.")
-                return False
-
-            chat_dict: dict[str, Any] = dict(chat_row)  # type: ignore
-            members_json = chat_dict.get("Members") or "[]"
-            members = json.loads(str(members_json))
+            # Add user to chat members and stats in one locked read-modify-write
+            with DbTransaction() as tx:
+                chat_row = tx.execute_single(
+                    "SELECT Members, ScoreSumPerUser, PredictionsPerUser FROM Chats WHERE Id = %s FOR UPDATE", (
+                        chat_id,)
+                )
+                if not chat_row:
+                    log.info("Chat %s not found", chat_id)
+                    return False
 
-            # Check if user is already a member
-            if user_id in members:
-                print(f"User {user_id} is already a member of chat {chat_id}.")
-                return True
+                chat_dict: dict[str, Any] = dict(chat_row)  # type: ignore
+                members_json = chat_dict.get("Members") or "[]"
+                members = json.loads(str(members_json))
 
-            # Add user to members list
-            members.append(user_id)
-            updated_members = json.dumps(members)
+                # Check if user is already a member
+                if user_id in members:
+                    log.debug("User %s is already a member of chat %s",
+                              user_id, chat_id)
+                    return True
 
-            success1 = DbUtils(
-                "UPDATE Chats SET Members = %s WHERE Id = %s",
-                (updated_members, chat_id)
-            ).execute_update()
-
-            if not success1:
-                print(
-                    f"Failed to add user {user_id} to chat {chat_id} members.")
-                return False
-
-            # Update ScoreSumPerUser and PredictionsPerUser for the new member
-            chat_stats_row = DbUtils(
-                "SELECT ScoreSumPerUser, PredictionsPerUser FROM Chats WHERE Id = %s", (
-                    chat_id,)
-            ).execute_single()
-            if chat_stats_row:
-                stats_dict: dict[str, Any] = dict(
-                    chat_stats_row)  # type: ignore
+                # Add user to members list
+                members.append(user_id)
+                updated_members = json.dumps(members)
 
                 # Update ScoreSumPerUser
-                scores_json = stats_dict.get("ScoreSumPerUser") or "{}"
+                scores_json = chat_dict.get("ScoreSumPerUser") or "{}"
                 scores = json.loads(str(scores_json))
                 if user_id not in scores:
                     scores[user_id] = 0
 
                 # Update PredictionsPerUser
-                preds_json = stats_dict.get("PredictionsPerUser") or "{}"
+                preds_json = chat_dict.get("PredictionsPerUser") or "{}"
                 preds = json.loads(str(preds_json))
                 if user_id not in preds:
                     preds[user_id] = 0
 
-                # Save updated stats
-                success_stats = DbUtils(
-                    "UPDATE Chats SET ScoreSumPerUser = %s, PredictionsPerUser = %s WHERE Id = %s",
-                    (json.dumps(scores), json.dumps(preds), chat_id)
-                ).execute_update()
-
-                if not success_stats:
-                    print(
-                        f"Failed to update chat stats for user {user_id} in chat {chat_id}.")
+                tx.execute_update(
+                    "UPDATE Chats SET Members = %s, ScoreSumPerUser = %s, PredictionsPerUser = %s WHERE Id = %s",
+                    (updated_members, json.dumps(scores),
+                     json.dumps(preds), chat_id)
+                )
 
             # Add chat to user's chats
             user_row = DbUtils(
                 "SELECT Chats FROM Users WHERE UserId = %s", (user_id,)
             ).execute_single()
             if not user_row:
-                print(f"User {user_id} not found.")
+                log.info("User %s not found", user_id)
                 return False
 
             user_dict: dict[str, Any] = dict(user_row)  # type: ignore
@@ -207,16 +208,16 @@ class JoinChatCommand(Command):
                 ).execute_update()
 
                 if not success2:
-                    print(
-                        f"Failed to add chat {chat_id} to user {user_id} chats.")
+                    log.error("Failed to add chat %s to user %s chats",
+                              chat_id, user_id)
                     return False
 
-            print(f"Successfully added user {user_id} to chat {chat_id}.")
+            log.info("Added user %s to chat %s", user_id, chat_id)
             return True
 
         except Exception as e:
-            print(
-                f"Error in JoinChatCommand for user {user_id}, chat {chat_id}: {e}")
+            log.error("Error in JoinChatCommand for user %s, chat %s: %s",
+                      user_id, chat_id, e)
             return False
 
 
@@ -240,7 +241,7 @@ class CreateChatCommand(Command):
             ).execute_update()
 
             if not success:
-                print(f"Failed to create chat with name: {name}")
+                log.error("Failed to create chat")
                 return ""
 
             # Get the created chat ID
@@ -250,14 +251,14 @@ class CreateChatCommand(Command):
             ).execute_single()
 
             if not chat_row:
-                print(f"Failed to retrieve created chat ID for: {name}")
+                log.error("Failed to retrieve created chat ID")
                 return ""
 
             chat_dict: dict[str, Any] = dict(chat_row)  # type: ignore
             chat_id = str(chat_dict.get("Id", ""))
 
             if not chat_id:
-                print(f"Invalid chat ID retrieved for: {name}")
+                log.error("Invalid chat ID retrieved")
                 return ""
 
             # Add chat to creator's chat list
@@ -281,14 +282,14 @@ class CreateChatCommand(Command):
                     ).execute_update()
 
                     if not success_user:
-                        print(
-                            f"Failed to add chat {chat_id} to user {creator_uid} chats.")
+                        log.error("Failed to add chat %s to user %s chats",
+                                  chat_id, creator_uid)
 
-            print(f"Successfully created chat '{name}' with ID {chat_id}")
+            log.info("Created chat %s", chat_id)
             return chat_id
 
         except Exception as e:
-            print(f"Error creating chat '{name}': {e}")
+            log.error("Error creating chat: %s", e)
             return ""
 
 
@@ -306,7 +307,7 @@ class CreateAssertionCommand(Command):
             ).execute_update()
 
             if not success:
-                print(f"Failed to create assertion for user: {user_id}")
+                log.error("Failed to create assertion for user %s", user_id)
                 return ""
 
             # Get the created assertion ID
@@ -316,8 +317,8 @@ class CreateAssertionCommand(Command):
             ).execute_single()
 
             if not assertion_row:
-                print(
-                    f"Failed to retrieve created assertion ID for user: {user_id}")
+                log.error(
+                    "Failed to retrieve created assertion ID for user %s", user_id)
                 return ""
 
             assertion_dict: dict[str, Any] = dict(
@@ -325,14 +326,14 @@ class CreateAssertionCommand(Command):
             assertion_id = str(assertion_dict.get("Id", ""))
 
             if not assertion_id:
-                print(f"Invalid assertion ID retrieved for user: {user_id}")
+                log.error("Invalid assertion ID retrieved for user %s", user_id)
                 return ""
 
-            print(f"Successfully created assertion with ID {assertion_id}")
+            log.info("Created assertion %s", assertion_id)
             return assertion_id
 
         except Exception as e:
-            print(f"Error creating assertion for user {user_id}: {e}")
+            log.error("Error creating assertion for user %s: %s", user_id, e)
             return ""
 
 
@@ -342,44 +343,46 @@ class AddPredictionCommand(Command):
         Add a prediction to an assertion's Predictions JSON field.
         """
         try:
-            # Get current predictions
-            row = DbUtils(
-                "SELECT Predictions FROM Assertions WHERE Id = %s", (
-                    assertion_id,)
-            ).execute_single()
-
-            if not row:
-                print(f"Assertion {assertion_id} not found.")
-                return False
+            with DbTransaction() as tx:
+                # Get current predictions
+                row = tx.execute_single(
+                    "SELECT Predictions FROM Assertions WHERE Id = %s FOR UPDATE", (
+                        assertion_id,)
+                )
+
+                if not row:
+                    log.info("Assertion %s not found", assertion_id)
+                    return False
 
-            # Parse existing predictions or start with empty dict
-            row_dict: dict[str, Any] = dict(row)  # type: ignore
-            predictions_json = row_dict.get("Predictions") or "{}"
-            predictions = json.loads(
-                str(predictions_json)) if predictions_json else {}
+                # Parse existing predictions or start with empty dict
+                row_dict: dict[str, Any] = dict(row)  # type: ignore
+                predictions_json = row_dict.get("Predictions") or "{}"
+                predictions = json.loads(
+                    str(predictions_json)) if predictions_json else {}
 
-            # Check if user has already made a prediction
-            if user_id in predictions:
-                print(
-                    f"User {user_id} has already made a prediction for assertion {assertion_id}")
-                return False
+                # Check if user has already made a prediction
+                if user_id in predictions:
+                    log.info("User %s has already made a prediction for assertion %s",
+                             user_id, assertion_id)
+                    return False
 
-            # Add user's prediction (first time only)
-            predictions[user_id] = {
-                "confidence": confidence,
-                "forecast": forecast
-            }
+                # Add user's prediction (first time only)
+                predictions[user_id] = {
+                    "confidence": confidence,
+                    "forecast": forecast
+                }
 
-            # Update database
-            success = DbUtils(
-                "UPDATE Assertions SET Predictions = %s WHERE Id = %s",
-                (json.dumps(predictions), assertion_id)
-            ).execute_update()
+                # Update database
+                tx.execute_update(
+                    "UPDATE Assertions SET Predictions = %s WHERE Id = %s",
+                    (json.dumps(predictions), assertion_id)
+                )
 
-            return success
+            return True
 
         except Exception as e:
-            print(f"Error adding prediction to assertion {assertion_id}: {e}")
+            log.error("Error adding prediction to assertion %s: %s",
+                      assertion_id, e)
             return False
 
 
@@ -389,39 +392,40 @@ class AddVoteCommand(Command):
         Add or update a user's vote on an assertion.
         """
         try:
-            # Get current votes
-            row = DbUtils(
-                "SELECT Votes FROM Assertions WHERE Id = %s",
-                (assertion_id,)
-            ).execute_single()
-
-            if not row:
-                print(f"Assertion {assertion_id} not found.")
-                return False
+            with DbTransaction() as tx:
+                # Get current votes
+                row = tx.execute_single(
+                    "SELECT Votes FROM Assertions WHERE Id = %s FOR UPDATE",
+                    (assertion_id,)
+                )
+
+                if not row:
+                    log.info("Assertion %s not found", assertion_id)
+                    return False
 
-            votes_data: dict[str, Any] = dict(row)  # type: ignore
-            votes_json = votes_data.get("Votes", "{}")
+                votes_data: dict[str, Any] = dict(row)  # type: ignore
+                votes_json = votes_data.get("Votes", "{}")
 
-            # Parse existing votes
-            if isinstance(votes_json, str):
-                try:
-                    votes = json.loads(votes_json)
-                except:
-                    votes = {}
-            else:
-                votes = votes_json if votes_json else {}
+                # Parse existing votes
+                if isinstance(votes_json, str):
+                    try:
+                        votes = json.loads(votes_json)
+                    except:
+                        votes = {}
+                else:
+                    votes = votes_json if votes_json else {}
 
-            # Add or update the user's vote
-            votes[user_id] = vote
+                # Add or update the user's vote
+                votes[user_id] = vote
 
-            # Update database
-            success = DbUtils(
-                "UPDATE Assertions SET Votes = %s WHERE Id = %s",
-                (json.dumps(votes), assertion_id)
-            ).execute_update()
+                # Update database
+                tx.execute_update(
+                    "UPDATE Assertions SET Votes = %s WHERE Id = %s",
+                    (json.dumps(votes), assertion_id)
+                )
 
-            return success
+            return True
 
         except Exception as e:
-            print(f"Error adding vote to assertion {assertion_id}: {e}")
+            log.error("Error adding vote to assertion %s: %s", assertion_id, e)
             return False
@@ -1,6 +1,11 @@
 import socket
+import threading
+import time
+import logs
 from Crypto.Cipher import AES
 
+log = logs.get("connection")
+
 
 class Connection():
     def __init__(self, conn: socket.socket, addr: tuple[str, int]):
@@ -9,19 +14,45 @@ class Connection():
         self.addr = addr
         self.aes_cipher = None
         self.session_key: bytes = b""  # store raw AES key for decrypt
+        # Workers and the event thread send concurrently, frames must not interleave
+        self._send_lock = threading.Lock()
+        # Receive chat events as sequenced "sevt" frames, see enable_event_seq()
+        self.event_seq = False
+        # When the client last sent a frame, read by the keepalive reaper
+        self.last_active = time.monotonic()
+        # Set once the socket is shut down, work still queued for it is skipped
+        self.closed = False
         self.conn.settimeout(5)
         self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
-    def send(self, prefix: str, content: bytes):
+    def _frame(self, prefix: str, content: bytes) -> bytes:
         data = prefix.encode() + content
 
         if self.session_key:
             cipher = AES.new(self.session_key, AES.MODE_GCM)  # type: ignore
             ciphertext, tag = cipher.encrypt_and_digest(data)
             data = cipher.nonce + ciphertext + tag  # type: ignore
-        size = len(data)
-        self.conn.send(size.to_bytes(4, 'big'))
-        self.conn.send(data)
+        return len(data).to_bytes(4, 'big') + data
+
+    def send(self, prefix: str, content: bytes):
+        frame = self._frame(prefix, content)
+        with self._send_lock:
+            self.conn.sendall(frame)
+
+    def try_send(self, prefix: str, content: bytes) -> bool:
+        """
+        Send a small frame without ever blocking. Skipped while another send is in progress,
+        False if the socket is broken or its send buffer is full.
+        """
+        frame = self._frame(prefix, content)
+        if not self._send_lock.acquire(blocking=False):
+            return True
+        try:
+            return self.conn.send(frame, socket.MSG_DONTWAIT) == len(frame)
+        except OSError:
+            return False
+        finally:
+            self._send_lock.release()
 
     def recv(self):
         # read 4-byte length header fully
@@ -34,6 +65,7 @@ class Connection():
                 header += chunk
             except:
                 return b""
+        self.last_active = time.monotonic()
         size = int.from_bytes(header, 'big')
         if size == 0:
             return b""
@@ -57,11 +89,11 @@ class Connection():
                 try:
                     return cipher.decrypt_and_verify(ciphertext, tag)
                 except Exception as e:
-                    print(f"[DEBUG] Decrypt error: {e}")
+                    log.warning("Decrypt error: %s", e)
                     return b""
 
             except Exception as e:
-                print(f"[DEBUG] Decrypt error: {e}")
+                log.warning("Decrypt error: %s", e)
                 raise
         return payload
 
@@ -69,8 +101,11 @@ class Connection():
         """Store the AES-GCM cipher and raw key for encrypt/decrypt operations."""
         self.aes_cipher = aes_cipher
         self.session_key = key
-        print(
-            f"[DEBUG] Session key set ({len(key)} bytes), using nonce: {aes_cipher.nonce.hex()}")
+        log.debug("Session key set", extra={
+                  "key_bytes": len(key), "nonce": aes_cipher.nonce.hex()})
+
+    def enable_event_seq(self):
+        self.event_seq = True
 
     def set_uid(self, uid: str):
         self.uid = uid
@@ -78,7 +113,18 @@ class Connection():
         import event_framework
         event_framework.register_connection(uid, self)
 
+    def shutdown(self):
+        """
+        Wake every thread blocked on this socket, the client thread then closes it.
+        """
+        self.closed = True
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
     def close(self):
+        self.closed = True
         # Unregister this connection if registered
         if self.uid:
             import event_framework
@@ -86,3 +132,36 @@ class Connection():
         if self.conn:
             self.conn.shutdown(socket.SHUT_RDWR)
         self.conn.close()
+
+
+class RequestConnection():
+    """
+    View of a connection for one pipelined request.
+    Replies are tagged "#<request_id>:" so the client can match them out of order.
+    """
+
+    def __init__(self, connection: Connection, request_id: str):
+        self.connection = connection
+        self.request_id = request_id
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def send(self, prefix: str, content: bytes):
+        self.connection.send(f"#{self.request_id}:{prefix}", content)
+
+
+class CapturingConnection():
+    """
+    View of a connection that collects replies instead of sending them, used for batched commands.
+    """
+
+    def __init__(self, connection: Connection):
+        self.connection = connection
+        self.frames: list[tuple[str, bytes]] = []
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def send(self, prefix: str, content: bytes):
+        self.frames.append((prefix, content))
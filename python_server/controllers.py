@@ -1,33 +1,41 @@
 from abc import ABC, abstractmethod
-from connection import Connection
-from commands import CreateUserCommand, AppendChatMessageCommand, JoinChatCommand, CreateChatCommand
+from connection import Connection, CapturingConnection
+from commands import CreateUserCommand, JoinChatCommand, CreateChatCommand
 from commands import CreateAssertionCommand, AddPredictionCommand, AddVoteCommand
 from queries import GetChatsQuery, GetChatMembersQuery, GetChatMessagesQuery, GetUserProfileQuery, GetChatStatsQuery
-from queries import GetAssertionQuery
-from message_sender import send_message
+from queries import GetAssertionQuery, GetAssertionVersionsQuery, GetChatsMembersQuery, GetUserProfilesQuery, request_scope
+from message_sender import send_message, register_device_token
+from locks import ReadWriteLock, StripedLockTable
+from rate_limit import TokenBuckets
+import assertion_scheduler
+import logs
+import message_log
+import metrics
+import profiler
 import event_framework
+import tracing
 import datetime
 import json
 import hashlib
 import os
-import threading
 import base64
+import time
+import zlib
+from typing import Any
 
 
-# Global dictionary to store locks per chat_id
-_chat_locks: dict[str, threading.Lock] = {}
-_chat_locks_lock = threading.Lock()  # Lock to protect the locks dictionary
+log = logs.get("controllers")
 
+# Chat locks are striped so the table stays bounded no matter which chat ids clients send
+_chat_locks = StripedLockTable(int(os.environ.get("CHAT_LOCK_STRIPES", 1024)))
 
-def get_chat_lock(chat_id: str) -> threading.Lock:
+
+def get_chat_lock(chat_id: str) -> ReadWriteLock:
     """
-    Get or create a lock for the specified chat_id.
-    Thread-safe creation ensures only one lock per chat_id.
+    Get the reader/writer lock guarding the specified chat_id.
+    Pure reads take it shared, anything that writes to the chat takes it exclusively.
     """
-    with _chat_locks_lock:
-        if chat_id not in _chat_locks:
-            _chat_locks[chat_id] = threading.Lock()
-        return _chat_locks[chat_id]
+    return _chat_locks.get(str(chat_id))
 
 
 def generate_chat_join_token_hash(chat_id: str) -> str | None:
@@ -54,6 +62,51 @@ def generate_chat_topic(chat_id: str) -> str | None:
     return f"chat_{hash_obj.hexdigest()[:64]}"
 
 
+# Comma-separated uids allowed to use the operator commands
+ADMIN_UIDS = {uid for uid in os.environ.get("ADMIN_UIDS", "").split(",") if uid}
+
+
+def is_admin(connection: Connection) -> bool:
+    return bool(connection.uid) and connection.uid in ADMIN_UIDS
+
+
+def sender_key(connection: Connection) -> str:
+    return connection.uid or f"{connection.addr[0]}:{connection.addr[1]}"
+
+
+def parse_rate_limits(spec: str) -> dict[str, tuple[float, float] | None]:
+    """
+    Per-user limit overrides, e.g. "msgs=5/30,sndm=off": tokens per second / burst.
+    """
+    limits: dict[str, tuple[float, float] | None] = {}
+    for entry in spec.split(","):
+        cmd, sep, value = entry.strip().partition("=")
+        if not sep:
+            continue
+        if value == "off":
+            limits[cmd] = None
+            continue
+        rate, _, burst = value.partition("/")
+        limits[cmd] = (float(rate), float(burst or rate))
+    return limits
+
+
+RATE_LIMITS = parse_rate_limits(os.environ.get("RATE_LIMITS", ""))
+
+# RATE_LIMITS=off turns every limit off, e.g. for benchmarks
+RATE_LIMITING = os.environ.get("RATE_LIMITS", "") != "off"
+
+# (command, scope) -> buckets, shared by every instance of a controller
+_rate_buckets: dict[tuple[str, str], TokenBuckets] = {}
+
+
+def _buckets(cmd: str, scope: str, limit: tuple[float, float]) -> TokenBuckets:
+    buckets = _rate_buckets.get((cmd, scope))
+    if buckets is None:
+        buckets = _rate_buckets.setdefault((cmd, scope), TokenBuckets(*limit))
+    return buckets
+
+
 class Controller(ABC):
     @abstractmethod
     def name(self) -> str:
@@ -69,56 +122,193 @@ class Controller(ABC):
         """
         pass
 
+    # Run on the connection's own thread instead of the worker pool
+    inline = False
+
+    # Token buckets as (tokens per second, burst), None for no limit. The user limit is shared
+    # by all of a user's connections and can be overridden with RATE_LIMITS
+    user_rate: tuple[float, float] | None = None
+    connection_rate: tuple[float, float] | None = (50, 200)
+
+    def allow(self, connection: Connection) -> bool:
+        """
+        Take a token from this command's per-connection and per-user buckets.
+        """
+        if not RATE_LIMITING:
+            return True
+        cmd = self.name()
+        if self.connection_rate and not _buckets(cmd, "connection", self.connection_rate).allow(
+                f"{connection.addr[0]}:{connection.addr[1]}"):
+            metrics.inc("commands_throttled_total",
+                        (("command", cmd), ("scope", "connection")))
+            return False
+        user_rate = RATE_LIMITS.get(cmd, self.user_rate)
+        if user_rate and connection.uid and not _buckets(cmd, "user", user_rate).allow(connection.uid):
+            metrics.inc("commands_throttled_total",
+                        (("command", cmd), ("scope", "user")))
+            return False
+        return True
+
+    def shard_key(self, connection: Connection, payload: str) -> str:
+        """
+        Key that orders this command on the worker pool, commands with the same key run in order.
+        Defaults to the sender, so reads spread over the pool and rely on the shared chat lock.
+        """
+        return sender_key(connection)
+
 
 class PingController(Controller):
+    inline = True
+
     def name(self):
         return "ping"
 
     def handle(self, connection: Connection, payload: str) -> bool:
-        print(f"Ping received from {connection.addr}.")
+        # "ack" answers a server keepalive, receiving it was all that mattered
+        if payload == "ack":
+            return True
         connection.send("ping", b"pong")
         return True
 
 
+def enrich_messages(messages: list, uid: str) -> list:
+    """
+    Replace sender ids with profiles and assertion ids with assertion data.
+    Messages are replaced by enriched copies, the dicts passed in are left untouched.
+    """
+    for i, msg in enumerate(messages):
+        if isinstance(msg, dict) and msg.get("sender"):
+            # Enrich sender with profile (displayName, photoUrl)
+            profile = GetUserProfileQuery().execute(msg["sender"])
+            messages[i] = {**msg, "sender": profile}
+        elif isinstance(msg, (int, str)) and str(msg).isdigit():
+            # This is an assertion ID, replace with assertion data
+            assertion_data = GetAssertionQuery().execute(str(msg), uid)
+            if assertion_data:
+                messages[i] = assertion_data
+    return messages
+
+
+def build_sync_token(positions: dict[str, tuple[int, int]]) -> str:
+    """
+    Encode the client's position in every chat: its message count and assertion version.
+    """
+    return base64.urlsafe_b64encode(json.dumps(
+        {chat_id: list(position) for chat_id, position in positions.items()},
+        separators=(",", ":")).encode()).decode()
+
+
+def parse_sync_token(token: str) -> dict[str, tuple[int, int | None]] | None:
+    try:
+        positions = json.loads(base64.urlsafe_b64decode(token.encode()))
+        # Older tokens only hold message counts, their assertion version is unknown
+        return {str(k): (int(v[0]), int(v[1])) if isinstance(v, list) else (int(v), None)
+                for k, v in positions.items()}
+    except Exception:
+        return None
+
+
 class ChatsController(Controller):
+    # Full chat lists with stats and topics
+    user_rate = (2, 20)
+
     def name(self):
         return "chts"
 
     def handle(self, connection: Connection, payload: str) -> bool:
-        chats: list[dict[str, str]] | None = GetChatsQuery().execute(
+        # Payload is empty for the full list, or a sync token from "stok" for changes only
+        chats: list[dict[str, Any]] | None = GetChatsQuery().execute(
             connection.uid)
 
         if not chats:
-            print(f"No chats found for user {connection.uid}.")
             connection.send("chts", json.dumps([]).encode())
+            if chats is not None:
+                # No chats is a position too, the next sync is a delta
+                connection.send("stok", build_sync_token({}).encode())
             return True
 
-        chats_json = json.dumps([{
-            "name": chat["Name"],
-            "lastMessage": chat["LastMessage"],
-            "chatId": str(chat["Id"]),
-        } for chat in chats])
-
-        connection.send("chts", chats_json.encode())
+        versions = GetAssertionVersionsQuery().execute(
+            [str(chat["Id"]) for chat in chats])
+        positions = {str(chat["Id"]): (int(chat.get("MessageCount") or 0),
+                                       versions.get(str(chat["Id"]), 0))
+                     for chat in chats}
+        known = parse_sync_token(payload.strip()) if payload.strip() else None
         topics = [
             generate_chat_topic(chat["Id"]) for chat in chats
         ]
 
-        if topics:
-            connection.send("tpcs", json.dumps(topics).encode())
-
+        if known is None:
+            chats_json = json.dumps([{
+                "name": chat["Name"],
+                "lastMessage": chat["LastMessage"],
+                "chatId": str(chat["Id"]),
+            } for chat in chats])
+
+            connection.send("chts", chats_json.encode())
+
+            if topics:
+                connection.send("tpcs", json.dumps(topics).encode())
+        else:
+            changed = [chat for chat in chats if known.get(
+                str(chat["Id"])) != positions[str(chat["Id"])]]
+
+            connection.send("chtd", json.dumps([{
+                "name": chat["Name"],
+                "lastMessage": chat["LastMessage"],
+                "chatId": str(chat["Id"]),
+            } for chat in changed]).encode())
+
+            # Topics only change when the set of chats does
+            if topics and {str(chat["Id"]) for chat in chats} != set(known):
+                connection.send("tpcs", json.dumps(topics).encode())
+
+            # New messages and updated assertions for chats the client already had
+            for chat in changed:
+                chat_id = str(chat["Id"])
+                if chat_id not in known:
+                    continue
+                seen, seen_version = known[chat_id]
+                version = positions[chat_id][1]
+                with get_chat_lock(chat_id).read(self.name()):
+                    messages = GetChatMessagesQuery().execute(chat_id)
+                    new_messages = enrich_messages(
+                        messages[seen:][-500:], connection.uid)
+                    # New assertions arrive with the messages, resend the ones the client has
+                    assertions = [GetAssertionQuery().execute(str(msg), connection.uid)
+                                  for msg in messages[:seen][-500:]
+                                  if isinstance(msg, (int, str)) and str(msg).isdigit()
+                                  ] if seen_version != version else []
+                # The client's position is what it was sent, not the earlier snapshot
+                positions[chat_id] = (len(messages), version)
+
+                if new_messages:
+                    connection.send(f"msgd{chat_id},",
+                                    json.dumps(new_messages).encode())
+                for assertion in assertions:
+                    if assertion:
+                        connection.send("assr", json.dumps(
+                            assertion["content"]).encode())
+
+        connection.send("stok", build_sync_token(positions).encode())
         return True
 
 
 class MessagesController(Controller):
+    # Up to 500 enriched messages per call
+    user_rate = (5, 30)
+
     def name(self):
         return "msgs"
 
+    def shard_key(self, connection: Connection, payload: str) -> str:
+        # Ordered per reader and chat, so one client's chats load concurrently
+        return f"{sender_key(connection)}/{payload.strip()}"
+
     def handle(self, connection: Connection, payload: str) -> bool:
         # Send the last X messages for the given chat
         chat_id = payload.strip()
 
-        with get_chat_lock(chat_id):
+        with get_chat_lock(chat_id).read(self.name()):
             # Check if user is a member of this chat
             members = GetChatMembersQuery().execute(chat_id)
             if connection.uid not in members:
@@ -126,30 +316,25 @@ class MessagesController(Controller):
                 return False
 
             messages = GetChatMessagesQuery().execute(chat_id)
-            last_x = messages[-500:]
-            # Enrich sender with profile (displayName, photoUrl)
-            for msg in last_x:
-                if isinstance(msg, dict) and msg.get("sender"):
-                    profile = GetUserProfileQuery().execute(msg["sender"])
-                    msg["sender"] = profile
-                elif isinstance(msg, (int, str)) and str(msg).isdigit():
-                    # This is an assertion ID, replace with assertion data
-                    assertion_data = GetAssertionQuery().execute(str(msg), connection.uid)
-                    if assertion_data:
-                        last_x[last_x.index(msg)] = assertion_data
+            last_x = enrich_messages(messages[-500:], connection.uid)
             connection.send(f"msgs{chat_id},", json.dumps(last_x).encode())
             return True
 
 
 class MembersController(Controller):
+    user_rate = (5, 30)
+
     def name(self):
         return "memb"
 
+    def shard_key(self, connection: Connection, payload: str) -> str:
+        return f"{sender_key(connection)}/{payload.strip()}"
+
     def handle(self, connection: Connection, payload: str) -> bool:
         # Send the members of the given chat
         chat_id = payload.strip()
 
-        with get_chat_lock(chat_id):
+        with get_chat_lock(chat_id).read(self.name()):
             members = GetChatMembersQuery().execute(chat_id)
 
             if not members:
@@ -181,9 +366,16 @@ class MembersController(Controller):
 
 
 class SendMessageController(Controller):
+    # Every message fans out to the chat and FCM
+    user_rate = (10, 30)
+
     def name(self):
         return "sndm"
 
+    def shard_key(self, connection: Connection, payload: str) -> str:
+        # Messages to the same chat are appended in arrival order
+        return payload.strip().split(" ", 1)[0]
+
     def handle(self, connection: Connection, payload: str) -> bool:
         # Append a new message to chat and broadcast event
         parts = payload.strip().split(" ", 1)
@@ -193,17 +385,15 @@ class SendMessageController(Controller):
             return False
         text = parts[1] if len(parts) > 1 else ""
 
-        with get_chat_lock(chat_id):
+        with get_chat_lock(chat_id).write(self.name()):
             # Use display name as sender
-            print("TIMESTAMP:", datetime.datetime.now(
-                datetime.timezone.utc).isoformat())
             msg_obj = {
                 "sender": connection.uid,
                 "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
                 "content": text,
             }
-            # Persist message
-            success = AppendChatMessageCommand().execute(chat_id, msg_obj)
+            # Persist message, or log it for the next group commit
+            success = message_log.append(chat_id, msg_obj)
             if not success:
                 connection.send("sndm", b"fail")
                 return False
@@ -223,31 +413,59 @@ class SendMessageController(Controller):
                 "prefix": "newm",
                 "data": chat_id.encode() + b"," + json.dumps(event_msg_obj).encode(),
                 "recipients": recipients,
+                "chat_id": chat_id,
             })
 
             topic = generate_chat_topic(chat_id)
             if topic:
-                send_message(topic, text, profile)
+                # Only members without a live socket need the push
+                send_message(topic, text, profile, recipients)
 
             connection.send("sndm", b"ok")
             return True
 
 
 class UserController(Controller):
+    # Token verification is the costliest call, and comes before a uid is known
+    connection_rate = (1, 5)
+
+    # Later commands depend on the uid set here
+    inline = True
+
     def name(self):
         return "user"
 
     def handle(self, connection: Connection, payload: str) -> bool:
-        print(f"Adding user...")
-        uid, display_name = CreateUserCommand().execute(payload)
+        # Parse payload: "<firebase token>" or "<firebase token> <sync token>" on reconnect
+        parts = payload.strip().split(" ", 1)
+        token = parts[0]
+        sync_token = parts[1] if len(parts) > 1 else ""
+
+        uid, display_name = CreateUserCommand().execute(token)
         if uid == "":
-            print(f"Failed to add user with token: {payload}")
+            log.info("Rejected user token", extra={
+                     "peer": f"{connection.addr[0]}:{connection.addr[1]}"})
             connection.send("", b"token_fail")
             return False
 
         connection.set_uid(uid)
         connection.send("token_ok", display_name.encode())
-        ChatsController().handle(connection, "")
+        ChatsController().handle(connection, sync_token)
+        return True
+
+
+class DeviceTokenController(Controller):
+    def name(self):
+        return "fcmt"
+
+    def handle(self, connection: Connection, payload: str) -> bool:
+        token = payload.strip()
+        if not connection.uid or not token:
+            connection.send("fcmt", b"invalid_token")
+            return True
+
+        register_device_token(connection.uid, token)
+        connection.send("fcmt", b"ok")
         return True
 
 
@@ -261,7 +479,7 @@ class ChatJoinTokenGeneratorController(Controller):
             connection.send("cjtk", b"invalid_chat_id")
             return False
 
-        with get_chat_lock(chat_id):
+        with get_chat_lock(chat_id).read(self.name()):
             # Check if user is a member of this chat
             members = GetChatMembersQuery().execute(chat_id)
             if connection.uid not in members:
@@ -279,6 +497,8 @@ class ChatJoinTokenGeneratorController(Controller):
 
 
 class ChatJoinTokenController(Controller):
+    user_rate = (0.5, 10)
+
     def name(self):
         return "join"
 
@@ -306,7 +526,7 @@ class ChatJoinTokenController(Controller):
             connection.send("join", b"invalid_token")
             return False
 
-        with get_chat_lock(chat_id):
+        with get_chat_lock(chat_id).write(self.name()):
             # Check if user is already a member
             members = GetChatMembersQuery().execute(chat_id)
             if connection.uid in members:
@@ -326,6 +546,8 @@ class ChatJoinTokenController(Controller):
 
 
 class ChatCreateController(Controller):
+    user_rate = (0.2, 5)
+
     def name(self):
         return "crtc"
 
@@ -350,9 +572,14 @@ class ChatCreateController(Controller):
 
 
 class AssertionSendController(Controller):
+    user_rate = (1, 10)
+
     def name(self):
         return "assr"
 
+    def shard_key(self, connection: Connection, payload: str) -> str:
+        return payload.strip().split(",", 1)[0]
+
     def handle(self, connection: Connection, payload: str) -> bool:
         # Parse payload: "chatId,2025-06-10T00:00:00.000,2025-06-11T00:00:00.000,Ophir will cancel tomorrow's lesson"
         parts = payload.strip().split(",", 3)
@@ -366,7 +593,7 @@ class AssertionSendController(Controller):
             connection.send("assr", b"missing_fields")
             return False
 
-        with get_chat_lock(chat_id):
+        with get_chat_lock(chat_id).write(self.name()):
             # Check if user is a member of this chat
             members = GetChatMembersQuery().execute(chat_id)
             if connection.uid not in members:
@@ -406,9 +633,10 @@ class AssertionSendController(Controller):
                 connection.send("assr", b"create_failed")
                 return False
 
+            assertion_scheduler.schedule_assertion(assertion_id, validation_dt)
+
             # Add assertion ID as a message to the chat
-            success = AppendChatMessageCommand().execute(
-                chat_id, int(assertion_id))  # type: ignore
+            success = message_log.append(chat_id, int(assertion_id))
             if not success:
                 connection.send("assr", b"message_failed")
                 return False
@@ -420,6 +648,7 @@ class AssertionSendController(Controller):
                 "prefix": "newm",
                 "data": chat_id.encode() + b"," + json.dumps(assertion_data).encode(),
                 "recipients": recipients,
+                "chat_id": chat_id,
             })
 
             send_message(chat_id, text,
@@ -430,6 +659,8 @@ class AssertionSendController(Controller):
 
 
 class PredictionController(Controller):
+    user_rate = (2, 20)
+
     def name(self):
         return "pred"
 
@@ -454,7 +685,7 @@ class PredictionController(Controller):
             connection.send("pred", b"invalid_chat_id")
             return False
 
-        with get_chat_lock(chat_id):
+        with get_chat_lock(chat_id).write(self.name()):
             members = GetChatMembersQuery().execute(chat_id)
             if connection.uid not in members:
                 connection.send("pred", b"not_member")
@@ -524,6 +755,8 @@ class PredictionController(Controller):
                 "prefix": "assr",
                 "data": f"{json.dumps(assertion_data)}".encode(),
                 "recipients": recipients,
+                "chat_id": chat_id,
+                "coalesce_key": f"assr{assertion_id}",
             })
 
             assertion_data["didPredict"] = True
@@ -531,6 +764,8 @@ class PredictionController(Controller):
                 "prefix": "assr",
                 "data": f"{json.dumps(assertion_data)}".encode(),
                 "recipients": [connection.uid],
+                "chat_id": chat_id,
+                "coalesce_key": f"assr{assertion_id}",
             })
 
             connection.send("pred", b"added")
@@ -538,6 +773,8 @@ class PredictionController(Controller):
 
 
 class VoteController(Controller):
+    user_rate = (2, 20)
+
     def name(self):
         return "vote"
 
@@ -594,7 +831,7 @@ class VoteController(Controller):
             connection.send("vote", b"invalid_chat")
             return True
 
-        with get_chat_lock(chat_id):
+        with get_chat_lock(chat_id).write(self.name()):
             members = GetChatMembersQuery().execute(chat_id)
             if connection.uid not in members:
                 connection.send("vote", b"not_member")
@@ -609,6 +846,9 @@ class VoteController(Controller):
                 connection.send("vote", b"vote_failed")
                 return True
 
+            # Completion happens in the scheduler once a majority is reached
+            assertion_scheduler.notify_vote(assertion_id)
+
             # Get updated assertion data and emit to all members
             updated_assertion_data = assertion_query.execute(
                 assertion_id, None)
@@ -618,7 +858,159 @@ class VoteController(Controller):
                 "prefix": "assr",
                 "data": f"{json.dumps(updated_assertion_data['content'])}".encode(),
                 "recipients": members,
+                "chat_id": chat_id,
+                "coalesce_key": f"assr{assertion_id}",
             })
 
             connection.send("vote", b"voted")
             return True
+
+
+class ResumeController(Controller):
+    def name(self):
+        return "resm"
+
+    def handle(self, connection: Connection, payload: str) -> bool:
+        # Empty payload opts in to "sevt" frames, "chatId,seq,epoch" replays what was missed
+        if not payload.strip():
+            connection.enable_event_seq()
+            connection.send("resm", f"ok,{event_framework.epoch}".encode())
+            return True
+
+        parts = payload.strip().split(",")
+        if len(parts) != 3 or not parts[1].isdigit():
+            connection.send("resm", b"invalid_format")
+            return True
+
+        chat_id, since, client_epoch = parts[0], int(parts[1]), parts[2]
+        events, last_seq = event_framework.replay_events(
+            chat_id, since, connection.uid)
+
+        if events is None or client_epoch != event_framework.epoch:
+            connection.send(f"resm{chat_id},", f"too_old,{last_seq}".encode())
+            return True
+
+        for seq, prefix, data in events:
+            connection.send("sevt", event_framework.sequenced_frame(
+                chat_id, seq, prefix, data))
+        connection.send(f"resm{chat_id},", f"done,{last_seq}".encode())
+        return True
+
+
+class StatsController(Controller):
+    def name(self):
+        return "stat"
+
+    def handle(self, connection: Connection, payload: str) -> bool:
+        if not is_admin(connection):
+            connection.send("stat", b"forbidden")
+            return True
+
+        connection.send("stat", json.dumps(metrics.snapshot()).encode())
+        return True
+
+
+class ProfileController(Controller):
+    # Starting a profile is cheap, keep it off the worker pool it measures
+    inline = True
+
+    def name(self):
+        return "prof"
+
+    def handle(self, connection: Connection, payload: str) -> bool:
+        # Payload: seconds to profile, empty for the default
+        if not is_admin(connection):
+            connection.send("prof", b"forbidden")
+            return True
+
+        seconds = payload.strip()
+        if seconds and not seconds.isdigit():
+            connection.send("prof", b"invalid_format")
+            return True
+
+        started, detail = profiler.start(float(seconds or 0))
+        connection.send("prof", f"{'started' if started else 'busy'},{detail}".encode())
+        return True
+
+
+class BatchController(Controller):
+    user_rate = (2, 10)
+
+    # Commands that must not run inside a batch
+    EXCLUDED = {"batc", "user"}
+
+    # Commands that don't change chat membership, the shared member lookups stay valid after them
+    READ_ONLY = {"ping", "chts", "msgs", "memb", "cjtk", "stat"}
+
+    MAX_COMMANDS = 50
+
+    _sub_handlers: dict[str, Controller] | None = None
+
+    def name(self):
+        return "batc"
+
+    def _handlers(self) -> dict[str, Controller]:
+        if self._sub_handlers is None:
+            self._sub_handlers = {inst.name(): inst for cls in Controller.__subclasses__()
+                                  if cls is not BatchController for inst in [cls()]}
+        return self._sub_handlers
+
+    def handle(self, connection: Connection, payload: str) -> bool:
+        # Parse payload: JSON list of full commands, e.g. ["chts", "msgs12", "memb12"]
+        try:
+            commands = json.loads(payload)
+        except ValueError:
+            connection.send("batc", b"invalid_format")
+            return True
+
+        if not isinstance(commands, list) or not all(isinstance(c, str) for c in commands):
+            connection.send("batc", b"invalid_format")
+            return True
+
+        if len(commands) > self.MAX_COMMANDS:
+            connection.send("batc", b"too_many_commands")
+            return True
+
+        handlers = self._handlers()
+        chat_ids = {c[4:].strip() for c in commands
+                    if c[:4].lower() in ("msgs", "memb") and c[4:].strip()}
+        results: list[list[list[str]]] = []
+
+        with request_scope() as members_memo:
+            # One membership lookup and one profile batch for every chat in the batch
+            members_memo.update(GetChatsMembersQuery().execute(list(chat_ids)))
+            GetUserProfilesQuery().execute(
+                [uid for members in members_memo.values() for uid in members])
+
+            for command in commands:
+                cmd = command[:4].lower()
+                capture = CapturingConnection(connection)
+                endpoint = handlers.get(cmd)
+
+                if not endpoint or cmd in self.EXCLUDED:
+                    capture.send("", b"what")
+                elif cmd not in self.READ_ONLY and endpoint.shard_key(
+                        capture, command[4:]) != self.shard_key(connection, payload):  # type: ignore
+                    # Writes ordered on another shard (per chat) would race their unbatched peers here
+                    capture.send("", b"not_batchable")
+                elif not endpoint.allow(capture):  # type: ignore
+                    capture.send(cmd, b"throttled")
+                else:
+                    started = time.perf_counter()
+                    try:
+                        with tracing.span("batch.command", command=cmd):
+                            endpoint.handle(capture, command[4:])  # type: ignore
+                    except Exception as e:
+                        log.exception("Error in batched command %s: %s", cmd, e)
+                        capture.send(cmd, b"error")
+                    metrics.observe("command_seconds", time.perf_counter() - started,
+                                    (("command", cmd),))
+                    if cmd not in self.READ_ONLY:
+                        members_memo.clear()
+
+                results.append([[prefix, content.decode(errors="replace")]
+                                for prefix, content in capture.frames])
+
+        # One zlib-compressed frame holding the replies of every command, in order
+        connection.send("batc", zlib.compress(json.dumps(results).encode()))
+        return True
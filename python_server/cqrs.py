@@ -1,7 +1,18 @@
 from abc import ABC, abstractmethod
+import tracing
+
+
+def _trace_execute(cls):
+    # Wrapped only when tracing is on, otherwise execute stays untouched
+    if tracing.ENABLED and "execute" in cls.__dict__:
+        cls.execute = tracing.spanned(cls.__name__)(cls.execute)
 
 
 class Command(ABC):
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        _trace_execute(cls)
+
     @abstractmethod
     def execute(self, *args, **kwargs):
         """
@@ -14,6 +25,10 @@ class Command(ABC):
 
 
 class Query(ABC):
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        _trace_execute(cls)
+
     @abstractmethod
     def execute(self, *args, **kwargs):
         """
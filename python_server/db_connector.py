@@ -1,4 +1,6 @@
+import logs
 import os
+import tempfile
 from dotenv import load_dotenv
 
 from mysql.connector import Error
@@ -10,8 +12,18 @@ from firebase_admin import credentials
 
 load_dotenv()
 
+log = logs.get("db")
+
+# Run against the local stand-ins in offline.py instead of MariaDB and Firebase
+OFFLINE = os.environ.get("OFFLINE", "0") == "1"
+OFFLINE_DB = os.environ.get("OFFLINE_DB", os.path.join(
+    tempfile.gettempdir(), "predictrix-offline.sqlite3"))
+
 
 def get_db_connection():
+    if OFFLINE:
+        import offline
+        return offline.connect(OFFLINE_DB)
     try:
         connection = mysql.connector.connect(
             host=os.environ.get('DB_HOST'),
@@ -22,10 +34,10 @@ def get_db_connection():
         )
         return connection
     except Error as e:
-        print(f"Error connecting to MariaDB: {e}")
+        log.error("Error connecting to MariaDB: %s", e)
         return None
 
 
-if not firebase_admin._apps:
+if not OFFLINE and not firebase_admin._apps:
     cred = credentials.Certificate("serviceAccountKey.json")
     firebase_admin.initialize_app(cred)
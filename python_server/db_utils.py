@@ -1,12 +1,30 @@
 from db_connector import get_db_connection
+import logs
+import metrics
+import os
+import threading
+import time
+import tracing
 from mysql.connector.abstracts import MySQLConnectionAbstract
 from mysql.connector.pooling import PooledMySQLConnection
 
 
+log = logs.get("db")
+
 conn: (PooledMySQLConnection | MySQLConnectionAbstract |
        None) = get_db_connection()
 
 
+def _reset_conn_after_fork():
+    # A forked worker must not share the parent's MySQL sockets
+    global conn
+    conn = None
+    _tx_local.conn = None
+
+
+os.register_at_fork(after_in_child=_reset_conn_after_fork)
+
+
 def verify_conn():
     global conn
 
@@ -14,10 +32,29 @@ def verify_conn():
         conn = get_db_connection()
 
     if conn and not conn.is_connected():
-        print("[DEBUG] Reconnecting to the database...")
+        log.info("Reconnecting to the database")
         conn = get_db_connection()
 
 
+def _timed(cursor, query: str, params, many: bool = False):
+    """
+    Run the statement on the cursor, recording its time (or failure) per statement and as a span.
+    """
+    labels = metrics.statement_labels(query)
+    start = time.perf_counter()
+    try:
+        with tracing.span("db.query", statement=labels[0][1]):
+            if many:
+                cursor.executemany(query, params)
+            else:
+                cursor.execute(query, params)
+    except Exception:
+        metrics.inc("db_errors_total", labels)
+        raise
+    finally:
+        metrics.observe("db_query_seconds", time.perf_counter() - start, labels)
+
+
 class DbUtils:
     global conn
 
@@ -37,14 +74,14 @@ class DbUtils:
             pass
         try:
             cursor = conn.cursor(dictionary=True)
-            print("[DEBUG] Executing query:", self.query,
-                  "with params:", self.params)
-            cursor.execute(self.query, self.params)
+            log.debug("Executing query", extra={"statement": self.query})
+            _timed(cursor, self.query, self.params)
             result = cursor.fetchall()
             cursor.close()
             return result
         except Exception as e:
-            print(f"Query execution error: {e}")
+            log.error("Query execution error: %s", e,
+                      extra={"statement": self.query})
             return None
 
     def execute_single(self):
@@ -59,14 +96,14 @@ class DbUtils:
             pass
         try:
             cursor = conn.cursor(dictionary=True)
-            print("[DEBUG] Executing query:", self.query,
-                  "with params:", self.params)
-            cursor.execute(self.query, self.params)
+            log.debug("Executing query", extra={"statement": self.query})
+            _timed(cursor, self.query, self.params)
             result = cursor.fetchone()
             cursor.close()
             return result
         except Exception as e:
-            print(f"Query execution error: {e}")
+            log.error("Query execution error: %s", e,
+                      extra={"statement": self.query})
             return None
 
     def execute_update(self):
@@ -81,12 +118,90 @@ class DbUtils:
             pass
         try:
             cursor = conn.cursor()
-            print("[DEBUG] Executing update query:", self.query,
-                  "with params:", self.params)
-            cursor.execute(self.query, self.params)
+            log.debug("Executing update query", extra={"statement": self.query})
+            _timed(cursor, self.query, self.params)
             conn.commit()
             cursor.close()
             return True
         except Exception as e:
-            print(f"Query execution error: {e}")
+            log.error("Query execution error: %s", e,
+                      extra={"statement": self.query})
+            return False
+
+    def execute_many(self, params_list: list[tuple]):
+        """
+        Execute the statement once per params tuple in a single commit.
+        """
+        global conn
+        verify_conn()
+
+        if not conn:
             return False
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        try:
+            cursor = conn.cursor()
+            log.debug("Executing batch query", extra={
+                      "statement": self.query, "param_sets": len(params_list)})
+            _timed(cursor, self.query, params_list, many=True)
+            conn.commit()
+            cursor.close()
+            return True
+        except Exception as e:
+            log.error("Query execution error: %s", e,
+                      extra={"statement": self.query})
+            return False
+
+
+# Per-thread connections reserved for transactions
+_tx_local = threading.local()
+
+
+class DbTransaction:
+    """
+    Run several statements atomically on the calling thread's transaction connection.
+    The shared connection is rolled back before every DbUtils call, so it can't hold a transaction.
+    Commits on a clean exit of the with-block and rolls back on any exception.
+    """
+
+    def __init__(self):
+        self.conn = None
+
+    def __enter__(self):
+        conn = getattr(_tx_local, "conn", None)
+        if not conn or not conn.is_connected():
+            conn = get_db_connection()
+            _tx_local.conn = conn
+        if not conn:
+            raise ConnectionError("No database connection for transaction")
+        self.conn = conn
+        self.conn.start_transaction()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.commit()  # type: ignore
+        else:
+            self.conn.rollback()  # type: ignore
+        return False
+
+    def execute_single(self, query: str, params: tuple = ()):
+        cursor = self.conn.cursor(dictionary=True)  # type: ignore
+        log.debug("Executing transaction query", extra={"statement": query})
+        _timed(cursor, query, params)
+        result = cursor.fetchone()
+        cursor.close()
+        return result
+
+    def execute_update(self, query: str, params: tuple = ()) -> int:
+        """
+        Execute a write and return the number of affected rows.
+        """
+        cursor = self.conn.cursor()  # type: ignore
+        log.debug("Executing transaction update", extra={"statement": query})
+        _timed(cursor, query, params)
+        affected = cursor.rowcount
+        cursor.close()
+        return affected
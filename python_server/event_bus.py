@@ -0,0 +1,234 @@
+from abc import ABC, abstractmethod
+from queue import Full, Queue
+import base64
+import json
+import logs
+import os
+import socket
+import threading
+import time
+from typing import Callable
+
+log = logs.get("bus")
+
+# Frames the broker buffers per worker, a worker further behind is disconnected and reconnects
+BROKER_QUEUE_SIZE = int(os.environ.get("EVENT_BROKER_QUEUE_SIZE", 10000))
+
+
+class EventBus(ABC):
+    """
+    Carries dispatched events to every server process.
+    Each process subscribes once and must receive all events, in the same order as every other process.
+    """
+
+    @abstractmethod
+    def subscribe(self, handler: Callable[[dict], None]):
+        pass
+
+    @abstractmethod
+    def publish(self, event: dict):
+        pass
+
+
+class LocalBus(EventBus):
+    """
+    Single-process bus, events are handled on the publishing thread.
+    """
+
+    def __init__(self):
+        self._handler: Callable[[dict], None] | None = None
+
+    def subscribe(self, handler: Callable[[dict], None]):
+        self._handler = handler
+
+    def publish(self, event: dict):
+        if self._handler:
+            self._handler(event)
+
+
+def _encode(event: dict) -> bytes:
+    body = json.dumps({
+        "prefix": event.get("prefix", ""),
+        "data": base64.b64encode(event.get("data", b"")).decode(),
+        "recipients": list(event.get("recipients", [])),
+        "chat_id": event.get("chat_id"),
+    }).encode()
+    return len(body).to_bytes(4, 'big') + body
+
+
+def _decode(body: bytes) -> dict:
+    event = json.loads(body)
+    event["data"] = base64.b64decode(event["data"])
+    return event
+
+
+def _recv_exact(conn: socket.socket, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            return b""
+        data += chunk
+    return data
+
+
+def _recv_frame(conn: socket.socket) -> bytes:
+    header = _recv_exact(conn, 4)
+    if not header:
+        return b""
+    return _recv_exact(conn, int.from_bytes(header, 'big'))
+
+
+class UnixSocketBus(EventBus):
+    """
+    Client of the local broker started by run_broker(). Published events go to the broker,
+    which relays them back to every worker, including this one, in one global order.
+    """
+
+    def __init__(self, path: str, connect_timeout: float = 10):
+        self.path = path
+        self.connect_timeout = connect_timeout
+        self._sock = self._connect()
+        self._send_lock = threading.Lock()
+
+    def _connect(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        deadline = time.time() + self.connect_timeout
+        while True:
+            try:
+                sock.connect(self.path)
+                return sock
+            except OSError:
+                if time.time() > deadline:
+                    sock.close()
+                    raise
+                time.sleep(0.05)
+
+    def subscribe(self, handler: Callable[[dict], None]):
+        threading.Thread(target=self._receive, args=(handler,),
+                         name="EventBusReader", daemon=True).start()
+
+    def publish(self, event: dict):
+        frame = _encode(event)
+        with self._send_lock:
+            try:
+                self._sock.sendall(frame)
+            except OSError as e:
+                # The reader thread reconnects, this event is lost like those missed meanwhile
+                log.error("Dropping event, event bus unavailable: %s", e)
+
+    def _receive(self, handler: Callable[[dict], None]):
+        while True:
+            body = _recv_frame(self._sock)
+            if not body:
+                # Closed by the broker, e.g. after falling behind, events until reconnecting are lost
+                log.warning("Event bus connection to %s closed, reconnecting", self.path)
+                try:
+                    sock = self._connect()
+                except OSError as e:
+                    log.error("Could not reconnect to event bus %s: %s", self.path, e)
+                    return
+                with self._send_lock:
+                    self._sock.close()
+                    self._sock = sock
+                continue
+            try:
+                handler(_decode(body))
+            except Exception as e:
+                log.error("Error handling bus event: %s", e)
+
+
+class _BrokerWorker:
+    """
+    A worker connected to the broker, with its own outbound queue and writer thread
+    so a worker that stops reading only delays itself.
+    """
+
+    def __init__(self, conn: socket.socket):
+        self.conn = conn
+        self.queue: Queue = Queue(BROKER_QUEUE_SIZE)
+        threading.Thread(target=self._write, name="BrokerWriter",
+                         daemon=True).start()
+
+    def offer(self, frame: bytes) -> bool:
+        """
+        Queue a frame without blocking, False if the worker is too far behind.
+        """
+        try:
+            self.queue.put_nowait(frame)
+            return True
+        except Full:
+            return False
+
+    def _write(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                return
+            try:
+                self.conn.sendall(frame)
+            except OSError:
+                return
+
+    def close(self):
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.queue.put_nowait(None)
+        except Full:
+            pass
+
+
+def run_broker(path: str):
+    """
+    Relay every frame received from a worker to all connected workers.
+    Frames are queued to every worker one at a time, which gives every worker the same event order.
+    """
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(64)
+    log.info("Event broker listening on %s", path)
+
+    workers: dict[socket.socket, _BrokerWorker] = {}
+    relay_lock = threading.Lock()
+
+    def relay(conn: socket.socket):
+        while True:
+            body = _recv_frame(conn)
+            if not body:
+                break
+            frame = len(body).to_bytes(4, 'big') + body
+            with relay_lock:
+                for worker in list(workers.values()):
+                    if not worker.offer(frame):
+                        log.error("Worker fell %d events behind, disconnecting it",
+                                  BROKER_QUEUE_SIZE)
+                        del workers[worker.conn]
+                        worker.close()
+        with relay_lock:
+            worker = workers.pop(conn, None)
+        if worker:
+            worker.close()
+        conn.close()
+
+    while True:
+        conn, _ = server.accept()
+        with relay_lock:
+            workers[conn] = _BrokerWorker(conn)
+        threading.Thread(target=relay, args=(conn,), daemon=True).start()
+
+
+def create_bus(spec: str) -> EventBus:
+    """
+    Build a bus from EVENT_BUS: "local" or "unix:<socket path>".
+    Other brokers plug in by subclassing EventBus and adding a scheme here.
+    """
+    if not spec or spec == "local":
+        return LocalBus()
+    if spec.startswith("unix:"):
+        return UnixSocketBus(spec[len("unix:"):])
+    raise ValueError(f"Unknown event bus: {spec}")
@@ -1,7 +1,29 @@
-from queue import Queue
+from queue import Empty, Queue
+from collections import OrderedDict, deque
 from typing import Dict, List
 from connection import Connection
+from event_bus import EventBus, LocalBus
+import logs
+import metrics
+import os
+import secrets
+import threading
 import time
+import tracing
+
+log = logs.get("events")
+
+# Recent events kept per chat for resuming clients, bounded by count and by payload bytes
+EVENT_RING_SIZE = int(os.environ.get("EVENT_RING_SIZE", 256))
+EVENT_RING_BYTES = int(os.environ.get("EVENT_RING_BYTES", 256 * 1024))
+# Chats keeping a ring, the one written least recently is dropped first
+EVENT_RINGS = int(os.environ.get("EVENT_RINGS", 1024))
+
+# Events carrying a 'coalesce_key' are held this long and only the latest per recipient is sent
+COALESCE_WINDOW = float(os.environ.get("EVENT_COALESCE_MS", 100)) / 1000
+
+# Sequence numbers restart with the process, clients must present the epoch they were issued under
+epoch = secrets.token_hex(4)
 
 # Thread-safe queue for events
 event_queue: Queue = Queue()
@@ -9,6 +31,41 @@ event_queue: Queue = Queue()
 # Mapping of user IDs to their active connections
 user_connections: Dict[str, List[Connection]] = {}
 
+# Time each user's last connection closed, for reconnect grace windows
+last_disconnect: Dict[str, float] = {}
+
+
+class EventRing:
+    """
+    Bounded buffer of a chat's most recent events: (seq, prefix, data, recipients).
+    """
+
+    def __init__(self, last_seq: int = 0):
+        self.events: deque = deque()
+        self.size = 0
+        self.last_seq = last_seq
+
+    def append(self, prefix: str, data: bytes, recipients: List[str]) -> int:
+        self.last_seq += 1
+        self.events.append((self.last_seq, prefix, data, frozenset(recipients)))
+        self.size += len(data)
+        while self.events and (len(self.events) > EVENT_RING_SIZE or self.size > EVENT_RING_BYTES):
+            self.size -= len(self.events.popleft()[2])
+        return self.last_seq
+
+
+# Per-chat event rings in write order, written by the event thread and read by resuming clients
+_rings: OrderedDict[str, EventRing] = OrderedDict()
+# Last seq of chats whose ring was dropped, a new ring continues from it so seqs are never reused
+_dropped_seqs: Dict[str, int] = {}
+_rings_lock = threading.Lock()
+
+# Carries events to the process holding each recipient's connection, see set_bus()
+_bus: EventBus
+
+# Snapshots held for coalescing: (coalesce_key, uid) -> (due time, event), event thread only
+_coalescing: Dict[tuple[str, str], tuple[float, dict]] = {}
+
 
 def register_connection(uid: str, conn: Connection):
     """
@@ -17,6 +74,7 @@ def register_connection(uid: str, conn: Connection):
     conns = user_connections.setdefault(uid, [])
     if conn not in conns:
         conns.append(conn)
+    last_disconnect.pop(uid, None)
 
 
 def unregister_connection(uid: str, conn: Connection):
@@ -28,6 +86,30 @@ def unregister_connection(uid: str, conn: Connection):
         conns.remove(conn)
         if not conns:
             del user_connections[uid]
+            last_disconnect[uid] = time.time()
+
+
+def is_connected(uid: str) -> bool:
+    """
+    Whether the user has at least one live connection receiving events.
+    """
+    return bool(user_connections.get(uid))
+
+
+def disconnected_at(uid: str) -> float | None:
+    """
+    When the user's last connection closed, None if connected or not seen since startup.
+    """
+    return last_disconnect.get(uid)
+
+
+def set_bus(bus: EventBus):
+    """
+    Route dispatched events through another bus, e.g. the broker shared by forked workers.
+    """
+    global _bus
+    _bus = bus
+    bus.subscribe(_dispatch)
 
 
 def emit_event(event: dict):
@@ -38,29 +120,148 @@ def emit_event(event: dict):
         - 'prefix': 4-char command prefix
         - 'data': bytes payload
         - 'recipients': list of user IDs to notify
+        - 'chat_id': optional, numbers the event in the chat's sequence and keeps it for replay
+        - 'coalesce_key': optional, e.g. an assertion id; within COALESCE_WINDOW only the
+          latest event with the same key is delivered to each recipient
     """
+    event['queued_at'] = time.perf_counter()
+    event['trace'] = tracing.current_context()
     event_queue.put(event)
 
 
+def sequenced_frame(chat_id: str, seq: int, prefix: str, data: bytes) -> bytes:
+    """
+    Payload of a "sevt" frame: "{chat_id},{seq},{prefix}{data}".
+    """
+    return f"{chat_id},{seq},{prefix}".encode() + data
+
+
+def replay_events(chat_id: str, since: int, uid: str) -> tuple[list[tuple[int, str, bytes]] | None, int]:
+    """
+    Events after `since` in a chat that were addressed to uid, and the chat's latest seq.
+    Returns None instead of the list when events in the gap were already evicted.
+    """
+    with _rings_lock:
+        ring = _rings.get(chat_id)
+        if not ring:
+            last_seq = _dropped_seqs.get(chat_id, 0)
+            return ([] if since == last_seq else None), last_seq
+        events = list(ring.events)
+        last_seq = ring.last_seq
+
+    if since > last_seq:
+        return None, last_seq
+    oldest = events[0][0] if events else last_seq + 1
+    if since < oldest - 1:
+        return None, last_seq
+    return [(seq, prefix, data) for seq, prefix, data, recipients in events
+            if seq > since and uid in recipients], last_seq
+
+
+def _dispatch(event: dict):
+    """
+    Number the event in its chat's sequence and send it to every local connection of its recipients.
+    Runs for every event on the bus, in every process.
+    """
+    prefix = event.get('prefix', '')
+    data = event.get('data', b'')
+    recipients = event.get('recipients', [])
+    chat_id = event.get('chat_id')
+
+    seq = 0
+    if chat_id:
+        chat_id = str(chat_id)
+        with _rings_lock:
+            ring = _rings.get(chat_id)
+            if ring is None:
+                ring = _rings[chat_id] = EventRing(
+                    _dropped_seqs.pop(chat_id, 0))
+                if len(_rings) > EVENT_RINGS:
+                    dropped_id, dropped = _rings.popitem(last=False)
+                    _dropped_seqs[dropped_id] = dropped.last_seq
+                    metrics.inc("event_rings_dropped_total")
+            else:
+                _rings.move_to_end(chat_id)
+            seq = ring.append(prefix, data, recipients)
+
+    for uid in recipients:
+        conns = user_connections.get(uid, [])
+        for conn in conns:
+            try:
+                if seq and conn.event_seq:
+                    conn.send("sevt", sequenced_frame(
+                        chat_id, seq, prefix, data))  # type: ignore
+                else:
+                    conn.send(prefix, data)
+            except Exception as e:
+                log.warning("Error sending event", extra={
+                            "prefix": prefix, "error": str(e)})
+
+
+def _coalesce(event: dict, now: float):
+    """
+    Hold the event per recipient, replacing any older snapshot with the same coalesce key.
+    """
+    key = event['coalesce_key']
+    for uid in event.get('recipients', []):
+        held = _coalescing.get((key, uid))
+        due = held[0] if held else now + COALESCE_WINDOW
+        _coalescing[(key, uid)] = (due, event)
+
+
+def _flush_coalesced(now: float) -> float | None:
+    """
+    Dispatch held snapshots whose window elapsed, one event per distinct snapshot.
+    Returns the time the next held snapshot is due, if any.
+    """
+    ready: Dict[int, tuple[dict, List[str]]] = {}
+    next_due = None
+    for (key, uid), (due, event) in list(_coalescing.items()):
+        if due <= now:
+            del _coalescing[(key, uid)]
+            ready.setdefault(id(event), (event, []))[1].append(uid)
+        elif next_due is None or due < next_due:
+            next_due = due
+
+    for event, recipients in ready.values():
+        _bus.publish({**event, 'recipients': recipients})
+    return next_due
+
+
 def process_events():
     """
     Background worker to process and dispatch events.
     """
+    next_due = None
     while True:
-        event = event_queue.get()
+        timeout = max(0.0, next_due - time.time()) if next_due else None
+        try:
+            event = event_queue.get(timeout=timeout)
+        except Empty:
+            next_due = _flush_coalesced(time.time())
+            continue
         if event is None:
             break
-        time.sleep(0.01)
+        lag = time.perf_counter() - event.pop('queued_at')
+        metrics.observe("event_dispatch_lag_seconds", lag)
+        trace = event.pop('trace')
+        tracing.record(trace, "event.queue", time.time() - lag, lag)
         try:
-            prefix = event.get('prefix', '')
-            data = event.get('data', b'')
-            recipients = event.get('recipients', [])
-            for uid in recipients:
-                conns = user_connections.get(uid, [])
-                for conn in conns:
-                    try:
-                        conn.send(prefix, data)
-                    except Exception as e:
-                        print(f"Error sending event to {uid}: {e}")
+            if event.get('coalesce_key'):
+                _coalesce(event, time.time())
+                if next_due is None:
+                    next_due = time.time() + COALESCE_WINDOW
+            else:
+                with tracing.resumed(trace, "event.dispatch", prefix=event.get('prefix', '')):
+                    _bus.publish(event)
         finally:
             event_queue.task_done()
+        if next_due and next_due <= time.time():
+            next_due = _flush_coalesced(time.time())
+
+
+metrics.gauge("event_queue_depth", lambda: {(): event_queue.qsize()})
+metrics.gauge("event_rings", lambda: {(): len(_rings)})
+
+# Single process by default, main.py installs the shared bus for forked workers
+set_bus(LocalBus())
@@ -0,0 +1,96 @@
+from queue import Queue
+from typing import Callable
+import logs
+import threading
+import time
+import zlib
+
+
+log = logs.get("executor")
+
+
+class _Shard:
+    def __init__(self, index: int, queue_size: int):
+        self.index = index
+        self.queue: Queue = Queue(queue_size)
+        self.processed = 0
+        self.dropped = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+
+
+class ShardedExecutor:
+    """
+    Bounded worker pool where every key is pinned to one worker thread.
+    Tasks submitted with the same key run one at a time in submission order.
+    Each worker queues at most queue_size tasks (0 for no limit), submitting to a full one blocks.
+    """
+
+    def __init__(self, size: int, name: str = "Worker", queue_size: int = 0):
+        self._shards = [_Shard(i, queue_size) for i in range(max(1, size))]
+        self._threads = [
+            threading.Thread(target=self._run, args=(shard,),
+                             name=f"{name}-{shard.index}", daemon=True)
+            for shard in self._shards
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def __len__(self):
+        return len(self._shards)
+
+    def submit(self, key: str, fn, *args, cancelled: Callable[[], bool] | None = None):
+        """
+        Queue fn(*args) on the worker that owns this key, waiting while its queue is full.
+        The task is dropped instead of run if cancelled() is true by the time it is dequeued.
+        """
+        shard = self._shards[zlib.crc32(key.encode()) % len(self._shards)]
+        shard.queue.put((time.perf_counter(), fn, args, cancelled))
+
+    def shutdown(self):
+        """
+        Let every worker finish its queue, then stop.
+        """
+        for shard in self._shards:
+            shard.queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def stats(self) -> list[dict[str, float]]:
+        """
+        Per-shard queue depth, tasks run and dropped, and average/max queue wait and run time in seconds.
+        """
+        return [{
+            "shard": shard.index,
+            "depth": shard.queue.qsize(),
+            "processed": shard.processed,
+            "dropped": shard.dropped,
+            "wait_avg": shard.wait_total / shard.processed if shard.processed else 0.0,
+            "wait_max": shard.wait_max,
+            "run_avg": shard.run_total / shard.processed if shard.processed else 0.0,
+        } for shard in self._shards]
+
+    def _run(self, shard: _Shard):
+        while True:
+            task = shard.queue.get()
+            if task is None:
+                break
+            queued_at, fn, args, cancelled = task
+            if cancelled and cancelled():
+                shard.dropped += 1
+                continue
+            started = time.perf_counter()
+            try:
+                fn(*args)
+            except Exception as e:
+                log.exception("Error in worker task %s: %s",
+                              getattr(fn, '__qualname__', fn), e)
+            finally:
+                finished = time.perf_counter()
+                wait = started - queued_at
+                # Only this thread writes the shard counters
+                shard.processed += 1
+                shard.wait_total += wait
+                shard.wait_max = max(shard.wait_max, wait)
+                shard.run_total += finished - started
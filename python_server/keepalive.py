@@ -0,0 +1,123 @@
+"""
+Server-driven keepalives and idle connection reaping.
+
+Every authenticated connection sits in a timer wheel, due KEEPALIVE_INTERVAL after the last
+frame it sent. When it comes due, a connection that was active in the meantime is simply
+rescheduled. A silent one is sent a "ping" frame, which clients answer with "pingack", and
+it is shut down once it has been silent for IDLE_TIMEOUT. The shutdown wakes handle_client,
+which unregisters it, and fails any send blocked on the dead socket.
+
+Receiving a frame only stores a timestamp, so activity costs nothing here. The wheel does
+O(1) work per connection per KEEPALIVE_INTERVAL, however many connections are open.
+"""
+from connection import Connection
+import logs
+import math
+import metrics
+import os
+import threading
+import time
+
+# 0 turns keepalives and reaping off
+IDLE_TIMEOUT = float(os.environ.get("IDLE_TIMEOUT_S", 120))
+KEEPALIVE_INTERVAL = float(os.environ.get("KEEPALIVE_INTERVAL_S", 30))
+TICK = float(os.environ.get("KEEPALIVE_TICK_S", 1))
+
+log = logs.get("keepalive")
+
+
+class TimerWheel:
+    """
+    Hashed timing wheel: one set of items per tick, scheduling and cancelling are O(1).
+    Delays longer than the wheel are clamped to its span.
+    """
+
+    def __init__(self, tick: float, span: float):
+        self.tick = tick
+        self._slots: list[set] = [set() for _ in range(int(math.ceil(span / tick)) + 1)]
+        # item -> index of the slot holding it
+        self._index: dict = {}
+        self._lock = threading.Lock()
+        self._current = int(time.monotonic() / tick)
+
+    def __len__(self):
+        return len(self._index)
+
+    def schedule(self, item, delay: float):
+        ticks = min(len(self._slots) - 1, max(1, int(math.ceil(delay / self.tick))))
+        with self._lock:
+            old = self._index.get(item)
+            if old is not None:
+                self._slots[old].discard(item)
+            slot = (self._current + ticks) % len(self._slots)
+            self._slots[slot].add(item)
+            self._index[item] = slot
+
+    def cancel(self, item):
+        with self._lock:
+            slot = self._index.pop(item, None)
+            if slot is not None:
+                self._slots[slot].discard(item)
+
+    def advance(self, now: float) -> list:
+        """
+        Move the wheel up to `now` and return the items that came due.
+        """
+        target = int(now / self.tick)
+        due = []
+        with self._lock:
+            while self._current < target:
+                self._current += 1
+                slot = self._current % len(self._slots)
+                for item in self._slots[slot]:
+                    del self._index[item]
+                due.extend(self._slots[slot])
+                self._slots[slot] = set()
+        return due
+
+
+_wheel = TimerWheel(TICK, max(IDLE_TIMEOUT, KEEPALIVE_INTERVAL) or TICK)
+
+
+def track(connection: Connection):
+    if IDLE_TIMEOUT:
+        _wheel.schedule(connection, KEEPALIVE_INTERVAL)
+
+
+def untrack(connection: Connection):
+    _wheel.cancel(connection)
+
+
+def _check(connection: Connection, now: float):
+    silent = now - connection.last_active
+    if silent < KEEPALIVE_INTERVAL:
+        _wheel.schedule(connection, KEEPALIVE_INTERVAL - silent)
+        return
+
+    if silent >= IDLE_TIMEOUT or not connection.try_send("ping", b"ping"):
+        # Silent too long, or not even a tiny frame fits in its send buffer
+        metrics.inc("connections_reaped_total")
+        log.info("Closing idle connection", extra={
+                 "peer": f"{connection.addr[0]}:{connection.addr[1]}", "silent_s": int(silent)})
+        connection.shutdown()
+        return
+
+    metrics.inc("keepalives_sent_total")
+    _wheel.schedule(connection, min(KEEPALIVE_INTERVAL, IDLE_TIMEOUT - silent))
+
+
+def process_idle():
+    """
+    Background worker that turns the wheel every tick.
+    """
+    while True:
+        time.sleep(TICK)
+        now = time.monotonic()
+        for connection in _wheel.advance(now):
+            try:
+                _check(connection, now)
+            except Exception as e:
+                log.error("Error checking idle connection: %s", e)
+
+
+metrics.gauge("keepalive_tracked", lambda: {(): len(_wheel)})
@@ -0,0 +1,122 @@
+from contextlib import contextmanager
+import logs
+import threading
+import tracing
+import os
+import time
+import zlib
+
+# Waits longer than this are logged as they happen
+SLOW_WAIT = float(os.environ.get("LOCK_SLOW_WAIT_MS", 100)) / 1000
+
+log = logs.get("locks")
+
+# Lock wait time per command: name -> [acquisitions, total seconds, max seconds]
+_wait_stats: dict[str, list] = {}
+_wait_stats_lock = threading.Lock()
+
+
+def record_wait(command: str, seconds: float):
+    if seconds >= SLOW_WAIT:
+        log.info("Slow lock wait", extra={
+                 "command": command or "unknown", "wait_ms": round(seconds * 1000, 1)})
+    with _wait_stats_lock:
+        entry = _wait_stats.setdefault(command, [0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+
+
+def lock_wait_stats() -> dict[str, dict[str, float]]:
+    """
+    Snapshot of lock wait times per command, in seconds.
+    """
+    with _wait_stats_lock:
+        return {
+            command: {
+                "count": count,
+                "total": total,
+                "avg": total / count if count else 0.0,
+                "max": longest,
+            }
+            for command, (count, total, longest) in _wait_stats.items()
+        }
+
+
+class ReadWriteLock:
+    """
+    Many concurrent readers or a single writer.
+    Waiting writers block new readers so a steady stream of reads can't starve them.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    def acquire_read(self):
+        with self._condition:
+            while self._writer or self._waiting_writers:
+                self._condition.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._condition:
+            self._readers -= 1
+            if not self._readers:
+                self._condition.notify_all()
+
+    def acquire_write(self):
+        with self._condition:
+            self._waiting_writers += 1
+            try:
+                while self._writer or self._readers:
+                    self._condition.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = True
+
+    def release_write(self):
+        with self._condition:
+            self._writer = False
+            self._condition.notify_all()
+
+    @contextmanager
+    def read(self, command: str = ""):
+        start = time.perf_counter()
+        with tracing.span("lock.read", command=command):
+            self.acquire_read()
+        record_wait(command, time.perf_counter() - start)
+        try:
+            yield self
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self, command: str = ""):
+        start = time.perf_counter()
+        with tracing.span("lock.write", command=command):
+            self.acquire_write()
+        record_wait(command, time.perf_counter() - start)
+        try:
+            yield self
+        finally:
+            self.release_write()
+
+
+class StripedLockTable:
+    """
+    Fixed-size table of reader/writer locks shared by hashing keys onto stripes.
+    Memory stays constant however many keys clients send, and lookups take no global lock.
+    Unrelated keys may share a stripe, so never hold two stripes at once.
+    """
+
+    def __init__(self, stripes: int):
+        self._locks = [ReadWriteLock() for _ in range(max(1, stripes))]
+
+    def __len__(self):
+        return len(self._locks)
+
+    def get(self, key: str) -> ReadWriteLock:
+        return self._locks[zlib.crc32(key.encode()) % len(self._locks)]
@@ -0,0 +1,168 @@
+"""
+Leveled, structured logging that never blocks the thread that logs.
+
+Records go through a bounded queue to a single writer thread, so client and worker threads
+don't contend on stdout. Every module logs under its own category (predictrix.<category>),
+each category is rate limited, and disabled levels cost one cached level check.
+Pass fields with extra={...}, they are appended as key=value or become JSON keys.
+
+    LOG_LEVEL       DEBUG, INFO (default), WARNING, ERROR
+    LOG_FORMAT      text (default) or json, one object per line
+    LOG_RATE        records per second allowed per category, bursts up to LOG_BURST
+    LOG_QUEUE_SIZE  records buffered for the writer, further records are dropped and counted
+"""
+# Levels re-exported for log.isEnabledFor() checks
+from logging import DEBUG, INFO, WARNING, ERROR
+from logging.handlers import QueueHandler, QueueListener
+from dotenv import load_dotenv
+from queue import Full, Queue
+import atexit
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+# Connection modules may import this before db_connector loads .env
+load_dotenv()
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+LOG_RATE = float(os.environ.get("LOG_RATE", 200))
+LOG_BURST = float(os.environ.get("LOG_BURST", 1000))
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+
+# Attributes every LogRecord has, anything else came in through extra=
+_STANDARD = set(logging.makeLogRecord({}).__dict__) | {"message", "asctime"}
+
+_stats = {"dropped": 0, "suppressed": 0}
+
+
+class _RateLimit(logging.Filter):
+    """
+    Token bucket per category. Errors always pass, the first record let through after
+    suppression carries the number of records skipped.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._buckets: dict[str, list[float]] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(record.name)
+            if bucket is None:
+                # [tokens, last refill, suppressed since last pass]
+                bucket = self._buckets[record.name] = [LOG_BURST, now, 0]
+            bucket[0] = min(LOG_BURST, bucket[0] + (now - bucket[1]) * LOG_RATE)
+            bucket[1] = now
+            if bucket[0] < 1 and record.levelno < logging.ERROR:
+                bucket[2] += 1
+                _stats["suppressed"] += 1
+                return False
+            bucket[0] -= 1
+            suppressed, bucket[2] = bucket[2], 0
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """
+    Enqueue without blocking, dropping the record when the writer is behind.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Format args on the writer thread instead, only exceptions must be rendered here
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            _stats["dropped"] += 1
+
+
+def _fields(record: logging.LogRecord) -> dict:
+    return {k: v for k, v in record.__dict__.items() if k not in _STANDARD}
+
+
+class _TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        line = (f"{self.formatTime(record)} {record.levelname:<7} "
+                f"{record.name.removeprefix('predictrix.')}: {record.getMessage()}")
+        fields = _fields(record)
+        if fields:
+            line += " " + " ".join(f"{k}={v}" for k, v in fields.items())
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": record.created,
+            "level": record.levelname,
+            "category": record.name.removeprefix("predictrix."),
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+            **_fields(record),
+        }
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+_root = logging.getLogger("predictrix")
+_root.setLevel(LOG_LEVEL)
+_root.propagate = False
+
+_output = logging.StreamHandler(sys.stdout)
+_output.setFormatter(_JsonFormatter() if LOG_FORMAT == "json" else _TextFormatter())
+
+_handler = _DroppingQueueHandler(Queue(LOG_QUEUE_SIZE))
+_handler.addFilter(_RateLimit())
+_root.addHandler(_handler)
+
+_listener = QueueListener(_handler.queue, _output)
+_listener.start()
+
+
+def _restart_after_fork():
+    # The writer thread doesn't survive fork, forked workers get their own
+    global _listener
+    _handler.queue = Queue(LOG_QUEUE_SIZE)
+    _listener = QueueListener(_handler.queue, _output)
+    _listener.start()
+
+
+os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+def get(category: str) -> logging.Logger:
+    return logging.getLogger(f"predictrix.{category}")
+
+
+def stats() -> dict[str, int]:
+    """
+    Records dropped because the queue was full and suppressed by rate limiting.
+    """
+    return dict(_stats)
+
+
+def flush():
+    """
+    Write out everything queued, e.g. before the process exits.
+    """
+    _listener.stop()
+    _listener.start()
+
+
+atexit.register(lambda: _listener.stop())
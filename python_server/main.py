@@ -1,45 +1,144 @@
 import socket
 import threading
 import controllers
-from connection import Connection
+import os
+from executor import ShardedExecutor
+from connection import Connection, RequestConnection
+from event_bus import create_bus, run_broker
+from locks import lock_wait_stats
+import admission
 import event_framework
+import keepalive
+import assertion_scheduler
+import message_sender
+import message_log
+import logs
+import metrics
+import profiler
+import traffic_trace
+import tracing
+import signal
+import time
 
 from Crypto.PublicKey import RSA
 from Crypto.Cipher import AES, PKCS1_OAEP
 from Crypto.Random import get_random_bytes
 
 
+PORT = int(os.environ.get("PORT", 32782))
+
+# More than one worker forks processes that share the port through SO_REUSEPORT
+SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", 1))
+
+# Forked workers exchange events through the local broker unless another bus is configured
+EVENT_BUS = os.environ.get(
+    "EVENT_BUS", "unix:/tmp/predictrix-events.sock" if SERVER_WORKERS > 1 else "local")
+
+log = logs.get("server")
+
 controller_instances = {inst.name(
 ): inst for cls in controllers.Controller.__subclasses__() for inst in [cls()]}
 
-s = socket.socket()
-s.bind(("0.0.0.0", 32782))
+# Controllers run here, sharded so commands with the same key stay ordered
+worker_pool: ShardedExecutor
+
+_command_labels = {name: (("command", name),) for name in controller_instances}
+
+
+def start_background_threads(primary: bool):
+    """
+    Start the worker pool and background threads of this server process.
+    Only the primary process loads pending assertions, the others schedule the ones they create.
+    """
+    global worker_pool
+    # A full worker queue blocks the reader threads submitting to it, pushing back on their clients
+    worker_pool = ShardedExecutor(
+        int(os.environ.get("WORKER_POOL_SIZE", 8)), name="CommandWorker",
+        queue_size=int(os.environ.get("WORKER_QUEUE_SIZE", 1000)))
+
+    metrics.collector("worker_pool", worker_pool.stats)
+    metrics.collector("lock_waits", lock_wait_stats)
+    metrics.collector("push", message_sender.stats)
+    metrics.collector("group_commit", message_log.stats)
+    metrics.collector("logging", logs.stats)
+
+    if EVENT_BUS != "local":
+        event_framework.set_bus(create_bus(EVENT_BUS))
+
+    # Start background event processing thread
+    event_thread = threading.Thread(
+        target=event_framework.process_events,
+        name="EventProcessor",
+        daemon=True
+    )
+    event_thread.start()
+
+    # Start background assertion completion thread
+    scheduler_thread = threading.Thread(
+        target=assertion_scheduler.process_deadlines,
+        args=(primary,),
+        name="AssertionScheduler",
+        daemon=True
+    )
+    scheduler_thread.start()
+
+    # Start background push notification threads
+    push_thread = threading.Thread(
+        target=message_sender.process_pending,
+        name="PushCoalescer",
+        daemon=True
+    )
+    push_thread.start()
+    for i in range(message_sender.WORKER_COUNT):
+        threading.Thread(
+            target=message_sender.process_batches,
+            name=f"PushWorker-{i}",
+            daemon=True
+        ).start()
 
-s.listen(5)
-print("Server is listening on port 32782...")
+    # Start background idle connection reaper
+    if keepalive.IDLE_TIMEOUT:
+        threading.Thread(
+            target=keepalive.process_idle,
+            name="IdleReaper",
+            daemon=True
+        ).start()
 
-# Start background event processing thread
-event_thread = threading.Thread(
-    target=event_framework.process_events,
-    name="EventProcessor",
-    daemon=True
-)
-event_thread.start()
+    # Start background thread for profiles requested by SIGUSR1
+    threading.Thread(
+        target=profiler.process_requests,
+        name="ProfileRequests",
+        daemon=True
+    ).start()
 
+    # Start background group commit flusher
+    if message_log.GROUP_COMMIT:
+        threading.Thread(
+            target=message_log.process_flushes,
+            name="MessageFlusher",
+            daemon=True
+        ).start()
 
-def key_exchange(connection: Connection):
-    rsa_key = RSA.generate(2048)
+
+def key_exchange(connection: Connection, rsa_key: RSA.RsaKey):
     pub = rsa_key.publickey()
     connection.send("", pub.export_key(format="PEM"))
 
+    # One deadline for every read, a client that never answers only holds its own thread
+    deadline = time.monotonic() + admission.HANDSHAKE_READ_TIMEOUT
     encrypted_session_key = b""
     reattempt = 0
     while len(encrypted_session_key) != 256 and reattempt < 5:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("No session key from client")
+        connection.conn.settimeout(remaining)
         encrypted_session_key = connection.recv()
-        print(
-            f"Encrypted session key length: {len(encrypted_session_key)}")
+        log.debug("Encrypted session key received",
+                  extra={"length": len(encrypted_session_key)})
         reattempt += 1
-    session_key = PKCS1_OAEP.new(rsa_key).decrypt(encrypted_session_key)
+    with admission.handshake_slot():
+        session_key = PKCS1_OAEP.new(rsa_key).decrypt(encrypted_session_key)
 
     # Generate fresh 16-byte nonce and send raw so Dart client can read
     final_nonce = get_random_bytes(16)
@@ -49,64 +148,251 @@ def key_exchange(connection: Connection):
     connection.set_aes_cipher(aes, session_key)
 
 
+def measured(cmd: str, handle):
+    """
+    Wrap a controller's handle so its latency is recorded from now (frame arrival),
+    including the wait for a worker.
+    """
+    received = time.perf_counter()
+    labels = _command_labels[cmd]
+
+    def run(connection, payload: str):
+        profiling = profiler.active
+        if profiling:
+            profiler.enter(cmd)
+        try:
+            return handle(connection, payload)
+        finally:
+            metrics.observe("command_seconds",
+                            time.perf_counter() - received, labels)
+            if profiling:
+                profiler.leave(cmd)
+
+    return run
+
+
 def handle_client(connection: Connection):
-    print(f"Connection from {connection.addr} has been established.")
+    peer = f"{connection.addr[0]}:{connection.addr[1]}"
+    log.debug("Connection established", extra={"peer": peer})
+    metrics.inc("connections_total")
+    started = time.perf_counter()
+    try:
+        with admission.handshake_slot():
+            rsa_key = RSA.generate(2048)
+    except admission.HandshakeBusy:
+        admission.shed(connection.conn, connection.addr, "handshake_timeout")
+        return
     try:
-        key_exchange(connection)
+        key_exchange(connection, rsa_key)
     except:
+        metrics.inc("handshake_failures_total")
         connection.close()
-        print(
-            f"Key exchange failed with {connection.addr}. Closing connection.")
+        log.warning("Key exchange failed, closing connection",
+                    extra={"peer": peer})
         return
-    print(f"Key exchange successful with {connection.addr}.")
-
-    # token = connection.recv().decode()
-    # print(f"Token received from {connection.addr}: {token}")
+    metrics.observe("handshake_seconds", time.perf_counter() - started)
+    metrics.inc("connections_active")
+    log.debug("Key exchange successful", extra={"peer": peer})
 
     connection.conn.settimeout(None)
+    keepalive.track(connection)
+
+    trace_id = traffic_trace.open_connection() if traffic_trace.TRACE_FILE else None
+
+    try:
+        while True:
+            data = connection.recv()
+            if not data or data == b"":
+                break
+
+            try:
+                decoded = data.decode()
+            except UnicodeDecodeError:
+                metrics.inc("commands_unknown_total")
+                connection.send("", b"what")
+                continue
 
-    while True:
-        data = connection.recv()
-        if not data or data == b"":
-            break
+            # Optional "#<request_id>:" header lets the client pipeline commands
+            request = connection
+            if decoded.startswith("#"):
+                request_id, sep, rest = decoded[1:].partition(":")
+                if sep and request_id and len(request_id) <= 16 and request_id.isalnum():
+                    request = RequestConnection(connection, request_id)
+                    decoded = rest
 
-        decoded = data.decode()
-        cmd = decoded[:4].lower()
-        payload = decoded[4:]
+            cmd = decoded[:4].lower()
+            payload = decoded[4:]
 
-        # print(f"\n{'-'*100}")
+            # Payloads hold tokens and message text, only their size is logged
+            if log.isEnabledFor(logs.DEBUG):
+                log.debug("Received command", extra={
+                          "peer": peer, "cmd": cmd, "bytes": len(payload)})
 
-        print(
-            f"Received from {connection.addr}: {cmd}___{payload[:50]}{'...' if len(payload) > 50 else ''}")
+            endpoint = controller_instances.get(cmd)
+            if endpoint and not endpoint.allow(request):  # type: ignore
+                # Over its rate limit, refused before it reaches a worker
+                request.send(cmd, b"throttled")
+                continue
+            handle = measured(cmd, endpoint.handle) if endpoint else None
+            if endpoint and tracing.ENABLED:
+                handle = tracing.traced(cmd, handle, payload_length=len(payload))
+            if endpoint and trace_id is not None:
+                handle = traffic_trace.traced(trace_id, cmd, handle)
+            if endpoint and endpoint.inline:
+                try:
+                    handle(request, payload)  # type: ignore
+                except Exception as e:
+                    # Same as a failed worker task, the connection stays up
+                    log.exception("Error in inline command %s: %s", cmd, e)
+            elif endpoint:
+                worker_pool.submit(endpoint.shard_key(request, payload), handle, request, payload,
+                                   cancelled=lambda: connection.closed)
+            else:
+                log.info("Unknown command", extra={"peer": peer, "cmd": cmd})
+                metrics.inc("commands_unknown_total")
+                request.send("", b"what")
+    finally:
+        if trace_id is not None:
+            traffic_trace.close_connection(trace_id, connection.uid)
+        metrics.inc("connections_active", value=-1)
+        keepalive.untrack(connection)
 
-        endpoint = controller_instances.get(cmd)
-        if endpoint:
-            endpoint.handle(connection, payload)
-        else:
-            print(f"Unknown command from {connection.addr}: {decoded}")
-            connection.send("", b"what")
+        # Unregister connection before closing if authenticated
+        if connection.uid:
+            event_framework.unregister_connection(connection.uid, connection)
 
-        # print(f"{'-'*100}\n")
+        try:
+            connection.close()
+        except:
+            pass
+        log.debug("Connection closed", extra={"peer": peer})
 
-    # Unregister connection before closing if authenticated
-    if connection.uid:
-        event_framework.unregister_connection(connection.uid, connection)
 
+def serve_client(connection: Connection):
     try:
-        connection.close()
-    except:
-        pass
-    print(f"Connection from {connection.addr} has been closed.")
-
-
-try:
-    while True:
-        conn, addr = s.accept()
-        connection = Connection(conn, addr)
-        client_thread = threading.Thread(
-            target=handle_client, args=(connection,), name=f"ClientThread-{addr[0]}:{addr[1]}", daemon=True)
-        client_thread.start()
-        print(f"Active connections: {threading.active_count() - 2}")
-except KeyboardInterrupt:
-    print("Server is shutting down.")
-    s.close()
+        handle_client(connection)
+    finally:
+        admission.release()
+
+
+def _terminate(signum, frame):
+    # A repeated signal must not interrupt the flushes on the way out
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise KeyboardInterrupt
+
+
+def _profile(signum, frame):
+    # Runs on the accept loop's thread, starting threads or logging here could deadlock it
+    profiler.request()
+
+
+def serve(primary: bool = True, reuse_port: bool = False, worker: int = 0):
+    start_background_threads(primary)
+
+    if metrics.METRICS_PORT:
+        metrics.start_http_server(metrics.METRICS_PORT + worker)
+
+    # SIGTERM (sent to forked workers on shutdown) takes the same path as Ctrl+C
+    signal.signal(signal.SIGTERM, _terminate)
+    # SIGUSR1 profiles the process for PROFILE_SECONDS
+    signal.signal(signal.SIGUSR1, _profile)
+
+    s = socket.socket()
+    # Restarts can bind again while old connections are in TIME_WAIT
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    s.bind(("0.0.0.0", PORT))
+
+    s.listen(admission.LISTEN_BACKLOG)
+    log.info("Server is listening", extra={"port": PORT, "pid": os.getpid()})
+    try:
+        while True:
+            conn, addr = s.accept()
+            # Refuse before spending a thread on the connection
+            reason = admission.admit(addr[0])
+            if reason:
+                admission.shed(conn, addr, reason)
+                continue
+            try:
+                connection = Connection(conn, addr)
+            except OSError:
+                # Peer reset before the socket could be set up
+                admission.release()
+                conn.close()
+                continue
+            client_thread = threading.Thread(
+                target=serve_client, args=(connection,), name=f"ClientThread-{addr[0]}:{addr[1]}", daemon=True)
+            client_thread.start()
+    except KeyboardInterrupt:
+        log.info("Server is shutting down")
+        s.close()
+    finally:
+        # Acked messages still in the group commit log must reach the DB before exiting
+        message_log.flush_all()
+        traffic_trace.flush()
+        tracing.flush()
+        logs.flush()
+
+
+def run_workers(count: int):
+    """
+    Fork the event broker and `count` server processes, then wait on them.
+    """
+    children: list[int] = []
+    workers: list[int] = []
+
+    # Ignored until serve() installs its handler, so SIGUSR1 to the process group can't kill
+    # the broker or a worker that is still starting
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+
+    if EVENT_BUS.startswith("unix:"):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_broker(EVENT_BUS[len("unix:"):])
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    for i in range(count):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                serve(primary=i == 0, reuse_port=True, worker=i)
+            finally:
+                os._exit(0)
+        children.append(pid)
+        workers.append(pid)
+
+    def forward_profile(signum, frame):
+        # A worker signalled twice (through the process group) is already profiling
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGUSR1)
+            except ProcessLookupError:
+                pass
+
+    # SIGUSR1 to the parent profiles every worker
+    signal.signal(signal.SIGUSR1, forward_profile)
+
+    try:
+        while children:
+            pid, status = os.wait()
+            if pid in children:
+                children.remove(pid)
+                log.info("Process exited", extra={
+                         "pid": pid, "status": status})
+    except KeyboardInterrupt:
+        log.info("Server is shutting down")
+        for pid in children:
+            try:
+                os.kill(pid, 15)
+            except ProcessLookupError:
+                pass
+
+
+if SERVER_WORKERS > 1:
+    run_workers(SERVER_WORKERS)
+else:
+    serve()
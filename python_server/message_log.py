@@ -0,0 +1,152 @@
+from commands import AppendChatMessageCommand, AppendChatMessagesCommand
+import logs
+import os
+import threading
+import time
+from typing import Any, Callable
+
+log = logs.get("message_log")
+
+# Write-behind mode: messages are acked once logged here and written to the DB in batches
+GROUP_COMMIT = os.environ.get("GROUP_COMMIT", "0") == "1"
+
+FLUSH_INTERVAL = float(os.environ.get("GROUP_COMMIT_INTERVAL_MS", 5)) / 1000
+FLUSH_MAX_MESSAGES = int(os.environ.get("GROUP_COMMIT_MAX_MESSAGES", 64))
+
+# Appends block once a chat has this many unflushed messages, bounding the durability lag
+MAX_PENDING = int(os.environ.get("GROUP_COMMIT_MAX_PENDING", 2048))
+
+# Unflushed messages per chat, in append order, with the time the oldest was logged
+_pending: dict[str, list] = {}
+_pending_since: dict[str, float] = {}
+
+# Bumped before and after each chat's flush, odd while its DB write is in flight
+_flush_versions: dict[str, int] = {}
+
+_condition = threading.Condition()
+
+# Serializes flushes, the flusher thread and flush_all() on shutdown may overlap
+_flush_lock = threading.Lock()
+
+_stats = {
+    "appended": 0,
+    "flushed": 0,
+    "flushes": 0,
+    "failed_flushes": 0,
+    "flush_time_total": 0.0,
+}
+
+
+def append(chat_id: str, message: dict | int) -> bool:
+    """
+    Append a message to a chat, through the log in group commit mode or directly otherwise.
+    """
+    if not GROUP_COMMIT:
+        return AppendChatMessageCommand().execute(chat_id, message)  # type: ignore
+
+    with _condition:
+        while len(_pending.get(chat_id, ())) >= MAX_PENDING:
+            _condition.wait()
+        _pending.setdefault(chat_id, []).append(message)
+        _pending_since.setdefault(chat_id, time.time())
+        _stats["appended"] += 1
+        if len(_pending[chat_id]) >= FLUSH_MAX_MESSAGES:
+            _condition.notify_all()
+    return True
+
+
+def _copy(messages: list) -> list:
+    # Readers enrich messages in place, they must never get the log's own dicts
+    return [dict(m) if isinstance(m, dict) else m for m in messages]
+
+
+def pending_messages(chat_id: str) -> list:
+    """
+    Snapshot of a chat's messages not yet written to the DB.
+    """
+    with _condition:
+        return _copy(_pending.get(chat_id, ()))
+
+
+def read_with_pending(chat_ids: list[str], read: Callable[[], Any]) -> tuple[Any, dict[str, list]]:
+    """
+    Run a DB read and return its result with the pending messages of the given chats,
+    retrying if a flush of one of them overlapped the read so no message is missed or counted twice.
+    """
+    if not GROUP_COMMIT:
+        return read(), {}
+
+    while True:
+        with _condition:
+            versions = [_flush_versions.get(chat_id, 0) for chat_id in chat_ids]
+            if any(version % 2 for version in versions):
+                # A flush is writing one of these chats, wait for it to land
+                _condition.wait()
+                continue
+            pending = {chat_id: _copy(_pending[chat_id])
+                       for chat_id in chat_ids if chat_id in _pending}
+
+        result = read()
+
+        with _condition:
+            if versions == [_flush_versions.get(chat_id, 0) for chat_id in chat_ids]:
+                return result, pending
+
+
+def stats() -> dict:
+    with _condition:
+        snapshot = dict(_stats)
+        snapshot["pending"] = sum(len(msgs) for msgs in _pending.values())
+        oldest = min(_pending_since.values(), default=None)
+    snapshot["oldest_pending_age"] = time.time() - oldest if oldest else 0.0
+    return snapshot
+
+
+def flush_all():
+    """
+    Write every pending message to the DB. Called by the flusher and on shutdown.
+    """
+    with _flush_lock:
+        with _condition:
+            batches = {chat_id: list(msgs)
+                       for chat_id, msgs in _pending.items() if msgs}
+
+        for chat_id, messages in batches.items():
+            with _condition:
+                _flush_versions[chat_id] = _flush_versions.get(chat_id, 0) + 1
+            start = time.perf_counter()
+            success = AppendChatMessagesCommand().execute(chat_id, messages)
+            elapsed = time.perf_counter() - start
+
+            with _condition:
+                _flush_versions[chat_id] += 1
+                if success:
+                    # Only the flushed prefix is dropped, appends may have arrived meanwhile
+                    remaining = _pending[chat_id][len(messages):]
+                    if remaining:
+                        _pending[chat_id] = remaining
+                        _pending_since[chat_id] = time.time()
+                    else:
+                        del _pending[chat_id]
+                        del _pending_since[chat_id]
+                    _stats["flushed"] += len(messages)
+                    _stats["flushes"] += 1
+                    _stats["flush_time_total"] += elapsed
+                else:
+                    _stats["failed_flushes"] += 1
+                    log.warning("Failed to flush %d messages for chat %s, retrying",
+                                len(messages), chat_id)
+                _condition.notify_all()
+
+
+def process_flushes():
+    """
+    Background worker that flushes pending messages every FLUSH_INTERVAL,
+    or sooner when a chat reaches FLUSH_MAX_MESSAGES.
+    """
+    while True:
+        with _condition:
+            _condition.wait(FLUSH_INTERVAL)
+            if not _pending:
+                continue
+        flush_all()
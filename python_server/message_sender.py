@@ -1,9 +1,203 @@
-from firebase_admin import messaging
+from db_connector import OFFLINE
+from firebase_admin import exceptions, messaging
+from queue import Queue
+import event_framework
+import heapq
+import itertools
+import logs
+import metrics
+import os
+import threading
+import time
+import tracing
 
+log = logs.get("push")
 
-def send_message(topic: str, text: str, profile: dict) -> bool:
-    message = messaging.Message(
-        topic=topic,
+# Pushes to the same topic within this window are merged into one notification
+COALESCE_WINDOW = float(os.environ.get("PUSH_COALESCE_MS", 250)) / 1000
+
+# Firebase accepts at most 500 messages per send_each call
+MAX_BATCH_SIZE = 500
+
+MAX_ATTEMPTS = 4
+RETRY_BASE_DELAY = 0.5
+
+WORKER_COUNT = int(os.environ.get("PUSH_WORKERS", 2))
+
+# Recipients who disconnected this recently are expected to reconnect and sync over the socket.
+# A push waits at most this long past its coalescing window, however often recipients reconnect.
+PRESENCE_GRACE = float(os.environ.get("PUSH_PRESENCE_GRACE_S", 10))
+
+# Delivery results reported by senders
+SENT = "sent"
+FAILED = "failed"
+# The device token is unregistered or not valid, retrying can't help
+INVALID_TOKEN = "invalid_token"
+
+
+class Push:
+    def __init__(self, topic: str, text: str, profile: dict, recipients: list[str] | None = None):
+        self.topic = topic
+        self.text = text
+        self.profile = profile
+        self.recipients = set(recipients) if recipients is not None else None
+        self.token: str | None = None
+        self.count = 1
+        self.attempts = 0
+        # Trace of the request that queued the push, delivery is recorded in it
+        self.trace = tracing.current_context()
+        self.enqueued_at = time.time()
+        self.due_at = self.enqueued_at + COALESCE_WINDOW
+
+    def merge(self, text: str, profile: dict, recipients: list[str] | None):
+        """
+        Fold a newer message for the same topic into this push, keeping the latest text.
+        """
+        self.text = text
+        self.profile = profile
+        self.count += 1
+        if self.recipients is not None and recipients is not None:
+            self.recipients.update(recipients)
+        else:
+            self.recipients = None
+
+    def for_token(self, token: str) -> "Push":
+        """
+        Copy of this push addressed to a single device instead of the topic.
+        """
+        push = Push(self.topic, self.text, self.profile)
+        push.token = token
+        push.count = self.count
+        push.trace = self.trace
+        push.enqueued_at = self.enqueued_at
+        return push
+
+    def body(self) -> str:
+        if self.count > 1:
+            return f"{self.text} (+{self.count - 1} more)"
+        return self.text
+
+
+class FirebaseSender:
+    """
+    Delivers batches through the Firebase Admin SDK.
+    """
+
+    def send_each(self, messages: list[messaging.Message]) -> list[str]:
+        response = messaging.send_each(messages)
+        return [SENT if r.success else
+                INVALID_TOKEN if message.token and _is_invalid_token(r.exception) else FAILED
+                for message, r in zip(messages, response.responses)]
+
+
+def _is_invalid_token(error: Exception | None) -> bool:
+    return isinstance(error, (messaging.UnregisteredError, messaging.SenderIdMismatchError,
+                              exceptions.InvalidArgumentError))
+
+
+class FakeSender:
+    """
+    Local stand-in that records messages instead of calling FCM.
+    """
+
+    def __init__(self, fail_first: int = 0, invalid_tokens: set[str] | None = None):
+        self.sent: list[messaging.Message] = []
+        self.fail_first = fail_first
+        self.invalid_tokens = invalid_tokens or set()
+        self._lock = threading.Lock()
+
+    def send_each(self, messages: list[messaging.Message]) -> list[str]:
+        results = []
+        with self._lock:
+            for message in messages:
+                if message.token in self.invalid_tokens:
+                    results.append(INVALID_TOKEN)
+                    continue
+                if self.fail_first > 0:
+                    self.fail_first -= 1
+                    results.append(FAILED)
+                    continue
+                self.sent.append(message)
+                results.append(SENT)
+        return results
+
+
+_sender = FakeSender() if OFFLINE else FirebaseSender()
+
+# FCM registration tokens reported by each user's devices, and the user each token belongs to
+_device_tokens: dict[str, set[str]] = {}
+_token_owners: dict[str, str] = {}
+_device_tokens_lock = threading.Lock()
+
+# Pushes waiting out their coalescing window, by topic
+_pending: dict[str, Push] = {}
+
+# Failed pushes waiting for their retry: (due_at, tiebreaker, push)
+_retries: list[tuple[float, int, Push]] = []
+_retry_counter = itertools.count()
+
+_condition = threading.Condition()
+
+# Batches ready for the delivery workers
+_batch_queue: Queue = Queue()
+
+_stats = {
+    "queued": 0,
+    "coalesced": 0,
+    "skipped_online": 0,
+    "sent": 0,
+    "failed": 0,
+    "retried": 0,
+    "tokens_removed": 0,
+    "lag_total": 0.0,
+    "lag_max": 0.0,
+}
+_stats_lock = threading.Lock()
+
+
+def set_sender(sender):
+    """
+    Replace the delivery backend, e.g. with a FakeSender.
+    """
+    global _sender
+    _sender = sender
+
+
+def register_device_token(uid: str, token: str):
+    """
+    Remember a device's FCM token so pushes can target offline users directly.
+    A device signed in as another user stops receiving that user's pushes.
+    """
+    with _device_tokens_lock:
+        previous = _token_owners.get(token)
+        if previous and previous != uid:
+            _discard_token(previous, token)
+        _token_owners[token] = uid
+        _device_tokens.setdefault(uid, set()).add(token)
+
+
+def forget_device_token(token: str):
+    """
+    Drop a token FCM no longer accepts.
+    """
+    with _device_tokens_lock:
+        uid = _token_owners.pop(token, None)
+        if uid:
+            _discard_token(uid, token)
+
+
+def _discard_token(uid: str, token: str):
+    tokens = _device_tokens.get(uid)
+    if tokens is not None:
+        tokens.discard(token)
+        if not tokens:
+            del _device_tokens[uid]
+
+
+def build_message(topic: str, text: str, profile: dict, token: str | None = None) -> messaging.Message:
+    return messaging.Message(
+        topic=None if token else topic,
+        token=token,
         android=messaging.AndroidConfig(
             priority="high",
             notification=messaging.AndroidNotification(
@@ -22,10 +216,172 @@ def send_message(topic: str, text: str, profile: dict) -> bool:
         ),
     )
 
-    try:
-        response = messaging.send(message)
-        print(f"Sent message to topic {topic}: {response}")
-        return True
-    except Exception as e:
-        print(f"Failed to send message to topic {topic}: {e}")
-        return False
+
+def send_message(topic: str, text: str, profile: dict, recipients: list[str] | None = None) -> bool:
+    """
+    Queue a push notification for a topic. Returns immediately, delivery happens on the push workers.
+    When recipients are given, only those without a live connection are notified.
+    """
+    with tracing.span("push.enqueue", topic=topic), _condition:
+        push = _pending.get(topic)
+        if push:
+            push.merge(text, profile, recipients)
+        else:
+            _pending[topic] = Push(topic, text, profile, recipients)
+            _condition.notify()
+
+    with _stats_lock:
+        _stats["queued"] += 1
+        if push:
+            _stats["coalesced"] += 1
+    return True
+
+
+def stats() -> dict:
+    """
+    Snapshot of the push pipeline counters and queue lag in seconds.
+    """
+    with _stats_lock:
+        snapshot = dict(_stats)
+    with _condition:
+        snapshot["pending"] = len(_pending)
+        snapshot["retrying"] = len(_retries)
+        oldest = min((p.enqueued_at for p in _pending.values()), default=None)
+    snapshot["batches_waiting"] = _batch_queue.qsize()
+    snapshot["oldest_pending_age"] = time.time() - oldest if oldest else 0.0
+    delivered = snapshot["sent"] + snapshot["failed"]
+    snapshot["lag_avg"] = snapshot["lag_total"] / delivered if delivered else 0.0
+    return snapshot
+
+
+def _resolve_targets(push: Push, now: float) -> list[Push] | float:
+    """
+    Expand a presence-aware push into the deliveries it still needs.
+    While some recipient is inside the reconnect grace window, returns when to look again instead.
+    """
+    if push.recipients is None:
+        return [push]
+
+    offline = [uid for uid in push.recipients
+               if not event_framework.is_connected(uid)]
+    # Grace runs from each disconnect, bounded by the push's own deadline
+    deadline = push.enqueued_at + COALESCE_WINDOW + PRESENCE_GRACE
+    grace_ends = max((ts + PRESENCE_GRACE for ts in map(event_framework.disconnected_at, offline)
+                      if ts is not None), default=0.0)
+    if min(grace_ends, deadline) > now:
+        return min(grace_ends, deadline)
+    if not offline:
+        return []
+
+    with _device_tokens_lock:
+        tokens = [_device_tokens.get(uid) for uid in offline]
+    if all(tokens):
+        return [push.for_token(token) for user_tokens in tokens for token in user_tokens]  # type: ignore
+
+    # Someone offline has no known device, the topic is the only way to reach them
+    push.recipients = None
+    return [push]
+
+
+def process_pending():
+    """
+    Background worker that collects pushes whose coalescing window or retry delay
+    elapsed and hands them to the delivery workers in batches.
+    """
+    while True:
+        with _condition:
+            now = time.time()
+            ready = [p for p in _pending.values() if p.due_at <= now]
+            due: list[Push] = []
+            skipped = 0
+            for push in ready:
+                targets = _resolve_targets(push, now)
+                if isinstance(targets, float):
+                    push.due_at = targets
+                    continue
+                del _pending[push.topic]
+                due.extend(targets)
+                skipped += not targets
+            while _retries and _retries[0][0] <= now:
+                due.append(heapq.heappop(_retries)[2])
+
+            if skipped:
+                with _stats_lock:
+                    _stats["skipped_online"] += skipped
+
+            if not due:
+                next_due = [p.due_at for p in _pending.values()]
+                if _retries:
+                    next_due.append(_retries[0][0])
+                _condition.wait(min(next_due) - now if next_due else None)
+                continue
+
+        for i in range(0, len(due), MAX_BATCH_SIZE):
+            _batch_queue.put(due[i:i + MAX_BATCH_SIZE])
+
+
+def _schedule_retry(push: Push):
+    delay = RETRY_BASE_DELAY * (2 ** (push.attempts - 1))
+    with _condition:
+        heapq.heappush(_retries, (time.time() + delay,
+                       next(_retry_counter), push))
+        _condition.notify()
+
+
+def process_batches():
+    """
+    Background worker that delivers batches and retries failures with exponential backoff.
+    """
+    while True:
+        batch: list[Push] = _batch_queue.get()
+        try:
+            messages = [build_message(p.topic, p.body(), p.profile, p.token)
+                        for p in batch]
+            started = time.perf_counter()
+            try:
+                results = _sender.send_each(messages)
+            except Exception as e:
+                log.error("Failed to send push batch", extra={
+                          "size": len(batch), "error": str(e)})
+                results = [FAILED] * len(batch)
+            send_time = time.perf_counter() - started
+            metrics.observe("fcm_send_seconds", send_time)
+
+            now = time.time()
+            sent = failed = retried = removed = 0
+            lag_total = lag_max = 0.0
+            for push, result in zip(batch, results):
+                push.attempts += 1
+                success = result == SENT
+                tracing.record(push.trace, "push.deliver", push.enqueued_at, now - push.enqueued_at,
+                               attempt=push.attempts, success=success,
+                               batch=len(batch), fcm_ms=f"{send_time * 1000:.1f}")
+                if result == INVALID_TOKEN:
+                    forget_device_token(push.token)  # type: ignore
+                    removed += 1
+                elif not success and push.attempts < MAX_ATTEMPTS:
+                    _schedule_retry(push)
+                    retried += 1
+                    continue
+                if success:
+                    sent += 1
+                else:
+                    failed += 1
+                    if result == INVALID_TOKEN:
+                        log.info("Removed invalid device token", extra={"topic": push.topic})
+                    else:
+                        log.warning("Giving up on push", extra={
+                                    "topic": push.topic, "device": bool(push.token), "attempts": push.attempts})
+                lag = now - push.enqueued_at
+                lag_total += lag
+                lag_max = max(lag_max, lag)
+
+            with _stats_lock:
+                _stats["sent"] += sent
+                _stats["failed"] += failed
+                _stats["retried"] += retried
+                _stats["tokens_removed"] += removed
+                _stats["lag_total"] += lag_total
+                _stats["lag_max"] = max(_stats["lag_max"], lag_max)
+        finally:
+            _batch_queue.task_done()
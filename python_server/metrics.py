@@ -0,0 +1,260 @@
+"""
+In-process metrics: counters, gauges and latency histograms.
+
+Every thread records into its own shard, so the hot path is a dict update with no lock.
+Readers (the "stat" command and the optional Prometheus endpoint) merge the shards.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import bisect
+import logs
+import os
+import re
+import threading
+from typing import Callable
+
+log = logs.get("metrics")
+
+# Optional local Prometheus text endpoint, forked workers listen on consecutive ports
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+
+# Histogram bucket upper bounds in seconds, 50us to ~13s
+BUCKETS = [0.00005 * 2 ** i for i in range(19)]
+
+# name -> (type, help)
+METRICS: dict[str, tuple[str, str]] = {
+    "command_seconds": ("histogram", "Time from frame arrival to controller return, per command"),
+    "commands_unknown_total": ("counter", "Frames with an unknown command prefix"),
+    "commands_throttled_total": ("counter", "Commands refused by a rate limit, by command and scope"),
+    "db_query_seconds": ("histogram", "Database statement time, per statement"),
+    "db_errors_total": ("counter", "Failed database statements"),
+    "event_dispatch_lag_seconds": ("histogram", "Time events wait in the event queue"),
+    "event_queue_depth": ("gauge", "Events waiting to be dispatched"),
+    "event_rings": ("gauge", "Chats keeping recent events for resuming clients"),
+    "event_rings_dropped_total": ("counter", "Chat event rings dropped to stay under EVENT_RINGS"),
+    "connections_active": ("gauge", "Open client connections"),
+    "connections_total": ("counter", "Accepted client connections"),
+    "handshake_seconds": ("histogram", "Key exchange duration"),
+    "handshake_failures_total": ("counter", "Failed key exchanges"),
+    "handshakes_queued_total": ("counter", "Connections that waited for a key exchange slot"),
+    "connections_rejected_total": ("counter", "Connections refused with a busy frame, by reason"),
+    "admission_connections": ("gauge", "Admitted connections and those waiting for a key exchange slot"),
+    "keepalives_sent_total": ("counter", "Keepalive pings sent to silent connections"),
+    "connections_reaped_total": ("counter", "Connections closed for staying silent past IDLE_TIMEOUT_S"),
+    "keepalive_tracked": ("gauge", "Connections tracked by the idle reaper"),
+    "cache_requests_total": ("counter", "Cache lookups by cache and result"),
+    "fcm_send_seconds": ("histogram", "Firebase send_each call duration"),
+}
+
+_Key = tuple[str, tuple[tuple[str, str], ...]]
+
+
+class _Shard:
+    def __init__(self):
+        self.counters: dict[_Key, float] = {}
+        # key -> [bucket counts..., +Inf count, sum]
+        self.histograms: dict[_Key, list[float]] = {}
+
+
+_local = threading.local()
+
+# (thread, shard) for every thread that recorded something
+_shards: list[tuple[threading.Thread, _Shard]] = []
+_shards_lock = threading.Lock()
+
+# Totals of threads that have exited, folded in when collecting
+_retired = _Shard()
+
+# Sources of point-in-time values, polled when collecting: name -> fn() -> {labels: value}
+_gauges: dict[str, Callable[[], dict[tuple[tuple[str, str], ...], float]]] = {}
+
+# Sections added to the "stat" snapshot, e.g. lock waits and executor queues
+_collectors: dict[str, Callable[[], object]] = {}
+
+
+def _shard() -> _Shard:
+    shard = getattr(_local, "shard", None)
+    if shard is None:
+        shard = _local.shard = _Shard()
+        with _shards_lock:
+            _shards.append((threading.current_thread(), shard))
+    return shard
+
+
+def inc(name: str, labels: tuple[tuple[str, str], ...] = (), value: float = 1):
+    """
+    Add to a counter, or to a gauge kept as a running sum of deltas.
+    """
+    counters = _shard().counters
+    key = (name, labels)
+    counters[key] = counters.get(key, 0) + value
+
+
+def observe(name: str, seconds: float, labels: tuple[tuple[str, str], ...] = ()):
+    histograms = _shard().histograms
+    key = (name, labels)
+    entry = histograms.get(key)
+    if entry is None:
+        entry = histograms[key] = [0] * (len(BUCKETS) + 2)
+    entry[bisect.bisect_left(BUCKETS, seconds)] += 1
+    entry[-1] += seconds
+
+
+def gauge(name: str, fn: Callable[[], dict[tuple[tuple[str, str], ...], float]]):
+    _gauges[name] = fn
+
+
+def collector(section: str, fn: Callable[[], object]):
+    _collectors[section] = fn
+
+
+# Literal lists of placeholders vary with the number of ids, one label covers them all
+_PLACEHOLDER_LIST = re.compile(r"%s(\s*,\s*%s)+")
+_statement_labels: dict[str, tuple[tuple[str, str], ...]] = {}
+
+
+def statement_labels(query: str) -> tuple[tuple[str, str], ...]:
+    labels = _statement_labels.get(query)
+    if labels is None:
+        statement = _PLACEHOLDER_LIST.sub("%s...", " ".join(query.split()))
+        labels = (("statement", statement),)
+        if len(_statement_labels) < 4096:
+            _statement_labels[query] = labels
+    return labels
+
+
+def _merge(into: _Shard, shard: _Shard):
+    for key, value in list(shard.counters.items()):
+        into.counters[key] = into.counters.get(key, 0) + value
+    for key, entry in list(shard.histograms.items()):
+        total = into.histograms.setdefault(key, [0] * len(entry))
+        for i, value in enumerate(entry):
+            total[i] += value
+
+
+def _collect() -> _Shard:
+    merged = _Shard()
+    with _shards_lock:
+        alive = []
+        for thread, shard in _shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                _merge(_retired, shard)
+        _shards[:] = alive
+        _merge(merged, _retired)
+    for _, shard in alive:
+        _merge(merged, shard)
+    for name, fn in _gauges.items():
+        try:
+            for labels, value in fn().items():
+                merged.counters[(name, labels)] = value
+        except Exception as e:
+            log.error("Error reading gauge %s: %s", name, e)
+    return merged
+
+
+def _quantile(entry: list[float], q: float) -> float:
+    count = sum(entry[:-1])
+    if not count:
+        return 0.0
+    target = q * count
+    running = 0
+    for i, bucket in enumerate(entry[:-1]):
+        running += bucket
+        if running >= target:
+            return BUCKETS[min(i, len(BUCKETS) - 1)]
+    return BUCKETS[-1]
+
+
+def _label_text(labels: tuple[tuple[str, str], ...]) -> str:
+    return ",".join(f"{k}={v}" for k, v in labels)
+
+
+def snapshot() -> dict:
+    """
+    Everything recorded so far, with p50/p99 bucket upper bounds (capped at the last bucket) for histograms.
+    """
+    merged = _collect()
+    result: dict = {"counters": {}, "histograms": {}}
+    for (name, labels), value in sorted(merged.counters.items()):
+        result["counters"].setdefault(name, {})[_label_text(labels)] = value
+    for (name, labels), entry in sorted(merged.histograms.items()):
+        count = sum(entry[:-1])
+        result["histograms"].setdefault(name, {})[_label_text(labels)] = {
+            "count": count,
+            "sum": entry[-1],
+            "avg": entry[-1] / count if count else 0.0,
+            "p50": _quantile(entry, 0.5),
+            "p99": _quantile(entry, 0.99),
+        }
+    for section, fn in _collectors.items():
+        try:
+            result[section] = fn()
+        except Exception as e:
+            result[section] = f"error: {e}"
+    return result
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _prometheus_labels(labels: tuple[tuple[str, str], ...], extra: str = "") -> str:
+    parts = [f'{k}="{_escape(str(v))}"' for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def render_prometheus() -> str:
+    merged = _collect()
+    lines: list[str] = []
+    described: set[str] = set()
+
+    def describe(name: str):
+        if name not in described:
+            described.add(name)
+            kind, help_text = METRICS.get(name, ("untyped", ""))
+            lines.append(f"# HELP predictrix_{name} {help_text}")
+            lines.append(f"# TYPE predictrix_{name} {kind}")
+
+    for (name, labels), value in sorted(merged.counters.items()):
+        describe(name)
+        lines.append(f"predictrix_{name}{_prometheus_labels(labels)} {value}")
+    for (name, labels), entry in sorted(merged.histograms.items()):
+        describe(name)
+        running = 0
+        for bound, bucket in zip(BUCKETS + [float("inf")], entry[:-1]):
+            running += bucket
+            le = "le=\"+Inf\"" if bound == float("inf") else f"le=\"{bound:g}\""
+            lines.append(
+                f"predictrix_{name}_bucket{_prometheus_labels(labels, le)} {running}")
+        lines.append(f"predictrix_{name}_sum{_prometheus_labels(labels)} {entry[-1]}")
+        lines.append(f"predictrix_{name}_count{_prometheus_labels(labels)} {running}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port: int):
+    """
+    Serve /metrics on localhost only, scrapers reach it through the host.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever,
+                     name="MetricsServer", daemon=True).start()
+    log.info("Metrics endpoint on http://127.0.0.1:%d/metrics", port)
@@ -0,0 +1,275 @@
+"""
+Local stand-ins for MySQL and Firebase, used when the server runs with OFFLINE=1.
+
+The database is a SQLite file with the same tables, wrapped to look like a
+mysql.connector connection so DbUtils and DbTransaction work unchanged.
+OFFLINE_DB=:memory: keeps it in memory, shared by every connection of the process.
+ID tokens are "offline:<uid>" or "offline:<uid>:<display name>".
+"""
+import datetime
+import json
+import re
+import sqlite3
+import threading
+import zlib
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS Users (
+    UserId TEXT PRIMARY KEY,
+    DisplayName TEXT NOT NULL DEFAULT '',
+    Email TEXT NOT NULL DEFAULT '',
+    PhotoUrl TEXT NOT NULL DEFAULT '',
+    Chats TEXT NOT NULL DEFAULT '[]'
+);
+CREATE TABLE IF NOT EXISTS Chats (
+    Id INTEGER PRIMARY KEY AUTOINCREMENT,
+    Name TEXT NOT NULL,
+    Messages TEXT NOT NULL DEFAULT '[]',
+    LastMessage TEXT NOT NULL DEFAULT '',
+    Members TEXT NOT NULL DEFAULT '[]',
+    ScoreSumPerUser TEXT NOT NULL DEFAULT '{}',
+    PredictionsPerUser TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS Assertions (
+    Id INTEGER PRIMARY KEY AUTOINCREMENT,
+    UserId TEXT NOT NULL,
+    ChatId INTEGER NOT NULL,
+    Text TEXT NOT NULL,
+    Predictions TEXT NOT NULL DEFAULT '{}',
+    Votes TEXT NOT NULL DEFAULT '{}',
+    ValidationDate DATETIME,
+    CastingForecastDeadline DATETIME,
+    CreatedAt DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    Completed INTEGER NOT NULL DEFAULT 0,
+    FinalAnswer INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS IdxAssertionsPending ON Assertions (Completed, ValidationDate);
+CREATE INDEX IF NOT EXISTS IdxAssertionsChat ON Assertions (ChatId);
+"""
+
+MEMORY = ":memory:"
+# Named shared-cache database, lives as long as one connection to it is open
+MEMORY_URI = "file:predictrix-offline?mode=memory&cache=shared"
+
+sqlite3.register_converter(
+    "DATETIME", lambda raw: datetime.datetime.fromisoformat(raw.decode()))
+sqlite3.register_adapter(
+    datetime.datetime, lambda value: value.isoformat(" "))
+
+# MySQL syntax used by the queries, mapped to SQLite
+_REWRITES = [
+    (re.compile(r"%s"), "?"),
+    (re.compile(r"\s+FOR UPDATE\b", re.IGNORECASE), ""),
+    (re.compile(r"\bJSON_LENGTH\(", re.IGNORECASE), "json_array_length("),
+]
+_translated: dict[str, str] = {}
+
+
+def translate(query: str) -> str:
+    sql = _translated.get(query)
+    if sql is None:
+        sql = query
+        for pattern, replacement in _REWRITES:
+            sql = pattern.sub(replacement, sql)
+        _translated[query] = sql
+    return sql
+
+
+class SqliteCursor:
+    """
+    Buffered cursor with the parts of the mysql.connector cursor API the server uses.
+    """
+
+    def __init__(self, connection: "SqliteConnection", dictionary: bool = False):
+        self._connection = connection
+        self._dictionary = dictionary
+        self._rows: list = []
+        self.rowcount = -1
+        self.lastrowid = None
+
+    def _store(self, cursor: sqlite3.Cursor):
+        self.rowcount = cursor.rowcount
+        self.lastrowid = cursor.lastrowid
+        if cursor.description:
+            names = [column[0] for column in cursor.description]
+            rows = cursor.fetchall()
+            self._rows = [dict(zip(names, row)) for row in rows] if self._dictionary else rows
+        else:
+            self._rows = []
+
+    def execute(self, query: str, params: tuple = ()):
+        with self._connection.lock:
+            self._store(self._connection.db.execute(
+                translate(query), tuple(params)))
+
+    def executemany(self, query: str, params_list: list[tuple]):
+        with self._connection.lock:
+            self._store(self._connection.db.executemany(
+                translate(query), [tuple(p) for p in params_list]))
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def close(self):
+        self._rows = []
+
+
+class _BitXor:
+    """
+    MySQL's BIT_XOR aggregate.
+    """
+
+    def __init__(self):
+        self.value = 0
+
+    def step(self, value):
+        if value is not None:
+            self.value ^= int(value)
+
+    def finalize(self) -> int:
+        return self.value
+
+
+def _concat_ws(separator: str, *values) -> str:
+    return separator.join(str(value) for value in values if value is not None)
+
+
+def _crc32(value) -> int | None:
+    return None if value is None else zlib.crc32(str(value).encode())
+
+
+class SqliteConnection:
+    """
+    mysql.connector-like connection over a SQLite database file.
+    Transactions take SQLite's write lock up front, which stands in for SELECT ... FOR UPDATE.
+    """
+
+    def __init__(self, path: str):
+        in_memory = path == MEMORY
+        self.db = sqlite3.connect(MEMORY_URI if in_memory else path, timeout=30,
+                                  isolation_level=None, check_same_thread=False,
+                                  detect_types=sqlite3.PARSE_DECLTYPES, uri=in_memory)
+        # Calls on the shared connection come from many threads
+        self.lock = threading.RLock()
+        if in_memory:
+            # Shared-cache reads would otherwise fail while another connection holds a transaction
+            self.db.execute("PRAGMA read_uncommitted=1")
+        else:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        # MySQL functions used by the queries that SQLite lacks
+        self.db.create_function("CONCAT_WS", -1, _concat_ws, deterministic=True)
+        self.db.create_function("CRC32", 1, _crc32, deterministic=True)
+        self.db.create_aggregate("BIT_XOR", 1, _BitXor)
+
+    def cursor(self, dictionary: bool = False) -> SqliteCursor:
+        return SqliteCursor(self, dictionary)
+
+    def start_transaction(self):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+
+    def commit(self):
+        with self.lock:
+            if self.db.in_transaction:
+                self.db.execute("COMMIT")
+
+    def rollback(self):
+        with self.lock:
+            if self.db.in_transaction:
+                self.db.execute("ROLLBACK")
+
+    def is_connected(self) -> bool:
+        return True
+
+    def close(self):
+        self.db.close()
+
+
+def connect(path: str) -> SqliteConnection:
+    return SqliteConnection(path)
+
+
+class OfflineAuth:
+    """
+    Stand-in for firebase_admin.auth that trusts "offline:<uid>[:<display name>]" tokens.
+    """
+
+    @staticmethod
+    def verify_id_token(token: str) -> dict[str, str]:
+        scheme, _, rest = token.partition(":")
+        uid, _, name = rest.partition(":")
+        if scheme != "offline" or not uid:
+            raise ValueError("Invalid offline ID token")
+        return {
+            "uid": uid,
+            "name": name or uid,
+            "email": f"{uid}@offline.invalid",
+            "picture": "",
+        }
+
+
+auth = OfflineAuth()
+
+
+def token_for(uid: str, name: str = "") -> str:
+    return f"offline:{uid}:{name}" if name else f"offline:{uid}"
+
+
+def seed(path: str, chats: int, members: int, messages: int = 0, assertions: int = 0,
+         uid_prefix: str = "user") -> dict[str, dict[str, list]]:
+    """
+    Fill a database with synthetic chats, each with its own `members` users,
+    `messages` text messages and `assertions` assertions past their validation date (open for voting).
+    Returns chat id -> {"members": uids, "assertions": assertion ids}.
+    The returned layout is only valid while the database exists, keep a connection open for :memory:.
+    """
+    connection = connect(path)
+    db = connection.db
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    layout: dict[str, dict[str, list]] = {}
+
+    db.execute("BEGIN")
+    for c in range(chats):
+        uids = [f"{uid_prefix}{c}-{m}" for m in range(members)]
+        cursor = db.execute(
+            "INSERT INTO Chats (Name, Members, ScoreSumPerUser, PredictionsPerUser) VALUES (?, ?, ?, ?)",
+            (f"Chat {c}", json.dumps(uids),
+             json.dumps({uid: 0 for uid in uids}), json.dumps({uid: 0 for uid in uids})))
+        chat_id = cursor.lastrowid
+
+        chat_messages: list = [{
+            "sender": uids[i % members],
+            "timestamp": (now - datetime.timedelta(seconds=messages - i)).isoformat() + "+00:00",
+            "content": f"Message {i}",
+        } for i in range(messages)]
+
+        assertion_ids = []
+        for a in range(assertions):
+            cursor = db.execute(
+                "INSERT INTO Assertions (UserId, Text, ChatId, Predictions, ValidationDate, CastingForecastDeadline) VALUES (?, ?, ?, ?, ?, ?)",
+                (uids[a % members], f"Assertion {a}", chat_id,
+                 json.dumps({uid: {"confidence": 0.5 + (i % 5) / 10, "forecast": i % 2 == 0}
+                             for i, uid in enumerate(uids)}),
+                 now - datetime.timedelta(hours=1), now - datetime.timedelta(hours=2)))
+            chat_messages.append(cursor.lastrowid)
+            assertion_ids.append(cursor.lastrowid)
+
+        last_message = f"{uids[(messages - 1) % members]}: Message {messages - 1}" if messages else ""
+        db.execute("UPDATE Chats SET Messages = ?, LastMessage = ? WHERE Id = ?",
+                   (json.dumps(chat_messages), last_message, chat_id))
+        db.executemany(
+            "INSERT INTO Users (UserId, DisplayName, Email, Chats) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (UserId) DO UPDATE SET Chats = json_insert(Chats, '$[#]', ?)",
+            [(uid, f"User {uid}", f"{uid}@offline.invalid", json.dumps([chat_id]), chat_id)
+             for uid in uids])
+        layout[str(chat_id)] = {"members": uids, "assertions": assertion_ids}
+    db.execute("COMMIT")
+    if path != MEMORY:
+        connection.close()
+    return layout
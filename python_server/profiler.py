@@ -0,0 +1,179 @@
+"""
+On-demand sampling profiler, safe to start on a live server.
+
+start() samples the stack of every thread for a while and writes two files to PROFILE_DIR:
+    <name>.folded  collapsed stacks ("thread;command;frame;frame count"), ready for
+                   flamegraph.pl or speedscope
+    <name>.json    CPU seconds per controller, measured on the handling thread, and
+                   sample counts per thread role
+
+By default threads parked in a known wait (queue get, condition wait, socket receive)
+are left out, PROFILE_MODE=wall keeps them to show where time is spent blocked.
+Only one profile runs at a time and a new one can start PROFILE_COOLDOWN_S after the last.
+"""
+from collections import Counter
+import json
+import logs
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+PROFILE_DIR = os.environ.get("PROFILE_DIR", tempfile.gettempdir())
+PROFILE_MODE = os.environ.get("PROFILE_MODE", "cpu")
+INTERVAL = float(os.environ.get("PROFILE_INTERVAL_MS", 10)) / 1000
+DEFAULT_SECONDS = float(os.environ.get("PROFILE_SECONDS", 30))
+MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", 120))
+COOLDOWN = float(os.environ.get("PROFILE_COOLDOWN_S", 300))
+
+# Innermost frames of a thread that is waiting rather than running
+_IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("queue.py", "get"),
+    ("socket.py", "accept"),
+    ("connection.py", "recv"),
+    ("selectors.py", "select"),
+    ("event_bus.py", "_recv_exact"),
+}
+
+# Per-thread numbering in names, e.g. CommandWorker-3 or ClientThread-1.2.3.4:5678
+_THREAD_SUFFIX = re.compile(r"-[\d.:]+$")
+
+log = logs.get("profiler")
+
+# Read by the dispatch wrapper, commands are only attributed while a profile runs
+active = False
+
+_lock = threading.Lock()
+_last_start = 0.0
+
+# Set by the SIGUSR1 handler, which must not take locks the interrupted thread may hold
+_requested = threading.Event()
+
+# Command each thread is handling, by thread ident
+_commands: dict[int, str] = {}
+_local = threading.local()
+_cpu: Counter = Counter()
+_cpu_lock = threading.Lock()
+
+
+def enter(cmd: str):
+    _commands[threading.get_ident()] = cmd
+    _local.started = time.thread_time()
+
+
+def leave(cmd: str):
+    spent = time.thread_time() - getattr(_local, "started", time.thread_time())
+    _commands.pop(threading.get_ident(), None)
+    with _cpu_lock:
+        _cpu[cmd] += spent
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _sample(stacks: Counter, roles: Counter, names: dict[int, str], own: int, keep_idle: bool):
+    for ident, frame in sys._current_frames().items():
+        if ident == own:
+            continue
+        code = frame.f_code
+        if not keep_idle and (os.path.basename(code.co_filename), code.co_name) in _IDLE_FRAMES:
+            continue
+        role = _THREAD_SUFFIX.sub("", names.get(ident, "unknown"))
+        frames = []
+        while frame is not None:
+            frames.append(_frame_label(frame))
+            frame = frame.f_back
+        cmd = _commands.get(ident)
+        root = f"{role};{cmd}" if cmd else role
+        stacks[root + ";" + ";".join(reversed(frames))] += 1
+        roles[role] += 1
+
+
+def _run(seconds: float, path: str):
+    global active
+    own = threading.get_ident()
+    keep_idle = PROFILE_MODE == "wall"
+    stacks: Counter = Counter()
+    roles: Counter = Counter()
+    samples = 0
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    try:
+        deadline = started + seconds
+        while time.perf_counter() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}  # type: ignore
+            _sample(stacks, roles, names, own, keep_idle)  # type: ignore
+            samples += 1
+            time.sleep(INTERVAL)
+    finally:
+        active = False
+        _commands.clear()
+
+    elapsed = time.perf_counter() - started
+    with _cpu_lock:
+        cpu = dict(_cpu.most_common())
+    with open(path + ".folded", "w") as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+    with open(path + ".json", "w") as f:
+        json.dump({
+            "mode": PROFILE_MODE,
+            "seconds": elapsed,
+            "interval": INTERVAL,
+            "samples": samples,
+            "process_cpu_seconds": time.process_time() - cpu_started,
+            "command_cpu_seconds": cpu,
+            "thread_samples": dict(roles.most_common()),
+        }, f, indent=2)
+    log.info("Profile written to %s.folded", path, extra={"samples": samples})
+
+
+def start(seconds: float = 0) -> tuple[bool, str]:
+    """
+    Profile for `seconds` (PROFILE_SECONDS by default, capped at PROFILE_MAX_SECONDS) on a
+    background thread. Returns whether it started, and the output path without extension
+    or the reason it didn't.
+    """
+    global active, _last_start
+    seconds = min(seconds or DEFAULT_SECONDS, MAX_SECONDS)
+    with _lock:
+        if active:
+            return False, "running"
+        wait = _last_start + COOLDOWN - time.time()
+        if _last_start and wait > 0:
+            return False, f"cooldown,{int(wait) + 1}"
+        _last_start = time.time()
+        with _cpu_lock:
+            _cpu.clear()
+        active = True
+
+    path = os.path.join(PROFILE_DIR, time.strftime(
+        f"predictrix-profile-{os.getpid()}-%Y%m%d-%H%M%S"))
+    threading.Thread(target=_run, args=(seconds, path),
+                     name="Profiler", daemon=True).start()
+    log.info("Profiling for %.0fs", seconds, extra={"mode": PROFILE_MODE})
+    return True, path
+
+
+def request():
+    """
+    Ask for a profile, safe to call from a signal handler: it only sets a flag.
+    """
+    _requested.set()
+
+
+def process_requests():
+    """
+    Background worker that starts the profiles asked for with request().
+    """
+    while True:
+        _requested.wait()
+        _requested.clear()
+        started, detail = start()
+        if not started:
+            log.info("Profile not started: %s", detail)
@@ -1,44 +1,98 @@
 from cqrs import Query
 from db_utils import DbUtils
+from contextlib import contextmanager
+import logs
+import metrics
 import json
 from typing import Any
+import threading
 import time
 
+log = logs.get("queries")
+
 # Cache for user profiles: uid -> (profile dict, timestamp)
 _user_profile_cache: dict[str, tuple[dict[str, str], float]] = {}
 
+_PROFILE_HIT = (("cache", "user_profile"), ("result", "hit"))
+_PROFILE_MISS = (("cache", "user_profile"), ("result", "miss"))
+
+# Per-thread memo of chat members, only set inside request_scope()
+_request_local = threading.local()
+
+
+@contextmanager
+def request_scope():
+    """
+    Share chat member lookups between the queries run for one request.
+    Yields the memo (chat_id -> member ids) so it can be prefilled or cleared after writes.
+    """
+    _request_local.members = {}
+    try:
+        yield _request_local.members
+    finally:
+        _request_local.members = None
+
 
 class GetChatsQuery(Query):
     def execute(self, uid: str) -> list[dict[str, str]] | None:
         """
-        Execute the query to get chats for a user.
+        Execute the query to get chats for a user, with the number of messages in each.
         :param uid: User ID for which to retrieve chats.
         :return: List of chats or None if an error occurs.
         """
+        import message_log
+
         try:
             # Get chat ids from Users table (Chats column)
             row = DbUtils(
                 "SELECT Chats FROM Users WHERE UserId = %s", (uid,)).execute_single()
             if not row or not row.get("Chats"):  # type: ignore
-                print(f"No chats found for user {uid}.")
+                log.debug("No chats found for user %s", uid)
                 return []
             chat_ids = json.loads(row["Chats"])  # type: ignore
-            print(f"Chat IDs for user {uid}: {chat_ids}")
             if not chat_ids:
-                print(f"No chats found for user {uid}.")
+                log.debug("No chats found for user %s", uid)
                 return []
 
             # Fetch chats from Chats table
             format_strings = ','.join(['%s'] * len(chat_ids))
-            query = f"SELECT Id, Name, LastMessage, Members FROM Chats WHERE Id IN ({format_strings})"
-            chats = DbUtils(query, tuple(chat_ids)).execute()
+            query = f"SELECT Id, Name, LastMessage, Members, JSON_LENGTH(Messages) AS MessageCount FROM Chats WHERE Id IN ({format_strings})"
+            chats, pending = message_log.read_with_pending(
+                [str(chat_id) for chat_id in chat_ids], DbUtils(query, tuple(chat_ids)).execute)
+            # Count messages not yet flushed by the group commit log
+            for chat in chats or []:
+                unflushed = pending.get(str(chat["Id"]))  # type: ignore
+                if unflushed:
+                    chat["MessageCount"] = int(  # type: ignore
+                        chat["MessageCount"] or 0) + len(unflushed)  # type: ignore
             return chats  # type: ignore
 
         except Exception as e:
-            print(f"Error executing GetChatsQuery for user {uid}: {e}")
+            log.error("Error executing GetChatsQuery for user %s: %s", uid, e)
             return None
 
 
+class GetAssertionVersionsQuery(Query):
+    def execute(self, chat_ids: list[str]) -> dict[str, int]:
+        """
+        Fingerprint of the assertions in each chat, which changes with every prediction,
+        vote and completion. Chats without assertions are left out.
+        """
+        if not chat_ids:
+            return {}
+        try:
+            format_strings = ','.join(['%s'] * len(chat_ids))
+            rows = DbUtils(
+                "SELECT ChatId, BIT_XOR(CRC32(CONCAT_WS('|', Id, Completed, FinalAnswer, Predictions, Votes))) AS Version "
+                f"FROM Assertions WHERE ChatId IN ({format_strings}) GROUP BY ChatId",
+                tuple(chat_ids)).execute()
+            return {str(row["ChatId"]): int(row["Version"] or 0)  # type: ignore
+                    for row in rows or []}
+        except Exception as e:
+            log.error("Error executing GetAssertionVersionsQuery: %s", e)
+            return {}
+
+
 class GetUserProfileQuery(Query):
     def execute(self, uid: str) -> dict[str, str]:
         """
@@ -49,7 +103,9 @@ class GetUserProfileQuery(Query):
         if cached:
             profile, ts = cached
             if now - ts < 3600:
+                metrics.inc("cache_requests_total", _PROFILE_HIT)
                 return profile
+        metrics.inc("cache_requests_total", _PROFILE_MISS)
         profile = {"displayName": "", "photoUrl": ""}
         try:
             row = DbUtils(
@@ -63,7 +119,7 @@ class GetUserProfileQuery(Query):
                 profile["displayName"] = str(name)
                 profile["photoUrl"] = str(photo)
         except Exception as e:
-            print(f"Error executing GetUserProfileQuery for user {uid}: {e}")
+            log.error("Error executing GetUserProfileQuery for user %s: %s", uid, e)
         _user_profile_cache[uid] = (profile, now)
         return profile
 
@@ -73,42 +129,122 @@ class GetChatMembersQuery(Query):
         """
         Retrieve user IDs of members in the given chat using Chats.Members column.
         """
+        memo = getattr(_request_local, "members", None)
+        if memo is not None and chat_id in memo:
+            return list(memo[chat_id])
         try:
             row = DbUtils(
                 "SELECT Members FROM Chats WHERE Id = %s", (chat_id,)
             ).execute_single()
             # No members field or empty
             if not row or not row.get("Members"):  # type: ignore
-                print(f"No members found for chat {chat_id}.")
+                log.debug("No members found for chat %s", chat_id)
                 return []
             # Ensure JSON string
             raw = row.get("Members")  # type: ignore
             members_str = str(raw)
             ids = json.loads(members_str)
-            return [str(uid) for uid in ids]
+            members = [str(uid) for uid in ids]
+            if memo is not None:
+                memo[chat_id] = members
+            return list(members)
         except Exception as e:
-            print(
-                f"Error executing GetChatMembersQuery for chat {chat_id}: {e}")
+            log.error("Error executing GetChatMembersQuery for chat %s: %s",
+                      chat_id, e)
             return []
 
 
+class GetChatsMembersQuery(Query):
+    def execute(self, chat_ids: list[str]) -> dict[str, list[str]]:
+        """
+        Retrieve member IDs for several chats in one query.
+        Chats that don't exist are left out of the result.
+        """
+        if not chat_ids:
+            return {}
+        try:
+            format_strings = ','.join(['%s'] * len(chat_ids))
+            rows = DbUtils(
+                f"SELECT Id, Members FROM Chats WHERE Id IN ({format_strings})",
+                tuple(chat_ids)
+            ).execute()
+            result: dict[str, list[str]] = {}
+            for row in rows or []:
+                row_dict: dict[str, Any] = dict(row)  # type: ignore
+                ids = json.loads(str(row_dict.get("Members") or "[]"))
+                result[str(row_dict["Id"])] = [str(uid) for uid in ids]
+            return result
+        except Exception as e:
+            log.error("Error executing GetChatsMembersQuery for %d chats: %s",
+                      len(chat_ids), e)
+            return {}
+
+
+class GetUserProfilesQuery(Query):
+    def execute(self, uids: list[str]) -> dict[str, dict[str, str]]:
+        """
+        Retrieve profiles for several users, fetching every uncached one in a single query.
+        Fills the same cache GetUserProfileQuery reads from.
+        """
+        now = time.time()
+        result: dict[str, dict[str, str]] = {}
+        missing: list[str] = []
+        for uid in dict.fromkeys(uids):
+            cached = _user_profile_cache.get(uid)
+            if cached and now - cached[1] < 3600:
+                result[uid] = cached[0]
+            else:
+                missing.append(uid)
+        metrics.inc("cache_requests_total", _PROFILE_HIT, len(result))
+        metrics.inc("cache_requests_total", _PROFILE_MISS, len(missing))
+
+        if missing:
+            fetched: dict[str, dict[str, str]] = {}
+            try:
+                format_strings = ','.join(['%s'] * len(missing))
+                rows = DbUtils(
+                    f"SELECT UserId, DisplayName, PhotoUrl FROM Users WHERE UserId IN ({format_strings})",
+                    tuple(missing)
+                ).execute()
+                for row in rows or []:
+                    data: Any = dict(row)  # type: ignore
+                    fetched[str(data["UserId"])] = {
+                        "displayName": str(data.get("DisplayName", "")),
+                        "photoUrl": str(data.get("PhotoUrl", "")),
+                    }
+            except Exception as e:
+                log.error("Error executing GetUserProfilesQuery: %s", e)
+                return {**result, **{uid: GetUserProfileQuery().execute(uid) for uid in missing}}
+
+            for uid in missing:
+                profile = fetched.get(uid, {"displayName": "", "photoUrl": ""})
+                _user_profile_cache[uid] = (profile, now)
+                result[uid] = profile
+
+        return result
+
+
 class GetChatMessagesQuery(Query):
     def execute(self, chat_id: str) -> list[dict]:
         """
         Retrieve list of message entries (dict or IDs) from Chats.Messages JSON.
+        Includes messages still waiting in the group commit log.
         """
+        import message_log
+
         try:
-            row = DbUtils(
+            row, pending = message_log.read_with_pending([chat_id], DbUtils(
                 "SELECT Messages FROM Chats WHERE Id = %s", (chat_id,)
-            ).execute_single()
-            if not row or not row.get("Messages"):  # type: ignore
-                return []
-            raw = row.get("Messages")  # type: ignore
-            msgs = json.loads(str(raw))
-            return msgs if isinstance(msgs, list) else []
+            ).execute_single)
+            msgs = []
+            if row and row.get("Messages"):  # type: ignore
+                msgs = json.loads(str(row.get("Messages")))  # type: ignore
+                if not isinstance(msgs, list):
+                    msgs = []
+            return msgs + pending.get(chat_id, [])
         except Exception as e:
-            print(
-                f"Error executing GetChatMessagesQuery for chat {chat_id}: {e}")
+            log.error("Error executing GetChatMessagesQuery for chat %s: %s",
+                      chat_id, e)
             return []
 
 
@@ -138,7 +274,7 @@ class GetChatStatsQuery(Query):
             pred_map = {str(k): int(v) for k, v in preds.items()}
             return score_map, pred_map
         except Exception as e:
-            print(f"Error executing GetChatStatsQuery for chat {chat_id}: {e}")
+            log.error("Error executing GetChatStatsQuery for chat %s: %s", chat_id, e)
             return {}, {}
 
 
@@ -146,7 +282,7 @@ class GetAssertionQuery(Query):
     def execute(self, assertion_id: str, did_predict_uid: str | None) -> dict[str, Any]:
         """
         Retrieve assertion details by ID for message enrichment.
-        Automatically checks and completes assertions that are past validation date.
+        Completion is handled by the assertion scheduler, this query only reads.
         """
         import datetime
 
@@ -161,27 +297,6 @@ class GetAssertionQuery(Query):
 
             assertion_dict: dict[str, Any] = dict(row)  # type: ignore
 
-            # Check if assertion should be auto-completed
-            completed = bool(assertion_dict.get("Completed", 0))
-            if not completed:
-                validation_date: datetime.datetime | None = assertion_dict.get(
-                    "ValidationDate", "")
-                if validation_date:
-                    try:
-                        now = datetime.datetime.now(datetime.timezone.utc)
-                        if validation_date and validation_date.tzinfo is None:
-                            validation_date = validation_date.replace(
-                                tzinfo=datetime.timezone.utc)
-                        # If past validation date, check for completion
-                        if now > validation_date:
-                            from assertion_completion import check_and_complete_assertion
-                            completed, final_answer = check_and_complete_assertion(
-                                assertion_dict)
-                            assertion_dict["Completed"] = completed
-                            assertion_dict["FinalAnswer"] = final_answer
-                    except Exception as e:
-                        print(f"Error checking assertion completion: {e}")
-
             # Get user profile for sender info
             user_id = assertion_dict.get("UserId", "")
             chat_id = assertion_dict.get("ChatId", 0)
@@ -271,6 +386,6 @@ class GetAssertionQuery(Query):
             }
 
         except Exception as e:
-            print(
-                f"Error executing GetAssertionQuery for assertion {assertion_id}: {e}")
+            log.error("Error executing GetAssertionQuery for assertion %s: %s",
+                      assertion_id, e)
             return {}
@@ -0,0 +1,55 @@
+import threading
+import time
+
+
+class TokenBuckets:
+    """
+    A token bucket per key: `rate` tokens per second, holding at most `burst`.
+    Checks are O(1). When the table reaches max_keys, buckets that refilled completely are
+    dropped (a fresh bucket is identical), then the oldest ones.
+    """
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 100_000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        # key -> [tokens, last refill]
+        self._buckets: dict[str, list[float]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def allow(self, key: str, cost: float = 1.0) -> bool:
+        """
+        Take `cost` tokens from the key's bucket if it holds that many.
+        """
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_keys:
+                    self._evict(now)
+                bucket = self._buckets[key] = [self.burst, now]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < cost:
+                bucket[0] = tokens
+                return False
+            bucket[0] = tokens - cost
+            return True
+
+    def forget(self, key: str):
+        with self._lock:
+            self._buckets.pop(key, None)
+
+    def _evict(self, now: float):
+        full = [key for key, (tokens, last) in self._buckets.items()
+                if tokens + (now - last) * self.rate >= self.burst]
+        for key in full:
+            del self._buckets[key]
+        # Free at least a tenth of the table so evictions stay amortized O(1),
+        # dicts keep insertion order so the oldest buckets go first
+        excess = len(self._buckets) - (self.max_keys - max(1, self.max_keys // 10))
+        for key in list(self._buckets)[:max(0, excess)]:
+            del self._buckets[key]
@@ -0,0 +1,163 @@
+"""
+Recompute ScoreSumPerUser and PredictionsPerUser for every chat from its completed assertions.
+
+Run with the server stopped so live completions don't race the rewrite:
+    python recompute_scores.py [--chunk-size 5000] [--dry-run]
+"""
+from db_utils import DbUtils
+from scoring import calculate_scores
+import argparse
+import json
+import time
+from typing import Any
+
+import numpy as np
+
+
+def _parse_json(raw: Any, default: Any) -> Any:
+    if isinstance(raw, (str, bytes, bytearray)):
+        try:
+            return json.loads(raw)
+        except Exception:
+            return default
+    return raw or default
+
+
+def aggregate_scores(chunk_size: int) -> tuple[dict[str, dict[str, int]], dict[str, dict[str, int]], int]:
+    """
+    Stream completed assertions in Id order and sum scores per (chat, user).
+    Memory is bounded by the number of (chat, user) pairs, not by predictions.
+    Returns (score_sums per chat, prediction counts per chat, predictions scored).
+    """
+    keys: dict[tuple[str, str], int] = {}
+    score_totals = np.zeros(0, dtype=np.int64)
+    pred_totals = np.zeros(0, dtype=np.int64)
+    scored = 0
+    last_id = 0
+
+    while True:
+        rows = DbUtils(
+            "SELECT Id, ChatId, Predictions, FinalAnswer FROM Assertions WHERE Completed = 1 AND Id > %s ORDER BY Id LIMIT %s",
+            (last_id, chunk_size)
+        ).execute()
+        if not rows:
+            break
+
+        key_indices: list[int] = []
+        confidences: list[float] = []
+        forecasts: list[bool] = []
+        final_answers: list[bool] = []
+
+        for row in rows:
+            row_dict: dict[str, Any] = dict(row)  # type: ignore
+            chat_id = str(row_dict.get("ChatId", ""))
+            final_answer = bool(row_dict.get("FinalAnswer", 0))
+            predictions = _parse_json(row_dict.get("Predictions"), {})
+            if not isinstance(predictions, dict):
+                continue
+
+            for user_id, prediction in predictions.items():
+                if not isinstance(prediction, dict):
+                    continue
+                key_indices.append(keys.setdefault(
+                    (chat_id, str(user_id)), len(keys)))
+                confidences.append(float(prediction.get("confidence", 0.5)))
+                forecasts.append(bool(prediction.get("forecast", False)))
+                final_answers.append(final_answer)
+
+        last_id = dict(rows[-1])["Id"]  # type: ignore
+        if not key_indices:
+            continue
+
+        # Grow the per-key accumulators for keys first seen in this chunk
+        if len(keys) > len(score_totals):
+            growth = len(keys) - len(score_totals)
+            score_totals = np.concatenate(
+                [score_totals, np.zeros(growth, dtype=np.int64)])
+            pred_totals = np.concatenate(
+                [pred_totals, np.zeros(growth, dtype=np.int64)])
+
+        indices = np.asarray(key_indices, dtype=np.int64)
+        scores = calculate_scores(np.asarray(confidences), np.asarray(
+            forecasts), np.asarray(final_answers))
+
+        # Per-chunk sums stay far below 2**53, so float64 bincount weights are exact
+        score_totals += np.rint(np.bincount(indices, weights=scores,
+                                            minlength=len(keys))).astype(np.int64)
+        pred_totals += np.bincount(indices, minlength=len(keys))
+        scored += len(indices)
+
+    score_sums: dict[str, dict[str, int]] = {}
+    pred_counts: dict[str, dict[str, int]] = {}
+    for (chat_id, user_id), index in keys.items():
+        score_sums.setdefault(chat_id, {})[user_id] = int(score_totals[index])
+        pred_counts.setdefault(chat_id, {})[user_id] = int(pred_totals[index])
+
+    return score_sums, pred_counts, scored
+
+
+def write_scores(score_sums: dict[str, dict[str, int]], pred_counts: dict[str, dict[str, int]], chunk_size: int, dry_run: bool) -> int:
+    """
+    Rewrite chat stats in chunks, keeping a zero entry for members without predictions.
+    Returns the number of chats written.
+    """
+    written = 0
+    last_id = 0
+
+    while True:
+        rows = DbUtils(
+            "SELECT Id, Members FROM Chats WHERE Id > %s ORDER BY Id LIMIT %s",
+            (last_id, chunk_size)
+        ).execute()
+        if not rows:
+            break
+
+        updates: list[tuple] = []
+        for row in rows:
+            row_dict: dict[str, Any] = dict(row)  # type: ignore
+            chat_id = str(row_dict["Id"])
+            members = _parse_json(row_dict.get("Members"), [])
+
+            scores = {str(uid): 0 for uid in members}
+            preds = {str(uid): 0 for uid in members}
+            scores.update(score_sums.get(chat_id, {}))
+            preds.update(pred_counts.get(chat_id, {}))
+            updates.append((json.dumps(scores), json.dumps(preds), chat_id))
+
+        last_id = dict(rows[-1])["Id"]  # type: ignore
+
+        if not dry_run:
+            success = DbUtils(
+                "UPDATE Chats SET ScoreSumPerUser = %s, PredictionsPerUser = %s WHERE Id = %s"
+            ).execute_many(updates)
+            if not success:
+                print(f"Failed to write stats for chats up to {last_id}.")
+                continue
+        written += len(updates)
+
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Recompute chat leaderboards from completed assertions.")
+    parser.add_argument("--chunk-size", type=int, default=5000,
+                        help="rows fetched per query")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="compute the stats without writing them")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    score_sums, pred_counts, scored = aggregate_scores(args.chunk_size)
+    aggregated = time.perf_counter()
+    written = write_scores(score_sums, pred_counts,
+                           args.chunk_size, args.dry_run)
+    done = time.perf_counter()
+
+    print(f"Scored {scored} predictions in {aggregated - start:.2f}s.")
+    print(
+        f"{'Would write' if args.dry_run else 'Wrote'} stats for {written} chats in {done - aggregated:.2f}s.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+import numpy as np
+
+# Points awarded for a prediction made with 0.5 confidence
+SCORE_MULTIPLIER = 1000
+
+
+def calculate_score(confidence: float, forecast: bool, final_answer: bool) -> int:
+    """
+    Calculate score based on prediction accuracy.
+
+    Formula: ((0.5 - true_confidence) * multiplier * final_answer) + multiplier / 2
+    """
+    multiplier = SCORE_MULTIPLIER
+    true_confidence = (1 - confidence) if forecast else confidence
+
+    score = ((0.5 - true_confidence) * multiplier *
+             (1 if final_answer else -1)) + multiplier // 2
+
+    return int(score)
+
+
+def calculate_scores(confidences: np.ndarray, forecasts: np.ndarray, final_answers: np.ndarray) -> np.ndarray:
+    """
+    Vectorized calculate_score over equally sized arrays.
+    Returns an int64 array identical to applying calculate_score element-wise.
+    """
+    multiplier = SCORE_MULTIPLIER
+    confidences = np.asarray(confidences, dtype=np.float64)
+    true_confidences = np.where(
+        np.asarray(forecasts, dtype=bool), 1 - confidences, confidences)
+    signs = np.where(np.asarray(final_answers, dtype=bool), 1, -1)
+
+    scores = ((0.5 - true_confidences) * multiplier *
+              signs) + multiplier // 2
+
+    # int() truncates towards zero
+    return np.trunc(scores).astype(np.int64)
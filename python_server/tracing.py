@@ -0,0 +1,208 @@
+"""
+Sampled request tracing, exported as Zipkin v2 JSON.
+
+Set TRACE_EXPORT to a file path to enable it. A sampled frame starts a trace in handle_client
+and every span opened while its handler runs (queries, commands, DB statements, lock waits,
+pushes) becomes a child of it. Events and pushes carry the trace context to the threads that
+deliver them. Each finished span tree is appended to the file as one line holding a JSON array,
+the body Zipkin's POST /api/v2/spans expects.
+
+Forked workers write to <path>.<pid>.
+"""
+from contextlib import contextmanager
+import atexit
+import functools
+import json
+import os
+import random
+import threading
+import time
+
+TRACE_FILE = os.environ.get("TRACE_EXPORT", "")
+
+# Fraction of frames traced
+SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0.01))
+
+SERVICE_NAME = os.environ.get("TRACE_SERVICE_NAME", "predictrix")
+
+# Spans kept per trace, e.g. msgs enriching 500 messages would otherwise export thousands
+MAX_SPANS = int(os.environ.get("TRACE_MAX_SPANS", 500))
+
+ENABLED = bool(TRACE_FILE)
+
+_local = threading.local()
+_parent_pid = os.getpid()
+_lock = threading.Lock()
+_file = None
+
+
+def _reset_after_fork():
+    global _file
+    _file = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class Span:
+    def __init__(self, name: str, trace_id: str, parent_id: str | None, tags: dict | None = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.tags = tags or {}
+        self.timestamp = time.time()
+        self.start = time.perf_counter()
+        self.duration = 0.0
+        # Finished descendants, exported together with this span
+        self.children: list["Span"] = []
+        self.dropped = 0
+        self.root: "Span" = self
+
+    def child(self, name: str, tags: dict | None = None) -> "Span":
+        span = Span(name, self.trace_id, self.id, tags)
+        span.root = self.root
+        return span
+
+    def context(self) -> tuple[str, str]:
+        return self.trace_id, self.id
+
+    def to_zipkin(self) -> dict:
+        span = {
+            "traceId": self.trace_id,
+            "id": self.id,
+            "name": self.name,
+            "timestamp": int(self.timestamp * 1_000_000),
+            "duration": max(1, int(self.duration * 1_000_000)),
+            "localEndpoint": {"serviceName": SERVICE_NAME},
+        }
+        if self.parent_id:
+            span["parentId"] = self.parent_id
+        if self.tags:
+            span["tags"] = {k: str(v) for k, v in self.tags.items()}
+        return span
+
+
+def _export(spans: list[Span]):
+    global _file
+    line = json.dumps([s.to_zipkin() for s in spans]) + "\n"
+    with _lock:
+        if _file is None:
+            path = TRACE_FILE
+            if os.getpid() != _parent_pid:
+                path = f"{TRACE_FILE}.{os.getpid()}"
+            _file = open(path, "a")
+        _file.write(line)
+
+
+def flush():
+    with _lock:
+        if _file is not None:
+            _file.flush()
+
+
+def current_context() -> tuple[str, str] | None:
+    """
+    (trace id, span id) of the active span, for handing the trace to another thread.
+    """
+    span = getattr(_local, "span", None)
+    return span.context() if span else None
+
+
+@contextmanager
+def _active(span: Span):
+    previous = getattr(_local, "span", None)
+    _local.span = span
+    try:
+        yield span
+    finally:
+        span.duration = time.perf_counter() - span.start
+        _local.span = previous
+        if span.root is span:
+            if span.dropped:
+                span.tags["dropped_spans"] = span.dropped
+            _export([span] + span.children)
+        elif len(span.root.children) < MAX_SPANS:
+            span.root.children.append(span)
+        else:
+            span.root.dropped += 1
+
+
+@contextmanager
+def _noop():
+    yield None
+
+
+def span(name: str, **tags):
+    """
+    Time a block as a child of the active span. Does nothing outside a sampled trace.
+    """
+    parent = getattr(_local, "span", None)
+    if parent is None:
+        return _noop()
+    return _active(parent.child(name, tags))
+
+
+def spanned(name: str):
+    """
+    Decorator form of span().
+    """
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if getattr(_local, "span", None) is None:
+                return fn(*args, **kwargs)
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def traced(cmd: str, handle, **tags):
+    """
+    Sample a frame: wrap the controller's handle so it runs as the root span of a new trace,
+    started now (frame arrival) with a child span for the wait for a worker.
+    Returns handle unchanged when the frame isn't sampled.
+    """
+    if random.random() >= SAMPLE_RATE:
+        return handle
+    root = Span(cmd, f"{random.getrandbits(128):032x}", None, tags)
+
+    def run(connection, payload: str):
+        wait = root.child("worker.wait")
+        wait.timestamp = root.timestamp
+        wait.duration = time.perf_counter() - root.start
+        root.children.append(wait)
+        with _active(root):
+            return handle(connection, payload)
+
+    return run
+
+
+def record(context: tuple[str, str] | None, name: str, timestamp: float, duration: float, **tags):
+    """
+    Export a span measured elsewhere (e.g. time spent queued) under a propagated context.
+    """
+    if not context:
+        return
+    span = Span(name, context[0], context[1], tags)
+    span.timestamp = timestamp
+    span.duration = duration
+    _export([span])
+
+
+@contextmanager
+def resumed(context: tuple[str, str] | None, name: str, **tags):
+    """
+    Continue a trace on another thread, as a child of the span that handed it over.
+    """
+    if not context:
+        yield None
+        return
+    span = Span(name, context[0], context[1], tags)
+    with _active(span):
+        yield span
+
+
+if ENABLED:
+    atexit.register(flush)
@@ -0,0 +1,171 @@
+"""
+Opt-in recorder of the decrypted commands the server handles, for replay with benchmarks/replay.py.
+
+Set TRAFFIC_TRACE to a file path to enable it. Every record holds the wall-clock time the
+frame arrived, a per-process connection number, the command prefix, a
+pseudonymized uid, how long the command took to handle and its payload.
+Firebase and device tokens are dropped, and message, assertion and chat
+name texts are replaced by filler of the same length.
+
+File layout: MAGIC + version byte, then one record per event:
+    >dIB4sdBI header (time, connection, kind, command, duration, uid length, payload length)
+    followed by the uid and payload bytes.
+"""
+import atexit
+import base64
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import struct
+import threading
+import time
+
+TRACE_FILE = os.environ.get("TRAFFIC_TRACE", "")
+
+# Same salt in every forked worker, so a uid maps to one pseudonym across their traces
+SALT = os.environ.get("TRAFFIC_TRACE_SALT", "").encode() or os.urandom(16)
+
+MAGIC = b"PXTR"
+VERSION = 1
+
+OPEN, COMMAND, CLOSE = 0, 1, 2
+
+RECORD = struct.Struct(">dIB4sdBI")
+
+_parent_pid = os.getpid()
+_connection_ids = itertools.count()
+_lock = threading.Lock()
+_file = None
+
+
+def _reset_after_fork():
+    # Forked workers write their own file, see _open()
+    global _file
+    _file = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _open():
+    global _file
+    path = TRACE_FILE
+    if os.getpid() != _parent_pid:
+        path = f"{TRACE_FILE}.{os.getpid()}"
+    _file = open(path, "ab")
+    if _file.tell() == 0:
+        _file.write(MAGIC + bytes([VERSION]))
+
+
+def pseudonymize(uid: str) -> str:
+    if not uid:
+        return ""
+    return hmac.new(SALT, uid.encode(), hashlib.sha256).hexdigest()[:16]
+
+
+def _filler(text: str) -> str:
+    return "x" * len(text)
+
+
+def sanitize(cmd: str, payload: str) -> str:
+    """
+    Payload as stored in the trace, without credentials or user-written text.
+    """
+    if cmd in ("user", "fcmt"):
+        # The uid of the record stands in for the Firebase token
+        return ""
+    if cmd == "sndm":
+        chat_id, sep, text = payload.strip().partition(" ")
+        return f"{chat_id}{sep}{_filler(text)}"
+    if cmd == "assr":
+        parts = payload.strip().split(",", 3)
+        if len(parts) == 4:
+            parts[3] = _filler(parts[3])
+        return ",".join(parts)
+    if cmd == "crtc":
+        return _filler(payload)
+    if cmd == "join":
+        # Keep only the chat, the replay builds a token valid on its own server
+        try:
+            return base64.b64decode(payload.strip().split(".", 1)[1]).decode()
+        except Exception:
+            return ""
+    if cmd == "batc":
+        try:
+            commands = json.loads(payload)
+            return json.dumps([c[:4] + sanitize(c[:4].lower(), c[4:]) for c in commands])
+        except Exception:
+            return ""
+    return payload
+
+
+def _write(kind: int, connection_id: int, cmd: str, at: float, duration: float, uid: str, payload: str):
+    uid_bytes = pseudonymize(uid).encode()
+    payload_bytes = payload.encode()
+    header = RECORD.pack(at, connection_id, kind, cmd.encode()[:4].ljust(4),
+                         duration, len(uid_bytes), len(payload_bytes))
+    with _lock:
+        if _file is None:
+            _open()
+        _file.write(header + uid_bytes + payload_bytes)  # type: ignore
+
+
+def open_connection() -> int:
+    connection_id = next(_connection_ids)
+    _write(OPEN, connection_id, "", time.time(), 0.0, "", "")
+    return connection_id
+
+
+def close_connection(connection_id: int, uid: str):
+    _write(CLOSE, connection_id, "", time.time(), 0.0, uid, "")
+    flush()
+
+
+def traced(connection_id: int, cmd: str, handle):
+    """
+    Wrap a controller's handle so the command is recorded once it finishes,
+    timed from now (frame arrival) to include the wait for a worker.
+    """
+    received_at = time.time()
+    received = time.perf_counter()
+
+    def run(connection, payload: str):
+        try:
+            return handle(connection, payload)
+        finally:
+            _write(COMMAND, connection_id, cmd, received_at, time.perf_counter() - received,
+                   connection.uid, sanitize(cmd, payload))
+
+    return run
+
+
+def flush():
+    with _lock:
+        if _file is not None:
+            _file.flush()
+
+
+def read(path: str):
+    """
+    Yield (time, connection, kind, command, duration, uid, payload) from a trace file.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a traffic trace")
+        version = f.read(1)[0]
+        if version != VERSION:
+            raise ValueError(f"Unsupported trace version {version}")
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            at, connection_id, kind, cmd, duration, uid_len, payload_len = RECORD.unpack(
+                header)
+            uid = f.read(uid_len).decode()
+            payload = f.read(payload_len).decode()
+            yield at, connection_id, kind, cmd.decode().strip(), duration, uid, payload
+
+
+atexit.register(flush)